@@ -1,34 +1,55 @@
-from fastapi import FastAPI, UploadFile, HTTPException
+from fastapi import FastAPI, UploadFile, HTTPException, Request, BackgroundTasks, Path, Query, Depends
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from starlette.background import BackgroundTask
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
-from app.services.tasks.process_document_task import process_document, fetch_task_result
-from app.modules import rag_chat, utils, cache
-from app.config import config
+from app.services.tasks.process_document_task import (
+    process_document, update_document, fetch_task_result, status_event, events_channel, IngestionBusy,
+)
+from app.modules import rag_chat, utils, cache, uploads, connections, history, sse, metrics, tracing, limits
+from app.modules.answer_cache import AnswerCache
+from app.config import settings
+
+from contextlib import asynccontextmanager
+from typing import Optional
 
-import aiofiles, uuid
+import asyncio
+import uuid
 import logging
 import os
-import redis
 
 logging.basicConfig(
-    format="%(asctime)s - %(levelname)s - %(message)s",
+    format="%(asctime)s - %(levelname)s - [%(trace_id)s] %(message)s",
 )
+for handler in logging.getLogger().handlers:
+    handler.addFilter(tracing.TraceIdFilter())
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the model clients and the Redis pools (one sync and one async per process,
+    # shared by every module) are built on first use, not at import; the warm-up
+    # builds them ahead of the first request, in the background by default so the
+    # process accepts requests right away
+    warm_up = asyncio.create_task(asyncio.to_thread(connections.warm_up))
+    if settings.STARTUP_WARMUP == "blocking":
+        await warm_up
+    yield
+    warm_up.cancel()
+    await connections.close_async_redis()
+    connections.close_redis()
+
 # Initialize app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Initialize modules
 model = rag_chat.RagChat()
 helpers = utils.Utils()
 mem = cache.Cache()
-keys = config.Config()
-
-# Initialize redis client
-redis_client = redis.from_url(keys.REDIS_URL)
+resumable_uploads = uploads.ResumableUploads(mem.get_data_path())
 
 # Set all CORS enabled origins
 app.add_middleware(
@@ -40,6 +61,9 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
+# every request runs under a trace id, carried into the ingestion jobs it starts
+app.add_middleware(tracing.TraceMiddleware)
+
 class RequestBody(BaseModel):
     question: str
     file_id: str
@@ -47,16 +71,66 @@ class RequestBody(BaseModel):
 class SectionIDBody(BaseModel):
     file_id: str
 
+class CollectionFileBody(BaseModel):
+    file_id: str
+
+class ResumableUploadBody(BaseModel):
+    file_name: str
+    size: int
+
+@app.exception_handler(uploads.UploadError)
+async def upload_error_handler(request: Request, e: uploads.UploadError):
+    logger.error(f"Rejected upload: {e.detail}")
+    return JSONResponse(status_code=e.status_code, content={"detail": e.detail})
+
+@app.exception_handler(limits.RateLimited)
+async def rate_limited_handler(request: Request, e: limits.RateLimited):
+    logger.warning(f"Rejected chat: {e}")
+    return JSONResponse(status_code=429, content={"detail": "Too many chats, retry later."},
+                        headers={"Retry-After": str(e.retry_after)})
+
+def llm_tenants(request: Request, *tenants: str) -> list:
+    """The tenants whose LLM limits a chat counts against: the given ones and the caller's API key."""
+    api_key = request.headers.get(settings.API_KEY_HEADER)
+    return [*tenants, f"key:{api_key}"] if api_key else list(tenants)
+
+async def admit(request: Request, lookup: Optional[dict], *tenants: str) -> limits.Lease:
+    """An LLM slot for a chat, none when its answer comes from the answer cache."""
+    if model.is_cached(lookup):
+        return limits.Lease("", [])
+    return await limits.acquire(llm_tenants(request, *tenants))
+
+def chat_response(tokens, request: Request, lease: limits.Lease, meta: dict) -> StreamingResponse:
+    # the lease is released when the stream ends, and also when its body never started
+    return StreamingResponse(
+        sse.event_stream(lease.stream(tokens), request, final=lambda: meta),
+        media_type="text/event-stream",
+        headers=sse.SSE_HEADERS,
+        background=BackgroundTask(lease.release),
+    )
+
 @app.get("/api")
 async def root():
     return {"message": "Hello World"}
 
+@app.get("/metrics", include_in_schema=False)
+def prometheus_metrics():
+    """
+    Hot-path metrics in the Prometheus text format: uploads, embedding batches,
+    KNN queries, LLM time to first token and token rate, cache hit rates and
+    Redis pool usage. Ingestion stages are reported by the Celery workers.
+    """
+    if not settings.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled.")
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
 @app.get("/api/db-health")
 async def db_health():
     try:
-        redis_client.ping()
+        await connections.get_async_redis().ping()
     except Exception as e:
-        logger.error(f"Error in pinging redis @ {keys.REDIS_URL}: {e}")
+        logger.error(f"Error in pinging redis @ {connections.redis_url()}: {e}")
         raise HTTPException(status_code=500, detail="Database is not correctly configured.")
     return {"message": f"Database is healthy"}
 
@@ -69,6 +143,17 @@ def files(file_id: str):
     # TODO: implement with external db
     return {"message": mem.get_file_by_id(file_id)}
 
+def register_upload(file_id: str, file_path: str, content_hash: str):
+    """
+    Store the mapping from file_id to file path and link identical content.
+    """
+    mem.save_file(file_id, file_path)
+
+    # An identical file was uploaded before, reuse its index if it is ready
+    owner = mem.registry.claim_content_hash(file_id, content_hash)
+    if owner != file_id:
+        mem.registry.alias(file_id, owner)
+
 @app.post("/api/upload/")
 async def upload(file: UploadFile) -> JSONResponse:
     """
@@ -78,24 +163,109 @@ async def upload(file: UploadFile) -> JSONResponse:
     Returns:
         file_id: the id of the file
     """
+    uploads.check_content_type(file.content_type)
+
     # Generate a unique ID for the file
     file_id = str(uuid.uuid4())
-    file_name = file.filename
+    file_name = os.path.basename(file.filename)
     file_path = os.path.join(mem.get_data_path(), file_id + "_" + file_name)
 
-    # Save the file to disk with the unique ID as part of the filename
-    async with aiofiles.open(file_path, "wb") as out_file:
-        content = await file.read()
-        await out_file.write(content)
+    # Copy the file to disk in chunks with the unique ID as part of the filename,
+    # hashing the content as it is written
+    content_hash, _ = await uploads.stream_to_disk(uploads.iter_upload_file(file), file_path)
     
     try: 
-        # Store the mapping from unique_id to file path
-        mem.save_file(file_id, file_path)
+        await run_in_threadpool(register_upload, file_id, file_path, content_hash)
         return JSONResponse(content={"file_id": file_id})
     except Exception as e:
         logger.error(f"Error in saving uploaded file: {e}")
         raise HTTPException(status_code=500, detail="Error in saving uploaded file.")
 
+@app.post("/api/files/{file_id}/versions")
+async def upload_version(file_id: str, file: UploadFile) -> JSONResponse:
+    """
+    Upload a new version of a file and ingest it incrementally: only changed
+    pages are chunked and only new chunks embedded. Chats keep using the current
+    version until the new one is ready.
+    Args:
+        file_id: the id of the file to update
+        file: the new version
+    Returns:
+        file_id: unchanged
+        task_id: the id of the task
+    """
+    previous_path = mem.get_file_by_id(file_id)
+    if not previous_path:
+        raise HTTPException(status_code=404, detail="File not found or invalid file_id")
+    uploads.check_content_type(file.content_type)
+
+    # file_id stays the first part of the name, the version gets a name of its own
+    file_name = os.path.basename(file.filename)
+    file_path = os.path.join(mem.get_data_path(), f"{file_id}_{uuid.uuid4().hex[:8]}_{file_name}")
+    await uploads.stream_to_disk(uploads.iter_upload_file(file), file_path)
+
+    try:
+        job_id = await run_in_threadpool(update_document, file_path=file_path, file_id=file_id)
+    except IngestionBusy as e:
+        logger.error(f"Rejected new version: {e}")
+        os.remove(file_path)
+        raise HTTPException(status_code=409, detail="A new version of this file is still being processed.")
+    except Exception as e:
+        logger.error(f"Error in updating file: {e}")
+        os.remove(file_path)
+        raise HTTPException(status_code=500, detail="Error in updating file.")
+
+    mem.save_file(file_id, file_path)
+    if os.path.exists(previous_path):
+        os.remove(previous_path)
+    return JSONResponse(content={"file_id": file_id, "task_id": job_id})
+
+@app.post("/api/upload/resumable")
+def create_resumable_upload(body: ResumableUploadBody):
+    """
+    Start a resumable upload
+    Args:
+        file_name: name of the file
+        size: total size in bytes
+    Returns:
+        upload_id: the id of the upload, also the file_id once completed
+    """
+    upload_id = str(uuid.uuid4())
+    resumable_uploads.create(upload_id, body.file_name, body.size)
+    return {"upload_id": upload_id, "offset": 0, "chunk_size": settings.UPLOAD_CHUNK_SIZE}
+
+@app.get("/api/upload/resumable/{upload_id}")
+def resumable_upload_status(upload_id: str):
+    """
+    Get the offset to resume an upload from
+    """
+    session = resumable_uploads.get(upload_id)
+    return {"upload_id": upload_id, "offset": session["offset"], "size": session["size"]}
+
+@app.put("/api/upload/resumable/{upload_id}")
+async def upload_part(upload_id: str, offset: int, request: Request):
+    """
+    Append the raw request body to the upload, starting at offset
+    """
+    session = await resumable_uploads.append(upload_id, offset, request.stream())
+    return {"upload_id": upload_id, "offset": session["offset"], "size": session["size"]}
+
+@app.post("/api/upload/resumable/{upload_id}/complete")
+async def complete_resumable_upload(upload_id: str):
+    """
+    Finish a resumable upload
+    Returns:
+        file_id: the id of the file
+    """
+    session = await run_in_threadpool(resumable_uploads.complete, upload_id)
+    try:
+        content_hash = await run_in_threadpool(utils.Utils.hash_file, session["file_path"])
+        await run_in_threadpool(register_upload, upload_id, session["file_path"], content_hash)
+        return JSONResponse(content={"file_id": upload_id})
+    except Exception as e:
+        logger.error(f"Error in saving uploaded file: {e}")
+        raise HTTPException(status_code=500, detail="Error in saving uploaded file.")
+
 @app.post("/api/model_activation")
 async def model_activation(session_body: SectionIDBody):
     """
@@ -117,17 +287,98 @@ async def model_activation(session_body: SectionIDBody):
 
     logger.info("Initializing retriever and rag_chain...")
     try:
-        task = process_document.delay(
-            retrievers=mem.get_retrievers(),
-            chains=mem.get_rag_chains(),
+        job_id = await run_in_threadpool(
+            process_document,
             file_path=file_path,
             file_id=file_id
         )
-        return JSONResponse(content={"task_id": task.id})
+        return JSONResponse(content={"task_id": job_id})
     except Exception as e:
         logger.error(f"Error in initializing model: {e}")
         raise HTTPException(status_code=500, detail="Error in initializing model.")
 
+COLLECTION_NAME = Path(pattern=r"^[A-Za-z0-9_-]+$")
+
+class SearchParams(BaseModel):
+    """Per-request retrieval options, unset ones use the server defaults."""
+    k: Optional[int] = Field(None, ge=1, le=50)
+    fetch_k: Optional[int] = Field(None, ge=1, le=500)
+    mmr: Optional[bool] = None
+    lambda_mult: Optional[float] = Field(None, ge=0, le=1)
+    rerank: Optional[str] = Field(None, pattern=r"^(none|lexical|cross-encoder)$")
+    # pre-filters inside the KNN query: 1-based page range "10-20" and section number "4.2"
+    pages: Optional[str] = Field(None, pattern=r"^\d+(-\d+)?$")
+    section: Optional[str] = Field(None, pattern=r"^\d+(\.\d+)*$")
+
+    def search_kwargs(self) -> dict:
+        return self.model_dump(exclude_none=True)
+
+@app.post("/api/collections/{collection}/files")
+async def add_collection_file(body: CollectionFileBody, collection: str = COLLECTION_NAME):
+    """
+    Ingest a file into a collection's shared index
+    Args:
+        collection: name of the collection, created with its first file
+        file_id: the id of the file
+    Returns:
+        task_id: the id of the task
+    """
+    file_path = mem.get_file_by_id(body.file_id)
+    if not file_path or not os.path.exists(file_path):
+        raise HTTPException(status_code=404, detail="File not found or invalid file_id")
+
+    try:
+        job_id = await run_in_threadpool(
+            process_document,
+            file_path=file_path,
+            file_id=body.file_id,
+            collection=collection,
+        )
+        return JSONResponse(content={"task_id": job_id})
+    except Exception as e:
+        logger.error(f"Error in adding file to collection: {e}")
+        raise HTTPException(status_code=500, detail="Error in adding file to collection.")
+
+@app.get("/api/collections/{collection}")
+def collection_files(collection: str = COLLECTION_NAME):
+    """
+    Get the files of a collection
+    """
+    return {"collection": collection, "file_ids": mem.registry.get_collection_files(collection)}
+
+@app.delete("/api/collections/{collection}/files")
+async def remove_collection_file(file_id: str, background_tasks: BackgroundTasks, collection: str = COLLECTION_NAME):
+    """
+    Remove a file from a collection, its chunks are deleted in the background
+    """
+    if not await run_in_threadpool(mem.registry.in_collection, collection, file_id):
+        raise HTTPException(status_code=404, detail="File is not in this collection.")
+    background_tasks.add_task(mem.registry.remove_from_collection, collection, file_id)
+    return {"message": "File removed from collection."}
+
+@app.post("/api/collections/{collection}/chat_completion")
+async def collection_chat_completion(question: str, session_id: str, request: Request,
+                                     file_ids: list[str] = Query(None),
+                                     search: SearchParams = Depends(),
+                                     collection: str = COLLECTION_NAME):
+    """
+    Answer from every file of a collection, or only from file_ids, in one KNN query
+    """
+    retriever, rag_chain = await run_in_threadpool(mem.registry.get_collection, collection, file_ids)
+    if retriever is None or rag_chain is None:
+        raise HTTPException(status_code=404, detail="Collection not found or empty.")
+
+    meta = {}
+    scope = retriever.vectorstore.index_name
+    variant = AnswerCache.variant(file_ids, search.search_kwargs())
+    lookup = await model.lookup_answer(question, scope, variant)
+    lease = await admit(request, lookup, f"collection:{collection}")
+    tokens = model.output_generation(
+        question, session_id, rag_chain, scope=scope, meta=meta,
+        variant=variant, search_kwargs=search.search_kwargs(), lookup=lookup,
+    )
+    return chat_response(tokens, request, lease, meta)
+
 @app.get("/api/preprocessing_status")
 def get_processing_status(task_id: str):
     """
@@ -140,53 +391,84 @@ def get_processing_status(task_id: str):
         raise HTTPException(status_code=404, detail="Cannot find the specified task.")
     return JSONResponse(content=result)
 
+@app.get("/api/preprocessing_events")
+async def get_processing_events(request: Request, task_id: str):
+    """
+    Follow the processing of a file as server-sent events, instead of polling
+    /api/preprocessing_status: "progress" per stage, then "ready" with the index
+    stats or "error". Reconnecting starts again from the current status.
+    """
+    status = lambda: status_event(fetch_task_result(task_id))
+    return StreamingResponse(sse.job_events(task_id, request, events_channel(task_id), status),
+                             media_type="text/event-stream",
+                             headers=sse.SSE_HEADERS)
+
 
 @app.post("/api/chat_completion/")
-async def chat_completion(file_id: str, question: str):
+async def chat_completion(file_id: str, question: str, request: Request, search: SearchParams = Depends()):
     """
-    Get response from model, use LLM if the model is not initialized
+    Get response from model as server-sent events, use LLM if the model is not initialized.
+    Retrieval can be tuned per request with k, fetch_k, mmr, lambda_mult and rerank,
+    and restricted to pages ("10-20") or a section ("4.2").
+    Events: "token" ({"text"}) while generating, then "done" ({"sources", "citations",
+    "usage", "cached"}) or "error" ({"detail"}).
+    Answers not found in the answer cache queue for an LLM slot within the global,
+    per file_id and per API key limits, and get a 429 with Retry-After when none frees up in time.
     """
     file_id = file_id
-    retriever, rag_chain = mem.get_cached_file(file_id)
+    meta = {}
+    retriever, rag_chain = await run_in_threadpool(mem.get_cached_file, file_id)
     # If retriever and rag_chain are not initialized, initialize them
     if retriever is None or rag_chain is None:
         # Normal LLM call without context
-        async def generate():
-            async for token in model.chat_completion(question):
-                yield token.content + " "
-        return StreamingResponse(generate(), media_type="text/event-stream")
+        lookup = await model.lookup_answer(question, "llm", standalone_only=False)
+        lease = await admit(request, lookup, f"file:{file_id}")
+        tokens = model.chat_completion(question, meta, lookup=lookup)
     else:
-        async def generate():
-            async for token in model.output_generation(question, file_id, rag_chain):
-                yield str(token) + " "
-        return StreamingResponse(generate(), media_type="text/event-stream")
+        scope = retriever.vectorstore.index_name
+        variant = AnswerCache.variant(search_kwargs=search.search_kwargs())
+        lookup = await model.lookup_answer(question, scope, variant)
+        lease = await admit(request, lookup, f"file:{file_id}")
+        tokens = model.output_generation(
+            question, file_id, rag_chain, scope=scope, meta=meta,
+            variant=variant, search_kwargs=search.search_kwargs(), lookup=lookup,
+        )
+    return chat_response(tokens, request, lease, meta)
 
 
 @app.post("/api/chat/")
-async def chat(question: str):
-    async def generate():
-        async for token in model.chat_completion(question):
-            yield token.content + " "
-
-    return StreamingResponse(generate(), media_type="text/plain")
+async def chat(question: str, request: Request):
+    meta = {}
+    lookup = await model.lookup_answer(question, "llm", standalone_only=False)
+    lease = await admit(request, lookup)
+    return chat_response(model.chat_completion(question, meta, lookup=lookup), request, lease, meta)
 
 @app.get("/api/chat_history")
 async def chat_history(session_id: str):
     """
     Get chat history, uses file_id as session_id
     """
-    chat_history = helpers.get_session_history(session_id).messages
+    chat_history = await helpers.get_session_history(session_id)
     return {"message": chat_history}
 
 @app.delete("/api/delete")
-async def delete(file_id: str):
+async def delete(file_id: str, background_tasks: BackgroundTasks):
     """
-    Delete a file
+    Delete a file, its chat history, its chunks in every collection and, once no
+    other file shares it, its index. Index and collection keys are removed in the background.
     """
     try:
         mem.delete_file(file_id)
-        redis_client.delete(f"doc:{file_id}:*")
-        redis_client.delete(f"message_store:{file_id}:*")
+        # out of its collections first, their job claims are found through its content hash
+        for collection in await run_in_threadpool(mem.registry.collections_of, file_id):
+            await run_in_threadpool(mem.registry.leave_collection, collection, file_id)
+            background_tasks.add_task(mem.registry.remove_from_collection, collection, file_id)
+        index = await run_in_threadpool(mem.registry.remove, file_id)
+        if index is not None:
+            background_tasks.add_task(mem.registry.drop_index, *index)
+        await connections.get_async_redis().unlink(
+            utils.MESSAGE_STORE_PREFIX + file_id, history.SUMMARY_PREFIX + file_id
+        )
         return {"message": "File deleted successfully."}
     except Exception as e:
         logger.error(f"Error in deleting file: {e}")
@@ -198,7 +480,7 @@ async def flush():
     Flush all data
     """
     try:
-        redis_client.flushall()
+        await connections.get_async_redis().flushall()
         mem.clear_cache()
     except Exception as e:
         logger.error(f"Error in flushing data: {e}")
@@ -0,0 +1,175 @@
+"""
+Chunking strategies compared on chunking time, embedding calls and retrieval quality.
+
+    python -m app.benchmarks.chunking [--pdf file.pdf] [--pages 300] [--model hashing|config]
+                                      [--strategies semantic,markdown,recursive,hybrid] [--json out.json]
+
+Two corpora: the PDF (app/test/sample-1.pdf by default), parsed like ingestion does,
+and a synthetic markdown document of --pages pages with numbered sections on
+distinct topics. Queries are sentences of the corpus with a third of their words
+dropped; a query is answered when one of its top k chunks contains the whole
+sentence. Embeddings default to a local hashing bag-of-words model, so the run
+is offline and free (semantic split points are then lexical); --model config
+uses the configured embedding model instead.
+"""
+import argparse
+import json
+import math
+import os
+import time
+from typing import List
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from app.benchmarks.fakes import HashingEmbeddings
+from app.config import settings
+from app.modules.chunking import STRATEGIES, count_tokens, get_chunker
+from app.modules.preprocessing import SENTENCE_PATTERN, parse_page_range
+
+TOPICS = [
+    ("billing", "invoice payment refund charge account balance credit tax receipt currency"),
+    ("security", "password token encryption access audit firewall breach certificate key role"),
+    ("shipping", "parcel carrier delivery tracking warehouse customs pallet route courier freight"),
+    ("hiring", "candidate interview offer salary onboarding contract probation reference benefit role"),
+    ("safety", "hazard helmet inspection incident evacuation training ladder spill guard alarm"),
+    ("privacy", "consent retention erasure processor controller breach transfer subject cookie record"),
+]
+FILLER = "the a of to and in for is on that with as by be this are from at or it".split()
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self, embeddings: Embeddings):
+        """Count the requests and texts sent to an embedding model."""
+        self.embeddings = embeddings
+        self.requests = 0
+        self.texts = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.requests += 1
+        self.texts += len(texts)
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        self.requests += 1
+        self.texts += 1
+        return self.embeddings.embed_query(text)
+
+def synthetic_pages(n_pages: int, seed: int = 0) -> list:
+    """Markdown pages like pymupdf4llm output: numbered sections of 2 to 6 pages on one topic each."""
+    rng = np.random.default_rng(seed)
+    pages, section, remaining, topic = [], 0, 0, None
+    for page in range(n_pages):
+        lines = []
+        if remaining == 0:
+            section += 1
+            remaining = int(rng.integers(2, 7))
+            topic = TOPICS[section % len(TOPICS)]
+            lines.append(f"# {section} {topic[0].title()} policy\n")
+        for paragraph in range(int(rng.integers(3, 6))):
+            if rng.random() < 0.3:
+                lines.append(f"## {section}.{paragraph + 1} {topic[0].title()} rules\n")
+            words = topic[1].split()
+            sentences = []
+            for _ in range(int(rng.integers(3, 7))):
+                picked = rng.choice(words + FILLER, size=int(rng.integers(8, 16)))
+                sentences.append(" ".join(picked).capitalize() + f" {int(rng.integers(10, 10000))}.")
+            lines.append(" ".join(sentences) + "\n")
+        remaining -= 1
+        pages.append(Document(page_content="\n".join(lines), metadata={"page": page, "source": "synthetic"}))
+    return pages
+
+def normalize(text: str) -> str:
+    return " ".join(text.split())
+
+def make_queries(pages: list, n_queries: int, seed: int = 1) -> list:
+    """(query, sentence) pairs: corpus sentences with a third of their words dropped."""
+    rng = np.random.default_rng(seed)
+    sentences = [
+        normalize(sentence) for page in pages for sentence in SENTENCE_PATTERN.split(page.page_content)
+        if len(sentence.split()) >= 8 and not sentence.lstrip().startswith("#")
+    ]
+    picked = rng.choice(len(sentences), size=min(n_queries, len(sentences)), replace=False)
+    queries = []
+    for i in picked:
+        words = sentences[i].split()
+        keep = sorted(rng.choice(len(words), size=math.ceil(len(words) * 2 / 3), replace=False))
+        queries.append((" ".join(words[j] for j in keep), sentences[i]))
+    return queries
+
+def run(pages: list, strategy: str, embeddings: Embeddings, queries: list, k: int) -> dict:
+    counting = CountingEmbeddings(embeddings)
+    start = time.perf_counter()
+    chunks = get_chunker(counting, strategy).split_documents(pages)
+    chunk_seconds = time.perf_counter() - start
+
+    # ingestion embeds every chunk once, in INGEST_BATCH_SIZE batches
+    start = time.perf_counter()
+    texts = [chunk.page_content for chunk in chunks]
+    vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    embed_seconds = time.perf_counter() - start
+    ingest_requests = math.ceil(len(texts) / settings.INGEST_BATCH_SIZE)
+
+    query_vectors = np.asarray(embeddings.embed_documents([query for query, _ in queries]), dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query_vectors /= np.maximum(np.linalg.norm(query_vectors, axis=1, keepdims=True), 1e-12)
+    top = np.argsort(-(query_vectors @ vectors.T), axis=1)[:, :k]
+    normalized = [normalize(text) for text in texts]
+    hits = [any(sentence in normalized[i] for i in row) for (_, sentence), row in zip(queries, top)]
+
+    tokens = [count_tokens(text) for text in texts]
+    return {
+        "strategy": strategy,
+        "chunks": len(chunks),
+        "mean_tokens": round(float(np.mean(tokens)), 1),
+        "max_tokens": int(max(tokens)),
+        "chunk_seconds": round(chunk_seconds, 3),
+        "ingest_seconds": round(chunk_seconds + embed_seconds, 3),
+        "chunking_embed_texts": counting.texts,
+        "embed_texts": counting.texts + len(texts),
+        "embed_requests": counting.requests + ingest_requests,
+        f"recall@{k}": round(float(np.mean(hits)), 4),
+        f"context_tokens@{k}": round(float(np.mean([sum(tokens[i] for i in row) for row in top])), 1),
+    }
+
+def main():
+    default_pdf = os.path.join(os.path.dirname(__file__), "..", "test", "sample-1.pdf")
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pdf", default=default_pdf, help="PDF corpus, parsed like ingestion does")
+    parser.add_argument("--pages", type=int, default=300, help="pages of the synthetic document, 0 to skip it")
+    parser.add_argument("--model", choices=("hashing", "config"), default="hashing")
+    parser.add_argument("--strategies", default=",".join(STRATEGIES))
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=settings.RETRIEVER_K)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    if args.model == "config":
+        from app.modules.connections import get_embeddings
+        embeddings = get_embeddings()
+    else:
+        embeddings = HashingEmbeddings()
+
+    import pymupdf
+    with pymupdf.open(args.pdf) as doc:
+        total_pages = len(doc)
+    corpora = {os.path.basename(args.pdf): parse_page_range((args.pdf, 0, total_pages))}
+    if args.pages:
+        corpora[f"synthetic-{args.pages}p"] = synthetic_pages(args.pages)
+
+    results = []
+    for name, pages in corpora.items():
+        queries = make_queries(pages, args.queries)
+        print(f"\n{name}: {len(pages)} pages, {sum(count_tokens(p.page_content) for p in pages)} tokens, {len(queries)} queries")
+        rows = [{"corpus": name, **run(pages, strategy, embeddings, queries, args.k)} for strategy in args.strategies.split(",")]
+        columns = list(rows[0])[1:]
+        print("  ".join(f"{c:>20}" for c in columns))
+        for row in rows:
+            print("  ".join(f"{row[c]:>20.3f}" if isinstance(row[c], float) else f"{row[c]:>20}" for c in columns))
+        results += rows
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Memory and recall of the compact storage modes against the float32 baseline.
+
+    python -m app.benchmarks.compact_storage [--vectors embeddings.npy] [--pdf file.pdf]
+                                             [--redis-url redis://...] [--json out.json]
+
+Vectors default to a synthetic corpus with low-rank structure, like real text
+embeddings; pass real ones (one row per chunk, e.g. dumped from an index) for
+numbers that matter. Recall@k compares the top k of every mode with the exact
+float32 top k. Memory per million chunks is computed from the stored bytes, and
+measured in Redis (FT.INFO / INFO memory) when --redis-url is given.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from app.modules.compact import VectorCodec, compress_text
+
+MODES = [
+    # name, datatype, pca components, compact text
+    ("float32", "FLOAT32", 0, False),
+    ("float16", "FLOAT16", 0, False),
+    ("int8", "INT8", 0, False),
+    ("float16+zstd", "FLOAT16", 0, True),
+    ("int8+zstd", "INT8", 0, True),
+    ("pca256+float16+zstd", "FLOAT16", 256, True),
+    ("pca256+int8+zstd", "INT8", 256, True),
+    ("pca128+int8+zstd", "INT8", 128, True),
+]
+BYTES = {"FLOAT32": 4, "FLOAT16": 2, "INT8": 1}
+DTYPES = {"FLOAT32": np.float32, "FLOAT16": np.float16, "INT8": np.int8}
+
+def synthetic_vectors(n: int, dim: int, rank: int = 64, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(size=(n, rank)) @ rng.normal(size=(rank, dim)) + 0.3 * rng.normal(size=(n, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+def sample_texts(pdf_path: str, chunk_chars: int = 1000) -> list:
+    import pymupdf
+
+    with pymupdf.open(pdf_path) as doc:
+        text = "".join(page.get_text() for page in doc)
+    return [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)] or ["empty"]
+
+def top_k(corpus: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    corpus = corpus / np.maximum(np.linalg.norm(corpus, axis=1, keepdims=True), 1e-12)
+    queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+    return np.argsort(-(queries @ corpus.T), axis=1)[:, :k]
+
+def recall(truth: np.ndarray, found: np.ndarray) -> float:
+    return float(np.mean([len(set(t) & set(f)) / len(t) for t, f in zip(truth, found)]))
+
+def measure_redis(redis_url: str, name: str, stored: np.ndarray, datatype: str, texts: list, compact: bool) -> dict:
+    """Write the corpus to a throwaway index and read what Redis reports."""
+    import redis
+    from redis.commands.search.field import TextField, VectorField
+
+    try:
+        from redis.commands.search.index_definition import IndexDefinition, IndexType
+    except ImportError:  # redis-py < 6
+        from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+
+    client = redis.Redis.from_url(redis_url)
+    index, prefix = f"bench_{name}", f"bench:{name}:"
+    before = client.info("memory")["used_memory"]
+    client.ft(index).create_index(
+        (TextField("content"), VectorField("content_vector", "FLAT", {
+            "TYPE": datatype, "DIM": stored.shape[1], "DISTANCE_METRIC": "COSINE",
+        })),
+        definition=IndexDefinition(prefix=[prefix], index_type=IndexType.HASH),
+    )
+    try:
+        pipeline = client.pipeline(transaction=False)
+        for i, vector in enumerate(stored):
+            text = texts[i % len(texts)]
+            pipeline.hset(f"{prefix}{i}", mapping={
+                "content": "" if compact else text,
+                "content_vector": vector.astype(DTYPES[datatype]).tobytes(),
+            })
+            if compact:
+                pipeline.set(f"{prefix}{i}:text", compress_text(text))
+            if i % 1000 == 999:
+                pipeline.execute()
+        pipeline.execute()
+        while int(client.ft(index).info().get("indexing", 0)):
+            time.sleep(0.1)
+        info = client.ft(index).info()
+        used = client.info("memory")["used_memory"] - before
+        scale = 1_000_000 / len(stored)
+        return {
+            "redis_used_mb_per_million": used * scale / 2 ** 20,
+            "index_vector_mb_per_million": float(info.get("vector_index_sz_mb", 0)) * scale,
+        }
+    finally:
+        client.ft(index).dropindex(delete_documents=True)
+        for key in client.scan_iter(match=f"{prefix}*", count=1000):
+            client.unlink(key)
+
+def run(vectors: np.ndarray, texts: list, n_queries: int, k: int, redis_url: str = None) -> list:
+    rng = np.random.default_rng(1)
+    picked = rng.choice(len(vectors), size=min(n_queries, len(vectors)), replace=False)
+    # queries close to, but not equal to, corpus vectors
+    queries = vectors[picked] + 0.05 * rng.normal(size=(len(picked), vectors.shape[1])).astype(np.float32)
+    truth = top_k(vectors, queries, k)
+
+    raw_text = np.mean([len(t.encode("utf-8")) for t in texts])
+    compressed_text = np.mean([len(compress_text(t)) for t in texts])
+
+    results = []
+    for name, datatype, components, compact in MODES:
+        codec = VectorCodec(datatype, compact_text=compact)
+        if components and not codec.fit(vectors, min(components, vectors.shape[1])):
+            print(f"skipping {name}: too few vectors to fit {components} components")
+            continue
+        stored = codec.encode(vectors).astype(DTYPES[datatype])
+        found = top_k(stored.astype(np.float32), codec.encode(queries), k)
+
+        dims = stored.shape[1]
+        vector_bytes = dims * BYTES[datatype]
+        text_bytes = compressed_text if compact else raw_text
+        result = {
+            "mode": name,
+            "dims": dims,
+            "vector_bytes": vector_bytes,
+            "text_bytes": round(float(text_bytes), 1),
+            # what the KNN index has to keep resident, and the total payload
+            "index_vector_mb_per_million": vector_bytes * 1_000_000 / 2 ** 20,
+            "payload_mb_per_million": (vector_bytes + text_bytes) * 1_000_000 / 2 ** 20,
+            f"recall@{k}": round(recall(truth, found), 4),
+        }
+        if redis_url:
+            result.update(measure_redis(redis_url, name.replace("+", "_"), stored, datatype, texts, compact))
+        results.append(result)
+    return results
+
+def main():
+    default_pdf = os.path.join(os.path.dirname(__file__), "..", "test", "sample-1.pdf")
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", help=".npy file of embeddings, one row per chunk")
+    parser.add_argument("--count", type=int, default=20000, help="synthetic corpus size")
+    parser.add_argument("--dim", type=int, default=768, help="synthetic vector dimension")
+    parser.add_argument("--pdf", default=default_pdf, help="PDF providing sample chunk text")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--redis-url", help="also measure memory in this Redis (writes a throwaway index)")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    vectors = np.load(args.vectors).astype(np.float32) if args.vectors else synthetic_vectors(args.count, args.dim)
+    texts = sample_texts(args.pdf)
+    results = run(vectors, texts, args.queries, args.k, args.redis_url)
+
+    print(f"{len(vectors)} vectors of {vectors.shape[1]} dimensions, {len(texts)} sample chunks")
+    columns = list(results[0])
+    print("  ".join(f"{c:>22}" for c in columns))
+    for result in results:
+        print("  ".join(f"{v:>22.2f}" if isinstance(v, float) else f"{v:>22}" for v in result.values()))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Deterministic, offline stand-ins for the configured models, for benchmarks.
+
+Embeddings are hashed bags of words, so similar texts get similar vectors and
+retrieval behaves like it does with a real model. The chat model streams words
+of its prompt at a fixed rate after a fixed first-token delay. Latencies are
+slept, not computed, so many concurrent requests cost no CPU.
+"""
+import asyncio
+import re
+import sys
+import time
+import types
+import zlib
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+WORD_PATTERN = re.compile(r"\w+")
+
+class HashingEmbeddings(Embeddings):
+    def __init__(self, dim: int = 512):
+        """Bag of words hashed into dim buckets, L2 normalised. Deterministic and offline."""
+        self.dim = dim
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in WORD_PATTERN.findall(text.lower()):
+            vector[zlib.crc32(word.encode("utf-8")) % self.dim] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+class FakeEmbeddings(HashingEmbeddings):
+    def __init__(self, dim: int = 768, latency: float = 0.0, text_latency: float = 0.0,
+                 model: str = "fake-embedding"):
+        """Hashing embeddings behind a simulated API.
+        Args:
+            latency: seconds per request
+            text_latency: additional seconds per text of a request
+            model: name the embedding cache and index registry know the model by
+        """
+        super().__init__(dim)
+        self.latency = latency
+        self.text_latency = text_latency
+        self.model = model
+        self.requests = 0
+        self.texts = 0
+
+    def _delay(self, count: int) -> float:
+        self.requests += 1
+        self.texts += count
+        return self.latency + self.text_latency * count
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self._delay(len(texts)))
+        return super().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        time.sleep(self._delay(1))
+        return super().embed_query(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self._delay(len(texts)))
+        return super().embed_documents(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        await asyncio.sleep(self._delay(1))
+        return super().embed_query(text)
+
+class FakeChatModel(BaseChatModel):
+    """Chat model answering with answer_tokens words of its last message, one word per token,
+    streamed at tokens_per_second after first_token_latency seconds. Reports token usage
+    (input tokens approximated as words) like the provider integrations do.
+    """
+
+    first_token_latency: float = 0.3
+    tokens_per_second: float = 50.0
+    answer_tokens: int = 100
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _tokens(self, messages: List[BaseMessage]) -> List[str]:
+        words = WORD_PATTERN.findall(str(messages[-1].content) if messages else "") or ["ok"]
+        return [f"{words[i % len(words)]} " for i in range(self.answer_tokens)]
+
+    def _usage(self, messages: List[BaseMessage]) -> dict:
+        input_tokens = sum(len(WORD_PATTERN.findall(str(message.content))) for message in messages)
+        return {"input_tokens": input_tokens, "output_tokens": self.answer_tokens,
+                "total_tokens": input_tokens + self.answer_tokens}
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.first_token_latency + (self.answer_tokens - 1) / self.tokens_per_second)
+        message = AIMessage(content="".join(self._tokens(messages)), usage_metadata=self._usage(messages),
+                            response_metadata={"model_name": self._llm_type})
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _chunks(self, messages: List[BaseMessage]) -> Iterator[ChatGenerationChunk]:
+        tokens = self._tokens(messages)
+        for i, token in enumerate(tokens):
+            if i < len(tokens) - 1:
+                yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+            else:
+                # usage is keyed by model name, like the provider integrations report it
+                yield ChatGenerationChunk(message=AIMessageChunk(
+                    content=token, usage_metadata=self._usage(messages),
+                    response_metadata={"model_name": self._llm_type},
+                ))
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.first_token_latency)
+        for i, chunk in enumerate(self._chunks(messages)):
+            if i:
+                time.sleep(1 / self.tokens_per_second)
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.first_token_latency)
+        for i, chunk in enumerate(self._chunks(messages)):
+            if i:
+                await asyncio.sleep(1 / self.tokens_per_second)
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+def install_config(redis_url: str, embeddings: Embeddings, llm: BaseChatModel):
+    """
+    Make app.config.config.Config return the stand-ins. Has to run before the first
+    Config is built, connections.get_config() keeps it for the life of the process.
+    """
+    config = type("Config", (), {"REDIS_URL": redis_url, "EMBED_MODEL": embeddings, "LLM_MODEL": llm})
+    module = types.ModuleType("app.config.config")
+    module.Config = config
+    sys.modules["app.config.config"] = module
+    if "app.config" in sys.modules:
+        sys.modules["app.config"].Config = config
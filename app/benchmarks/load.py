@@ -0,0 +1,246 @@
+"""
+Offline load test of ingestion, retrieval and streaming chats, with the fake models
+of app.benchmarks.fakes in place of the configured ones.
+
+    python -m app.benchmarks.load [--redis-url redis://localhost:6379] [--pdf file.pdf | --pages 200]
+                                  [--concurrency 1,8,32] [--requests 32] [--json out.json]
+
+Needs a Redis Stack server (RediSearch), e.g. docker run -p 6379:6379 redis/redis-stack-server.
+There is no in-process stand-in, fakeredis has no vector search. Use a dedicated
+server: Redis ops are read from INFO commandstats, which counts every client.
+
+The document (the synthetic one of the chunking benchmark unless --pdf is given) is
+chunked, embedded, indexed and registered in process, like the ingestion pipeline
+does without Celery; then each query is searched once, and --requests chats are
+streamed through the RAG chain at each concurrency level. Model latencies are
+configurable, the defaults are in the range of hosted models. Everything the run
+writes (index, registry entries, cached embeddings, chat histories) is removed at
+the end.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import time
+import uuid
+
+import numpy as np
+
+from app.benchmarks.fakes import FakeChatModel, FakeEmbeddings, install_config
+
+def redis_calls(client) -> int:
+    """Commands the server has run so far, minus the INFO reading it."""
+    return sum(stats["calls"] for stats in client.info("commandstats").values()) - 1
+
+def latency_stats(seconds: list) -> dict:
+    values = np.asarray(seconds) * 1000
+    return {
+        "mean_ms": round(float(values.mean()), 2),
+        "p50_ms": round(float(np.percentile(values, 50)), 2),
+        "p95_ms": round(float(np.percentile(values, 95)), 2),
+        "max_ms": round(float(values.max()), 2),
+    }
+
+def unlink_matching(client, pattern: str) -> int:
+    deleted = 0
+    for key in client.scan_iter(match=pattern, count=1000):
+        deleted += client.unlink(key)
+    return deleted
+
+def commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+def ingest(pages: list, file_path: str, embeddings: FakeEmbeddings, chunking: str) -> dict:
+    from app.modules.connections import get_redis
+    from app.modules.preprocessing import DocumentProcessor, heading_outline
+    from app.modules.registry import IndexRegistry
+
+    client = get_redis()
+    processor = DocumentProcessor(file_path, chunking=chunking)
+    calls, requests = redis_calls(client), embeddings.requests
+
+    start = time.perf_counter()
+    outline = heading_outline(pages)
+    chunks = processor.split_pages(pages, outline=outline)
+    chunked = time.perf_counter()
+    processor.embed_chunks(chunks)
+    embedded = time.perf_counter()
+    vector = processor.ingest_document(chunks, page_hashes=processor.page_hashes(pages, outline))
+    processor.finish_ingestion(vector)
+    IndexRegistry().register(processor.file_id, vector, chunk_count=len(chunks))
+    end = time.perf_counter()
+
+    redis_ops = redis_calls(client) - calls
+    return {
+        "pages": len(pages),
+        "chunks": len(chunks),
+        "chunk_seconds": round(chunked - start, 3),
+        "embed_seconds": round(embedded - chunked, 3),
+        "index_seconds": round(end - embedded, 3),
+        "pages_per_second": round(len(pages) / (end - start), 2),
+        "chunks_per_second": round(len(chunks) / (end - start), 2),
+        "embed_requests": embeddings.requests - requests,
+        "redis_ops": redis_ops,
+        "redis_ops_per_page": round(redis_ops / len(pages), 2),
+    }
+
+def retrieve(retriever, queries: list) -> dict:
+    from app.modules.connections import get_redis
+
+    client = get_redis()
+    calls = redis_calls(client)
+    seconds = []
+    for query in queries:
+        start = time.perf_counter()
+        retriever.search(query)
+        seconds.append(time.perf_counter() - start)
+    return {
+        "queries": len(queries),
+        **latency_stats(seconds),
+        "redis_ops_per_query": round((redis_calls(client) - calls) / len(queries), 2),
+    }
+
+async def chat(chain, questions: list, concurrency: int, requests: int, session_prefix: str) -> dict:
+    """Stream requests chats through the chain, concurrency of them at a time."""
+    from app.modules.connections import get_redis
+    from app.modules.rag_chat import RagChat
+
+    client = get_redis()
+    rag = RagChat()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int) -> tuple:
+        async with semaphore:
+            start = time.perf_counter()
+            first, tokens = None, 0
+            async for _ in rag.output_generation(questions[i % len(questions)], f"{session_prefix}{i}", chain):
+                if first is None:
+                    first = time.perf_counter()
+                tokens += 1
+            end = time.perf_counter()
+            first = first or end
+            return first - start, end - start, tokens, (tokens - 1) / (end - first) if tokens > 1 else 0.0
+
+    calls = await asyncio.to_thread(redis_calls, client)
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one(i) for i in range(requests)))
+    wall = time.perf_counter() - start
+    redis_ops = await asyncio.to_thread(redis_calls, client) - calls
+
+    ttft, total, tokens, rates = zip(*results)
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "ttft": latency_stats(ttft),
+        "response": latency_stats(total),
+        "stream_tokens_per_second": round(float(np.mean(rates)), 2),
+        "tokens_per_second": round(sum(tokens) / wall, 2),
+        "requests_per_second": round(requests / wall, 2),
+        "redis_ops_per_request": round(redis_ops / requests, 2),
+    }
+
+async def chats(chain, questions: list, levels: list, requests: int, session_prefix: str) -> list:
+    # one event loop for every level, the async Redis pool is bound to it
+    from app.modules.connections import close_async_redis
+
+    try:
+        return [
+            await chat(chain, questions, concurrency, max(requests, concurrency), f"{session_prefix}{concurrency}:")
+            for concurrency in levels
+        ]
+    finally:
+        await close_async_redis()
+
+def cleanup(file_id: str, model: str, session_prefix: str):
+    from app.modules.connections import get_redis
+    from app.modules.history import SUMMARY_PREFIX
+    from app.modules.registry import IndexRegistry
+    from app.modules.utils import MESSAGE_STORE_PREFIX
+
+    registry = IndexRegistry()
+    dropped = registry.remove(file_id)
+    if dropped:
+        registry.drop_index(*dropped)
+    client = get_redis()
+    for pattern in (f"embedding:{model}:*", f"embedding_stats:{model}*",
+                    f"{MESSAGE_STORE_PREFIX}{session_prefix}*", f"{SUMMARY_PREFIX}{session_prefix}*"):
+        unlink_matching(client, pattern)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis-url", default=os.getenv("REDIS_URL", "redis://localhost:6379"))
+    parser.add_argument("--pdf", help="document to ingest, instead of the synthetic one")
+    parser.add_argument("--pages", type=int, default=200, help="pages of the synthetic document")
+    parser.add_argument("--chunking", help="chunking strategy, CHUNKING_STRATEGY by default")
+    parser.add_argument("--queries", type=int, default=100, help="retrieval queries, also the chat questions")
+    parser.add_argument("--concurrency", default="1,8,32", help="concurrent chats, one run per level")
+    parser.add_argument("--requests", type=int, default=32, help="chats per level, at least the concurrency")
+    parser.add_argument("--embed-dim", type=int, default=768)
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="seconds per embedding request")
+    parser.add_argument("--embed-text-latency", type=float, default=0.001, help="extra seconds per embedded text")
+    parser.add_argument("--first-token-latency", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--answer-tokens", type=int, default=100)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    run_id = uuid.uuid4().hex[:8]
+    # a model name of its own, so the embedding cache starts cold
+    embeddings = FakeEmbeddings(args.embed_dim, args.embed_latency, args.embed_text_latency,
+                                model=f"fake-embedding-{run_id}")
+    llm = FakeChatModel(first_token_latency=args.first_token_latency, tokens_per_second=args.tokens_per_second,
+                        answer_tokens=args.answer_tokens)
+    install_config(args.redis_url, embeddings, llm)
+
+    from app.benchmarks.chunking import make_queries, synthetic_pages
+    from app.config import settings
+    from app.modules.preprocessing import parse_page_range
+    from app.modules.registry import IndexRegistry
+
+    if args.pdf:
+        import pymupdf
+        with pymupdf.open(args.pdf) as doc:
+            total_pages = len(doc)
+        start = time.perf_counter()
+        pages = parse_page_range((args.pdf, 0, total_pages))
+        parse_seconds = time.perf_counter() - start
+        name = os.path.basename(args.pdf)
+    else:
+        pages, parse_seconds, name = synthetic_pages(args.pages), 0.0, f"synthetic-{args.pages}p.pdf"
+    file_id = f"bench{run_id}"
+    session_prefix = f"bench:{run_id}:"
+    queries = [query for query, _ in make_queries(pages, args.queries)]
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    results = {
+        "commit": commit(),
+        "document": name,
+        "params": {key: value for key, value in vars(args).items() if key not in ("redis_url", "json")},
+    }
+    try:
+        results["ingestion"] = ingest(pages, f"{file_id}_{name}", embeddings, args.chunking or settings.CHUNKING_STRATEGY)
+        results["ingestion"]["parse_seconds"] = round(parse_seconds, 3)
+        retriever, chain = IndexRegistry().get(file_id)
+        results["retrieval"] = retrieve(retriever, queries)
+        results["chat"] = asyncio.run(chats(chain, queries, levels, args.requests, session_prefix))
+    finally:
+        cleanup(file_id, embeddings.model, session_prefix)
+
+    print(f"{name}: {json.dumps(results['ingestion'])}")
+    print(f"retrieval: {json.dumps(results['retrieval'])}")
+    columns = ("concurrency", "ttft p50 ms", "ttft p95 ms", "stream tok/s", "total tok/s", "req/s", "redis ops/req")
+    print("  ".join(f"{c:>14}" for c in columns))
+    for level in results["chat"]:
+        row = (level["concurrency"], level["ttft"]["p50_ms"], level["ttft"]["p95_ms"], level["stream_tokens_per_second"],
+               level["tokens_per_second"], level["requests_per_second"], level["redis_ops_per_request"])
+        print("  ".join(f"{v:>14}" for v in row))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
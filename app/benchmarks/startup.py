@@ -0,0 +1,147 @@
+"""
+Cold start of the API and of the Celery worker, each run in a fresh interpreter.
+
+    python -m app.benchmarks.startup [--runs 5] [--fake-models] [--redis-url redis://...]
+                                     [--port 8765] [--json out.json]
+
+- import: time to import app.app and app.services.worker
+- serve: time from launching uvicorn to the first answer of GET /api, and of
+  GET /api/db-health (Redis reachable, needs a running Redis)
+- slowest imports of app.app, from python -X importtime
+
+Medians over --runs. The configured models are used (app/config/config.py),
+--fake-models swaps in the stand-ins of app.benchmarks.fakes, which need no keys
+and no network; they are built on first use, like the real clients.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FAKE_CONFIG = """
+import os, sys, types
+# as app/.env would, so Celery and the pools do not need Config
+os.environ.setdefault("REDIS_URL", {redis_url!r})
+class Config:
+    def __init__(self):
+        from app.benchmarks.fakes import FakeChatModel, FakeEmbeddings
+        self.REDIS_URL, self.EMBED_MODEL, self.LLM_MODEL = {redis_url!r}, FakeEmbeddings(), FakeChatModel()
+module = types.ModuleType("app.config.config")
+module.Config = Config
+sys.modules["app.config.config"] = module
+"""
+
+IMPORT = """
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+
+SERVE = """
+import uvicorn
+uvicorn.run("app.app:app", host="127.0.0.1", port={port}, log_level="warning")
+"""
+
+def script(body: str, fake_models: bool, redis_url: str) -> str:
+    return (FAKE_CONFIG.format(redis_url=redis_url) if fake_models else "") + body
+
+def python(code: str, *flags: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *flags, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+
+def import_seconds(module: str, fake_models: bool, redis_url: str) -> float:
+    return float(python(script(IMPORT.format(module=module), fake_models, redis_url)).stdout.strip().splitlines()[-1])
+
+def slowest_imports(fake_models: bool, redis_url: str, top: int) -> list:
+    """Direct imports of app.app by cumulative time, as [module, ms]."""
+    stderr = python(script("import app.app", fake_models, redis_url), "-X", "importtime").stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # nested imports are indented by two spaces a level, keep what app.app imports itself
+        if len(name) - len(name.lstrip()) != 3:
+            continue
+        rows.append((name.strip(), round(int(cumulative) / 1000, 1)))
+    return sorted(rows, key=lambda row: -row[1])[:top]
+
+def wait_for(url: str, process: subprocess.Popen, start: float, timeout: float) -> float:
+    """Seconds from start to the first 200 of url, None if the server died or timed out."""
+    while time.perf_counter() - start < timeout and process.poll() is None:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter() - start
+        except (urllib.error.URLError, ConnectionError, TimeoutError):
+            pass
+        time.sleep(0.01)
+    return None
+
+def serve_seconds(fake_models: bool, redis_url: str, port: int, timeout: float, redis_timeout: float) -> dict:
+    # the server logs to a file, a pipe nobody reads would fill up and block it
+    with tempfile.TemporaryFile("w+") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "-c", script(SERVE.format(port=port), fake_models, redis_url)],
+                                   cwd=ROOT, stdout=subprocess.DEVNULL, stderr=log, text=True)
+        try:
+            first = wait_for(f"http://127.0.0.1:{port}/api", process, start, timeout)
+            if first is None:
+                log.seek(0)
+                raise RuntimeError(f"Server did not start within {timeout}s: {log.read()[-2000:]}")
+            redis = wait_for(f"http://127.0.0.1:{port}/api/db-health", process, start, first + redis_timeout)
+            return {"first_response": first, "redis_ready": redis}
+        finally:
+            process.terminate()
+            process.wait()
+
+def median(values: list):
+    values = [value for value in values if value is not None]
+    return round(statistics.median(values), 3) if values else None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--fake-models", action="store_true", help="use the offline model stand-ins")
+    parser.add_argument("--redis-url", default=os.getenv("REDIS_URL", "redis://localhost:6379"),
+                        help="Redis of the fake config")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for the server")
+    parser.add_argument("--redis-timeout", type=float, default=10.0, help="seconds to wait for db-health once serving")
+    parser.add_argument("--top", type=int, default=15, help="slowest imports to report")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    runs = {"api_import": [], "worker_import": [], "first_response": [], "redis_ready": []}
+    for _ in range(args.runs):
+        runs["api_import"].append(import_seconds("app.app", args.fake_models, args.redis_url))
+        runs["worker_import"].append(import_seconds("app.services.worker", args.fake_models, args.redis_url))
+        for key, value in serve_seconds(args.fake_models, args.redis_url, args.port, args.timeout, args.redis_timeout).items():
+            runs[key].append(value)
+
+    results = {
+        "runs": args.runs,
+        "fake_models": args.fake_models,
+        **{f"{key}_seconds": median(values) for key, values in runs.items()},
+        "slowest_imports_ms": slowest_imports(args.fake_models, args.redis_url, args.top),
+    }
+    for key, value in results.items():
+        if key != "slowest_imports_ms":
+            print(f"{key:>24}  {value}")
+    print("\nslowest imports of app.app (cumulative ms)")
+    for name, ms in results["slowest_imports_ms"]:
+        print(f"{ms:>10}  {name}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,10 @@
-from .config import Config
+from . import settings
 
-__all__ = ['Config']
+__all__ = ['Config', 'settings']
+
+def __getattr__(name):
+    # config imports the model SDKs, only load it when Config is asked for
+    if name == 'Config':
+        from .config import Config
+        return Config
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
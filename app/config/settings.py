@@ -0,0 +1,126 @@
+import json
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Tunables, overridable through environment variables (or app/.env)
+
+# Index registry
+INDEX_CACHE_SIZE = int(os.getenv("INDEX_CACHE_SIZE", 32))  # retriever/chain pairs kept per process
+RETRIEVER_K = int(os.getenv("RETRIEVER_K", 3))
+
+# Uploads
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", 100 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", 24 * 60 * 60))  # resumable uploads, seconds
+
+# Embedding cache
+EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", 30 * 24 * 60 * 60))  # seconds, refreshed on every hit
+EMBEDDING_CACHE_LOCAL_SIZE = int(os.getenv("EMBEDDING_CACHE_LOCAL_SIZE", 4096))  # vectors kept per process
+
+# PDF parsing, set per Celery worker
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", os.cpu_count() or 1))
+PARSE_SHARD_PAGES = int(os.getenv("PARSE_SHARD_PAGES", 16))
+
+# Ingestion
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 100))  # chunks per embedding request and pipeline flush
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", 4))  # embedding requests in flight
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", 5))
+EMBED_RETRY_BASE_DELAY = float(os.getenv("EMBED_RETRY_BASE_DELAY", 1.0))  # seconds, doubled on every retry
+EMBED_RETRY_MAX_DELAY = float(os.getenv("EMBED_RETRY_MAX_DELAY", 30.0))
+
+# Chunking
+CHUNKING_STRATEGY = os.getenv("CHUNKING_STRATEGY", "semantic")  # semantic, markdown, recursive or hybrid
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", 400))  # token budget of a chunk, for markdown, recursive and hybrid
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", 40))
+CHUNK_MIN_TOKENS = int(os.getenv("CHUNK_MIN_TOKENS", 50))  # smaller sections (a lone heading) are merged into the next
+
+# Vector index, applies to newly ingested documents
+VECTOR_ALGORITHM = os.getenv("VECTOR_ALGORITHM", "FLAT")  # FLAT (exact) or HNSW (approximate, faster on big corpora)
+VECTOR_DATATYPE = os.getenv("VECTOR_DATATYPE", "FLOAT32")  # FLOAT16 halves memory, INT8 quarters it (COSINE only), need RediSearch >= 2.10 / Redis 8
+VECTOR_DISTANCE_METRIC = os.getenv("VECTOR_DISTANCE_METRIC", "COSINE")
+HNSW_M = int(os.getenv("HNSW_M", 16))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", 200))
+HNSW_EF_RUNTIME = int(os.getenv("HNSW_EF_RUNTIME", 10))
+PCA_COMPONENTS = int(os.getenv("PCA_COMPONENTS", 0))  # > 0 projects vectors with a PCA fitted on the first shard of an index, not with IP
+PCA_MIN_SAMPLES = int(os.getenv("PCA_MIN_SAMPLES", 256))  # fewer chunks in the first shard keeps full dimensions
+COMPACT_TEXT = os.getenv("COMPACT_TEXT", "false").lower() == "true"  # compressed text outside the index, disables full-text search
+TEXT_COMPRESSION_LEVEL = int(os.getenv("TEXT_COMPRESSION_LEVEL", 3))  # zstd level (zlib if zstandard is missing)
+
+# Deletion
+DELETE_BATCH_SIZE = int(os.getenv("DELETE_BATCH_SIZE", 1000))  # keys per SCAN page and UNLINK call
+
+# Redis connection pools, one sync and one async pool per process
+REDIS_URL = os.getenv("REDIS_URL")  # read without building Config (and its model clients), Config.REDIS_URL if unset
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))  # seconds to wait for a free connection
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 10))
+REDIS_SOCKET_CONNECT_TIMEOUT = float(os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", 5))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30))  # seconds idle before a PING on checkout
+
+# Chat history sent to the LLM
+HISTORY_WINDOW_TURNS = int(os.getenv("HISTORY_WINDOW_TURNS", 6))  # question/answer pairs read per request
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", 2000))  # approximate tokens of history + summary per prompt
+SUMMARY_MAX_WORDS = int(os.getenv("SUMMARY_MAX_WORDS", 200))
+
+# Follow-up question rewrite
+REWRITE_MODE = os.getenv("REWRITE_MODE", "auto")  # always, auto (skip standalone questions) or parallel (auto + raw retrieval during the rewrite)
+REWRITE_CACHE_TTL = int(os.getenv("REWRITE_CACHE_TTL", 60 * 60))  # seconds
+REWRITE_SKIP_SCORE = float(os.getenv("REWRITE_SKIP_SCORE", 0.8))  # parallel mode: raw relevance at which the rewrite is dropped
+
+# Semantic answer cache
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", 24 * 60 * 60))  # seconds
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))  # cosine similarity between normalized questions
+ANSWER_REPLAY_CHUNK = int(os.getenv("ANSWER_REPLAY_CHUNK", 20))  # characters per chunk when replaying a cached answer
+
+# Server-sent events
+SSE_FLUSH_CHARS = int(os.getenv("SSE_FLUSH_CHARS", 64))  # buffered characters that trigger a write
+SSE_FLUSH_INTERVAL = float(os.getenv("SSE_FLUSH_INTERVAL", 0.05))  # seconds a token may wait in the buffer
+SSE_HEARTBEAT_INTERVAL = float(os.getenv("SSE_HEARTBEAT_INTERVAL", 15))  # seconds of silence before a keep-alive comment
+
+# Retrieval, k/fetch_k/mmr/rerank can also be set per request
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "true").lower() == "true"  # full-text + KNN fused with RRF, else KNN only
+RETRIEVER_FETCH_K = int(os.getenv("RETRIEVER_FETCH_K", 20))  # candidates per query before fusion/rerank/MMR
+RRF_K = int(os.getenv("RRF_K", 60))
+RETRIEVER_RERANK = os.getenv("RETRIEVER_RERANK", "none")  # none, lexical or cross-encoder (needs sentence-transformers)
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+RETRIEVER_MMR_LAMBDA = float(os.getenv("RETRIEVER_MMR_LAMBDA", 0.5))  # 1 = relevance only, 0 = diversity only
+SCOPE_FROM_QUESTION = os.getenv("SCOPE_FROM_QUESTION", "true").lower() == "true"  # "pages 10-20", "section 4" in a question pre-filter the search
+
+# Ingestion jobs (Celery)
+INGEST_QUEUE_SMALL = os.getenv("INGEST_QUEUE_SMALL", "ingest_small")
+INGEST_QUEUE_LARGE = os.getenv("INGEST_QUEUE_LARGE", "ingest_large")
+LARGE_DOCUMENT_PAGES = int(os.getenv("LARGE_DOCUMENT_PAGES", 100))  # documents with this many pages go to the large queue
+INGEST_JOB_TTL = int(os.getenv("INGEST_JOB_TTL", 24 * 60 * 60))  # seconds a job is reused for the same content
+INGEST_STAGE_TTL = int(os.getenv("INGEST_STAGE_TTL", 24 * 60 * 60))  # seconds the output of a stage is kept for the next
+INGEST_MAX_RETRIES = int(os.getenv("INGEST_MAX_RETRIES", 5))  # stage retries on rate limits, after the per-request ones
+INGEST_RETRY_BASE_DELAY = float(os.getenv("INGEST_RETRY_BASE_DELAY", 10.0))  # seconds, doubled on every retry
+INGEST_RETRY_MAX_DELAY = float(os.getenv("INGEST_RETRY_MAX_DELAY", 300.0))
+
+# Document versions
+VERSION_DROP_DELAY = int(os.getenv("VERSION_DROP_DELAY", 10 * 60))  # seconds the replaced index is kept for in-flight chats
+
+# Observability
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"  # Prometheus text format on /metrics
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 0))  # port of each Celery worker's metrics server, 0 = off
+OTEL_ENABLED = os.getenv("OTEL_ENABLED", "false").lower() == "true"  # OpenTelemetry spans, needs opentelemetry-api
+TRACE_HEADER = os.getenv("TRACE_HEADER", "X-Request-ID")  # trace id read from and returned in this header
+
+# Startup
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "background")  # model clients and Redis pools built in the background, or "blocking" before serving
+
+# LLM admission control, shared by every API process through Redis, 0 = unlimited
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 0))  # LLM streams open at once, all processes together
+LLM_RATE_PER_MINUTE = float(os.getenv("LLM_RATE_PER_MINUTE", 0))  # chats started per minute (token bucket)
+LLM_BURST = int(os.getenv("LLM_BURST", 0))  # chats that may start at once after a quiet period, 0 = a second's worth of the rate
+LLM_TENANT_MAX_CONCURRENCY = int(os.getenv("LLM_TENANT_MAX_CONCURRENCY", 0))  # the same, for each file_id and each API key
+LLM_TENANT_RATE_PER_MINUTE = float(os.getenv("LLM_TENANT_RATE_PER_MINUTE", 0))
+LLM_TENANT_BURST = int(os.getenv("LLM_TENANT_BURST", 0))
+# per-tenant overrides, e.g. {"key:<api key>": {"concurrency": 8, "rate_per_minute": 120}, "file:<file_id>": {"burst": 2}}
+LLM_TENANT_LIMITS = json.loads(os.getenv("LLM_TENANT_LIMITS", "{}"))
+API_KEY_HEADER = os.getenv("API_KEY_HEADER", "X-API-Key")  # identifies the tenant of a chat, with its file_id
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", 10))  # seconds a chat waits for a slot before a 429
+LLM_LEASE_TTL = float(os.getenv("LLM_LEASE_TTL", 60))  # seconds a slot outlives a process that died holding it, renewed while streaming
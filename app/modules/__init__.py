@@ -1,15 +1,15 @@
-from .preprocessing import DocumentProcessor
 from .rag_chat import RagChat
 from .utils import Utils
+from .registry import IndexRegistry
 from .prompts import (
     prompt,
     contextualize_q_prompt
 )
 
 __all__ = [
-    'DocumentProcessor',
     'RagChat',
     'Utils',
+    'IndexRegistry',
     'prompt',
     'contextualize_q_prompt'
 ]
\ No newline at end of file
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import logging
+import re
+from typing import AsyncIterator, Optional
+
+import numpy as np
+import redis
+from langchain_community.vectorstores.redis.filters import RedisTag
+from redis.commands.search.field import TagField, TextField, VectorField
+from redis.commands.search.query import Query
+
+try:
+    from redis.commands.search.index_definition import IndexDefinition, IndexType
+except ImportError:  # redis-py < 6
+    from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+
+from app.config import settings
+from app.modules import metrics
+from app.modules.connections import get_async_redis, get_embeddings, get_redis
+from app.modules.embeddings import CachedEmbeddings
+
+logger = logging.getLogger(__name__)
+
+ANSWER_INDEX = "answer_cache"
+ANSWER_PREFIX = "answer:"
+# parts of the response meta kept with a cached answer, its citation numbers refer to them
+REFERENCE_KEYS = ("sources", "citations")
+
+def normalize_question(question: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation."""
+    return re.sub(r"\s+", " ", question.lower()).strip().rstrip("?!. ")
+
+def replay(answer: str, chunk_size: int = settings.ANSWER_REPLAY_CHUNK) -> list:
+    """Split a cached answer into stream chunks, on word boundaries."""
+    chunks, current = [], ""
+    for word in re.findall(r"\S+\s*", answer):
+        current += word
+        if len(current) >= chunk_size:
+            chunks.append(current)
+            current = ""
+    if current:
+        chunks.append(current)
+    return chunks
+
+class AnswerCache:
+    def __init__(self, ttl: int = settings.ANSWER_CACHE_TTL,
+                 threshold: float = settings.ANSWER_CACHE_THRESHOLD):
+        """Semantic cache of final answers.
+        Answers are stored in one RediSearch index, tagged with a scope (the index a
+        document was ingested into, a collection, or "llm" for plain chat) and a
+        variant (the file_ids filter of a collection query). A question hits the cache
+        when a stored question of the same scope and variant has a cosine similarity
+        of at least threshold. Entries expire after ttl and a scope is invalidated
+        whenever its index is dropped or re-ingested.
+        """
+        self.ttl = ttl
+        self.threshold = threshold
+        self.embeddings = CachedEmbeddings(get_embeddings())
+        self._index_ready = False
+
+    @staticmethod
+    def _key(scope: str, variant: str, question: str) -> str:
+        digest = hashlib.sha256(f"{variant}\x00{question}".encode("utf-8")).hexdigest()
+        return f"{ANSWER_PREFIX}{scope}:{digest}"
+
+    @staticmethod
+    def variant(file_ids: Optional[list] = None, search_kwargs: Optional[dict] = None) -> str:
+        """Answers depend on the file_ids filter and the retrieval options of the request."""
+        if not file_ids and not search_kwargs:
+            return "all"
+        key = ",".join(sorted(set(file_ids or []))) + json.dumps(search_kwargs or {}, sort_keys=True)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+    async def _ensure_index(self, dim: int):
+        if self._index_ready:
+            return
+        client = get_async_redis()
+        try:
+            await client.ft(ANSWER_INDEX).create_index(
+                (
+                    TagField("scope"),
+                    TagField("variant"),
+                    TextField("question", no_stem=True),
+                    VectorField("vector", "FLAT", {"TYPE": "FLOAT32", "DIM": dim, "DISTANCE_METRIC": "COSINE"}),
+                ),
+                definition=IndexDefinition(prefix=[ANSWER_PREFIX], index_type=IndexType.HASH),
+            )
+            logger.info(f"Created answer cache index with {dim} dimensions")
+        except redis.exceptions.ResponseError as e:
+            if "already exists" not in str(e).lower():
+                raise
+        self._index_ready = True
+
+    async def lookup(self, scope: str, question: str, variant: str = "all") -> tuple:
+        """
+        Find a cached answer for a question similar enough to this one.
+        The cache is optional: embedding or Redis errors are logged and count as a miss.
+        Returns:
+            tuple: ({"answer", "references"} or None, query vector, reused by store on a miss,
+            None if the question could not be embedded)
+        """
+        vector = None
+        try:
+            vector = np.asarray(await self.embeddings.aembed_query(normalize_question(question)), dtype=np.float32)
+            await self._ensure_index(len(vector))
+
+            filters = f"{RedisTag('scope') == scope} {RedisTag('variant') == variant}"
+            query = (
+                Query(f"({filters})=>[KNN 1 @vector $vector AS distance]")
+                .return_fields("answer", "references", "distance")
+                .dialect(2)
+            )
+            result = await get_async_redis().ft(ANSWER_INDEX).search(query, {"vector": vector.tobytes()})
+        except redis.exceptions.ResponseError as e:
+            # the index is gone (e.g. after /api/flush), recreate it on the next call
+            logger.warning(f"Answer cache lookup failed: {e}")
+            self._index_ready = False
+            metrics.cache_lookup("answer", False)
+            return None, vector
+        except Exception as e:
+            logger.error(f"Error in answer cache lookup, answering without it: {e}")
+            metrics.cache_lookup("answer", False)
+            return None, vector
+
+        if result.docs and 1 - float(result.docs[0].distance) >= self.threshold:
+            logger.info(f"Answer cache hit in {scope}")
+            metrics.cache_lookup("answer", True)
+            hit = result.docs[0]
+            return {"answer": hit.answer, "references": json.loads(getattr(hit, "references", None) or "{}")}, vector
+        metrics.cache_lookup("answer", False)
+        return None, vector
+
+    async def store(self, scope: str, question: str, answer: str, vector: np.ndarray, variant: str = "all",
+                    references: Optional[dict] = None):
+        """Cache an answer. Errors are logged, the answer was already sent."""
+        key = self._key(scope, variant, normalize_question(question))
+        try:
+            pipeline = get_async_redis().pipeline(transaction=False)
+            pipeline.hset(key, mapping={
+                "scope": scope,
+                "variant": variant,
+                "question": question,
+                "answer": answer,
+                "references": json.dumps(references or {}),
+                "vector": vector.tobytes(),
+            })
+            pipeline.expire(key, self.ttl)
+            await pipeline.execute()
+        except redis.exceptions.RedisError as e:
+            logger.error(f"Error in storing answer in cache: {e}")
+
+    async def stream(self, scope: str, question: str, generate: AsyncIterator[str],
+                     variant: str = "all", meta: Optional[dict] = None,
+                     found: Optional[tuple] = None) -> AsyncIterator[str]:
+        """
+        Replay a cached answer, or stream the generated one and cache it once complete.
+        On a hit meta["cached"] is set and the sources and citations of the answer restored.
+        Args:
+            found: the result of lookup() when the caller already made it
+        """
+        hit, vector = found if found is not None else await self.lookup(scope, question, variant)
+        if hit is not None:
+            if meta is not None:
+                meta.update(hit["references"])
+                meta["cached"] = True
+            for chunk in replay(hit["answer"]):
+                yield chunk
+            return
+
+        chunks = []
+        try:
+            async for chunk in generate:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            await generate.aclose()
+        if chunks and vector is not None:
+            references = {key: meta[key] for key in REFERENCE_KEYS if key in meta} if meta else None
+            await self.store(scope, question, "".join(chunks), vector, variant, references)
+
+    @staticmethod
+    def invalidate(scope: str, batch_size: int = settings.DELETE_BATCH_SIZE) -> int:
+        """
+        Drop every cached answer of a scope, with SCAN and batched UNLINK.
+        Returns:
+            int: number of answers deleted
+        """
+        client = get_redis()
+        deleted = 0
+        batch = []
+        for key in client.scan_iter(match=f"{ANSWER_PREFIX}{scope}:*", count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                deleted += client.unlink(*batch)
+                batch = []
+        if batch:
+            deleted += client.unlink(*batch)
+        if deleted:
+            logger.info(f"Invalidated {deleted} cached answers of {scope}")
+        return deleted
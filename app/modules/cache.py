@@ -2,10 +2,13 @@ import os
 import json
 from typing import Dict
 
+from app.modules.registry import IndexRegistry
+
 class Cache:
     def __init__(self):
         """A class to manage caching of files and associated retrievers and RAG chains.
-        The cache is implemented using on-disk storage and maintains a file map in JSON format.
+        The cache is implemented using on-disk storage and maintains a file map in JSON format,
+        retrievers and RAG chains come from the shared index registry.
         """
         # Create ./data/files and ./data/vectorstore directories if they don't exist
         if not os.path.exists("data"):
@@ -16,8 +19,7 @@ class Cache:
         self.data_path = "data/files"
         self.file_map_path = "data/file_map.json"
 
-        self.retrievers = {}
-        self.rag_chains = {}
+        self.registry = IndexRegistry()
 
         self.file_map: Dict[str, str] = self.load_file_map()
 
@@ -33,12 +35,6 @@ class Cache:
         with open(self.file_map_path, "w") as f:
             json.dump(self.file_map, f)
 
-    def get_retrievers(self) -> Dict[str, str]:
-        return self.retrievers
-    
-    def get_rag_chains(self) -> Dict[str, str]:
-        return self.rag_chains
-    
     def get_file_map(self) -> Dict[str, str]:
         return self.file_map
     
@@ -49,11 +45,11 @@ class Cache:
         return self.file_map.get(file_id)
     
     def get_cached_file(self, file_id: str) -> tuple:
-        return self.retrievers.get(file_id), self.rag_chains.get(file_id)
+        return self.registry.get(file_id)
     
     def save_file(self, file_id: str, file_path: str):
         self.file_map[file_id] = file_path
-        self.save_file_map(self.file_map)
+        self.save_file_map()
     
     def delete_file(self, file_id: str):
         file_path = self.file_map.get(file_id)
@@ -62,9 +58,6 @@ class Cache:
                 os.remove(file_path)
                 del self.file_map[file_id]
                 self.save_file_map()
-
-                self.retrievers.pop(file_id)
-                self.rag_chains.pop(file_id)
                 return True
             except Exception as e:
                 print(f"Error in deleting file: {e}")
@@ -73,14 +66,13 @@ class Cache:
     
     def clear_cache(self):
         try: 
-            self.retrievers.clear()
-            self.rag_chains.clear()
+            self.registry.clear()
             
             file_names = os.listdir(self.data_path)
             for file in file_names:
                 os.remove(os.path.join(self.data_path, file))
                 self.file_map.clear()
-                self.save_file_map(self.file_map)
+                self.save_file_map()
             return True
         except Exception as e:
             print(f"Error in clearing cache: {e}")
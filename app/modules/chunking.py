@@ -0,0 +1,116 @@
+import re
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+from langchain_experimental.text_splitter import SemanticChunker
+from langchain_text_splitters import Language, RecursiveCharacterTextSplitter, TextSplitter
+
+from app.config import settings
+
+STRATEGIES = ("semantic", "markdown", "recursive", "hybrid")
+# markdown headings, as written by pymupdf4llm
+HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$", re.MULTILINE)
+CHARS_PER_TOKEN = 4
+
+def count_tokens(text: str) -> int:
+    """Approximate token count, about four characters per token like count_tokens_approximately."""
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+def split_sections(text: str, min_tokens: int = settings.CHUNK_MIN_TOKENS) -> List[str]:
+    """
+    Split markdown at its headings, each section starting with its heading.
+    Sections under min_tokens (a lone heading, a caption) are merged into the next one.
+    """
+    starts = [match.start() for match in HEADING_PATTERN.finditer(text)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    sections = [text[start:end] for start, end in zip(starts, starts[1:] + [len(text)])]
+
+    merged, pending = [], ""
+    for section in sections:
+        pending += section
+        if count_tokens(pending.strip()) >= min_tokens:
+            merged.append(pending)
+            pending = ""
+    if pending.strip():
+        if merged:
+            merged[-1] += pending
+        else:
+            merged.append(pending)
+    return [section.strip() for section in merged if section.strip()]
+
+def recursive_splitter(chunk_tokens: int = settings.CHUNK_TOKENS,
+                       overlap_tokens: int = settings.CHUNK_OVERLAP_TOKENS) -> RecursiveCharacterTextSplitter:
+    """Token-budgeted splitter, trying markdown headings, then paragraphs, lines, sentences and words."""
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_tokens,
+        chunk_overlap=overlap_tokens,
+        length_function=count_tokens,
+        separators=RecursiveCharacterTextSplitter.get_separators_for_language(Language.MARKDOWN),
+    )
+
+class MarkdownSectionSplitter(TextSplitter):
+    def __init__(self, chunk_tokens: int = settings.CHUNK_TOKENS,
+                 overlap_tokens: int = settings.CHUNK_OVERLAP_TOKENS,
+                 min_tokens: int = settings.CHUNK_MIN_TOKENS, **kwargs):
+        """Structure-aware splitter: one chunk per markdown section, no embedding calls.
+        Sections over the token budget are split recursively.
+        """
+        super().__init__(chunk_size=chunk_tokens, chunk_overlap=overlap_tokens, length_function=count_tokens, **kwargs)
+        self.min_tokens = min_tokens
+        self.fallback = recursive_splitter(chunk_tokens, overlap_tokens)
+
+    def split_text(self, text: str) -> List[str]:
+        chunks = []
+        for section in split_sections(text, self.min_tokens):
+            if count_tokens(section) <= self._chunk_size:
+                chunks.append(section)
+            else:
+                chunks.extend(self.split_large(section))
+        return chunks
+
+    def split_large(self, section: str) -> List[str]:
+        return self.fallback.split_text(section)
+
+class HybridSplitter(MarkdownSectionSplitter):
+    def __init__(self, embeddings: Embeddings, **kwargs):
+        """Markdown sections, with semantic splitting only inside the oversized ones,
+        so only their sentences are embedded. Semantic chunks still over the budget
+        are split recursively.
+        """
+        super().__init__(**kwargs)
+        self.semantic = SemanticChunker(embeddings)
+
+    def split_large(self, section: str) -> List[str]:
+        chunks = []
+        for chunk in self.semantic.split_text(section):
+            if count_tokens(chunk) <= self._chunk_size:
+                chunks.append(chunk)
+            else:
+                chunks.extend(self.fallback.split_text(chunk))
+        return chunks
+
+def get_chunker(embeddings: Embeddings, strategy: str = settings.CHUNKING_STRATEGY,
+                chunk_tokens: int = settings.CHUNK_TOKENS,
+                overlap_tokens: int = settings.CHUNK_OVERLAP_TOKENS,
+                min_tokens: int = settings.CHUNK_MIN_TOKENS):
+    """
+    The splitter of a chunking strategy, anything with split_documents().
+    semantic embeds every sentence to find split points; markdown and recursive
+    make no embedding calls; hybrid embeds the sentences of oversized sections only.
+    """
+    if strategy == "semantic":
+        return SemanticChunker(embeddings)
+    if strategy == "recursive":
+        return recursive_splitter(chunk_tokens, overlap_tokens)
+    if strategy == "markdown":
+        return MarkdownSectionSplitter(chunk_tokens, overlap_tokens, min_tokens)
+    if strategy == "hybrid":
+        return HybridSplitter(embeddings, chunk_tokens=chunk_tokens, overlap_tokens=overlap_tokens, min_tokens=min_tokens)
+    raise ValueError(f"Unknown chunking strategy {strategy}, expected one of {STRATEGIES}")
+
+def chunking_key(strategy: str = settings.CHUNKING_STRATEGY) -> str:
+    """What chunks depend on besides the text, part of the page hashes of incremental ingestion."""
+    if strategy == "semantic":
+        return strategy
+    return f"{strategy}:{settings.CHUNK_TOKENS}:{settings.CHUNK_OVERLAP_TOKENS}:{settings.CHUNK_MIN_TOKENS}"
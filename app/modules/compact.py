@@ -0,0 +1,145 @@
+import logging
+import zlib
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from app.config import settings
+
+try:
+    import zstandard
+except ImportError:  # optional, zlib is used instead
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# chunk text kept outside of the indexed hash, next to it: {chunk_key}:text
+TEXT_SUFFIX = ":text"
+# first byte of a stored text, so both codecs can be read whatever is installed
+ZSTD_MARKER = b"Z"
+ZLIB_MARKER = b"z"
+INT8_SCALE = 127
+
+def compress_text(text: str, level: int = settings.TEXT_COMPRESSION_LEVEL) -> bytes:
+    data = text.encode("utf-8")
+    if zstandard is not None:
+        return ZSTD_MARKER + zstandard.ZstdCompressor(level=level).compress(data)
+    return ZLIB_MARKER + zlib.compress(data, min(level, 9))
+
+def decompress_text(blob: bytes) -> str:
+    marker, payload = blob[:1], blob[1:]
+    if marker == ZSTD_MARKER:
+        if zstandard is None:
+            raise RuntimeError("Text was stored with zstd, install zstandard to read it")
+        return zstandard.ZstdDecompressor().decompress(payload).decode("utf-8")
+    return zlib.decompress(payload).decode("utf-8")
+
+def check_vector_settings(datatype: str, distance_metric: str, pca_components: int = 0):
+    """
+    Reject codecs that change the ranking under the index's distance metric: per-vector
+    INT8 scaling only keeps directions (COSINE), and PCA centring shifts inner products (IP).
+    L2 distances are unchanged by centring, and approximated by the projection.
+    """
+    datatype, distance_metric = datatype.upper(), distance_metric.upper()
+    if datatype == "INT8" and distance_metric != "COSINE":
+        raise ValueError(f"INT8 vectors are scaled per vector and need the COSINE metric, not {distance_metric}")
+    if pca_components > 0 and distance_metric == "IP":
+        raise ValueError("PCA centres the vectors, which changes inner products: use COSINE or L2 with PCA_COMPONENTS")
+
+class VectorCodec:
+    def __init__(self, datatype: str = "FLOAT32", mean: Optional[np.ndarray] = None,
+                 components: Optional[np.ndarray] = None, compact_text: bool = False):
+        """How the vectors and text of an index are stored.
+        Vectors are optionally projected with a PCA fitted on the first chunks ingested
+        into the index (so a collection shares one projection), then, for INT8, scaled
+        per vector to [-127, 127]. Cosine distance is scale invariant, so per-vector
+        scaling needs no calibration; other metrics are refused (check_vector_settings). With compact_text the chunk text is compressed
+        into a separate key and the indexed hash only holds the vector and metadata.
+        """
+        self.datatype = datatype.upper()
+        self.mean = mean
+        self.components = components
+        self.compact_text = compact_text
+
+    @property
+    def reduced(self) -> bool:
+        return self.components is not None
+
+    @property
+    def is_identity(self) -> bool:
+        return not self.reduced and self.datatype != "INT8"
+
+    def fit(self, vectors: np.ndarray, n_components: int) -> bool:
+        """
+        Fit the PCA projection.
+        Returns:
+            bool: False when there are too few vectors to fit n_components
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if n_components <= 0 or len(vectors) < max(settings.PCA_MIN_SAMPLES, n_components):
+            return False
+        self.mean = vectors.mean(axis=0)
+        # rows of vt are the principal axes, by decreasing variance
+        _, _, vt = np.linalg.svd(vectors - self.mean, full_matrices=False)
+        self.components = vt[:n_components].astype(np.float32)
+        return True
+
+    def encode(self, vectors) -> np.ndarray:
+        """Vectors as stored, float values that cast exactly to the index datatype."""
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if self.reduced:
+            vectors = (vectors - self.mean) @ self.components.T
+        if self.datatype == "INT8":
+            scale = np.abs(vectors).max(axis=1, keepdims=True)
+            scale[scale == 0] = 1.0
+            vectors = np.rint(vectors / scale * INT8_SCALE)
+        return vectors
+
+    @staticmethod
+    def _key(index_name: str) -> str:
+        return f"vector_codec:{index_name}"
+
+    def save(self, client, index_name: str):
+        mapping = {"datatype": self.datatype, "compact_text": int(self.compact_text)}
+        if self.reduced:
+            mapping["mean"] = self.mean.astype(np.float32).tobytes()
+            mapping["components"] = self.components.astype(np.float32).tobytes()
+            mapping["n_components"] = len(self.components)
+        client.hset(self._key(index_name), mapping=mapping)
+
+    @classmethod
+    def load(cls, client, index_name: str) -> Optional["VectorCodec"]:
+        raw = client.hgetall(cls._key(index_name))
+        if not raw:
+            return None
+        codec = cls(raw[b"datatype"].decode(), compact_text=raw.get(b"compact_text") == b"1")
+        if b"components" in raw:
+            codec.mean = np.frombuffer(raw[b"mean"], dtype=np.float32)
+            codec.components = np.frombuffer(raw[b"components"], dtype=np.float32).reshape(
+                int(raw[b"n_components"]), -1
+            )
+        return codec
+
+    @classmethod
+    def delete(cls, client, index_name: str):
+        client.delete(cls._key(index_name))
+
+class CodecEmbeddings(Embeddings):
+    def __init__(self, embeddings: Embeddings, codec: VectorCodec):
+        """Embeddings passed through a VectorCodec, for documents and queries alike."""
+        self.embeddings = embeddings
+        self.codec = codec
+        self.model = getattr(embeddings, "model", None) or type(embeddings).__name__
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.codec.encode(self.embeddings.embed_documents(texts)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.codec.encode(self.embeddings.embed_query(text))[0].tolist()
+
+def with_codec(embeddings: Embeddings, codec: Optional[VectorCodec]) -> Embeddings:
+    """The embeddings to query an index with."""
+    if codec is None or codec.is_identity:
+        return embeddings
+    return CodecEmbeddings(embeddings, codec)
@@ -0,0 +1,117 @@
+import logging
+import threading
+from typing import Optional
+
+import redis
+import redis.asyncio
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+_config = None
+_redis: Optional[redis.Redis] = None
+_async_redis: Optional[redis.asyncio.Redis] = None
+_lock = threading.Lock()
+_config_lock = threading.Lock()
+
+def get_config():
+    """
+    The process-wide Config, built on first use: importing it pulls in the model
+    SDKs and building it creates the LLM and embedding clients, which has no
+    place at import time. Worker processes build it after the fork.
+    """
+    global _config
+    if _config is None:
+        with _config_lock:
+            if _config is None:
+                from app.config.config import Config
+                _config = Config()
+    return _config
+
+def redis_url() -> str:
+    """
+    The Redis URL, from the environment when it is set there (app/.env) so that
+    Celery and the pools can be configured without building Config.
+    """
+    return settings.REDIS_URL or get_config().REDIS_URL
+
+def get_llm():
+    return get_config().LLM_MODEL
+
+def get_embeddings():
+    return get_config().EMBED_MODEL
+
+def warm_up():
+    """
+    Build the clients of this process ahead of its first request: Config with the
+    model clients, and the sync Redis pool. Redis being down is logged, not raised:
+    the process starts anyway and connects on use.
+    """
+    get_config()
+    try:
+        get_redis().ping()
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Redis is not reachable yet: {e}")
+
+# deletes a key only if it still holds the caller's value, e.g. a lock or job claim
+# that may have expired and been taken by another process in the meantime
+COMPARE_AND_DELETE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+def delete_if_equals(key: str, value) -> bool:
+    return bool(get_redis().eval(COMPARE_AND_DELETE, 1, key, value))
+
+async def adelete_if_equals(key: str, value) -> bool:
+    return bool(await get_async_redis().eval(COMPARE_AND_DELETE, 1, key, value))
+
+def _pool_options() -> dict:
+    return {
+        "max_connections": settings.REDIS_MAX_CONNECTIONS,
+        "timeout": settings.REDIS_POOL_TIMEOUT,
+        "socket_timeout": settings.REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+        "health_check_interval": settings.REDIS_HEALTH_CHECK_INTERVAL,
+    }
+
+def get_redis() -> redis.Redis:
+    """
+    The process-wide synchronous client, for Celery tasks and code running in threads.
+    Callers wait for a free connection (up to REDIS_POOL_TIMEOUT) instead of opening new ones.
+    """
+    global _redis
+    if _redis is None:
+        with _lock:
+            if _redis is None:
+                pool = redis.BlockingConnectionPool.from_url(redis_url(), **_pool_options())
+                _redis = redis.Redis(connection_pool=pool)
+    return _redis
+
+def get_async_redis() -> redis.asyncio.Redis:
+    """
+    The process-wide asyncio client, for code running on the event loop.
+    Opened lazily and closed by the FastAPI lifespan.
+    """
+    global _async_redis
+    if _async_redis is None:
+        pool = redis.asyncio.BlockingConnectionPool.from_url(redis_url(), **_pool_options())
+        _async_redis = redis.asyncio.Redis(connection_pool=pool)
+    return _async_redis
+
+async def close_async_redis():
+    global _async_redis
+    if _async_redis is not None:
+        await _async_redis.aclose()
+        await _async_redis.connection_pool.disconnect()
+        _async_redis = None
+
+def close_redis():
+    global _redis
+    if _redis is not None:
+        _redis.close()
+        _redis.connection_pool.disconnect()
+        _redis = None
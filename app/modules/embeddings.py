@@ -0,0 +1,212 @@
+import hashlib
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from app.config import settings
+from app.modules import metrics
+from app.modules.connections import get_redis
+
+logger = logging.getLogger(__name__)
+
+class LocalVectorCache:
+    def __init__(self, max_size: int):
+        """A bounded in-process LRU of vectors, shared by every CachedEmbeddings of a process."""
+        self.max_size = max_size
+        self._vectors: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            vector = self._vectors.get(key)
+            if vector is not None:
+                self._vectors.move_to_end(key)
+            return vector
+
+    def put(self, key: str, vector: List[float]):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._vectors[key] = vector
+            self._vectors.move_to_end(key)
+            while len(self._vectors) > self.max_size:
+                self._vectors.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._vectors.clear()
+
+local_cache = LocalVectorCache(settings.EMBEDDING_CACHE_LOCAL_SIZE)
+
+# hits and misses per model not yet added to the shared stats in Redis
+_pending_stats = {}
+_stats_lock = threading.Lock()
+
+def is_rate_limited(error: Exception) -> bool:
+    """
+    Whether an embedding error is a provider rate limit / quota error worth retrying.
+    Provider errors are often re-wrapped, so the whole cause chain is checked.
+    """
+    while error is not None:
+        text = f"{type(error).__name__} {error}".lower()
+        if any(marker in text for marker in ("resourceexhausted", "429", "rate limit", "quota", "too many requests")):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+def embed_with_retry(embeddings: Embeddings, texts: List[str]) -> List[List[float]]:
+    """
+    embed_documents with exponential backoff and jitter on rate limits.
+    """
+    metrics.EMBED_BATCH_SIZE.labels("document").observe(len(texts))
+    with metrics.timed(metrics.EMBED_SECONDS.labels("document")):
+        for attempt in range(settings.EMBED_MAX_RETRIES + 1):
+            try:
+                return embeddings.embed_documents(texts)
+            except Exception as e:
+                if attempt == settings.EMBED_MAX_RETRIES or not is_rate_limited(e):
+                    raise
+                delay = min(settings.EMBED_RETRY_MAX_DELAY, settings.EMBED_RETRY_BASE_DELAY * 2 ** attempt)
+                delay *= random.uniform(0.5, 1.0)
+                logger.warning(f"Embedding rate limited, retrying in {delay:.1f}s ({attempt + 1}/{settings.EMBED_MAX_RETRIES})")
+                time.sleep(delay)
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings: Embeddings, ttl: int = settings.EMBEDDING_CACHE_TTL):
+        """Wrap an embedding model so identical texts are only embedded once.
+        Vectors are stored in Redis keyed by the model name and the SHA-256 of the text,
+        with a sliding TTL (refreshed on every hit) so unused vectors are evicted, and the
+        hottest ones are also kept in a process-local LRU.
+        Hit and miss counts are kept per instance and summed per model in Redis, sent
+        along with the next cache round-trip rather than in one of their own.
+        """
+        self.embeddings = embeddings
+        self.model = getattr(embeddings, "model", None) or type(embeddings).__name__
+        self.redis_client = get_redis()
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, text: str, kind: str = "document") -> str:
+        # documents and queries are embedded with different task types by some models
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        if kind == "document":
+            return f"embedding:{self.model}:{digest}"
+        return f"embedding:{self.model}:{kind}:{digest}"
+
+    def _lookup(self, keys: List[str]) -> List[Optional[List[float]]]:
+        """
+        Batch lookup, local LRU first, then one pipelined round-trip to Redis
+        that also refreshes the TTL of every hit.
+        """
+        vectors = [local_cache.get(key) for key in keys]
+        remote = [i for i, vector in enumerate(vectors) if vector is None]
+        if not remote:
+            return vectors
+
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for i in remote:
+            pipeline.getex(keys[i], ex=self.ttl)
+        self._queue_stats(pipeline)
+        for i, raw in zip(remote, pipeline.execute()):
+            if raw is not None:
+                vectors[i] = np.frombuffer(raw, dtype=np.float32).tolist()
+                local_cache.put(keys[i], vectors[i])
+        return vectors
+
+    def _store(self, items: dict):
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for key, vector in items.items():
+            pipeline.set(key, np.asarray(vector, dtype=np.float32).tobytes(), ex=self.ttl)
+            local_cache.put(key, list(vector))
+        self._queue_stats(pipeline)
+        pipeline.execute()
+
+    def _record(self, hits: int, misses: int):
+        self.hits += hits
+        self.misses += misses
+        metrics.cache_lookup("embedding", True, hits)
+        metrics.cache_lookup("embedding", False, misses)
+        with _stats_lock:
+            pending = _pending_stats.setdefault(self.model, [0, 0])
+            pending[0] += hits
+            pending[1] += misses
+
+    def _queue_stats(self, pipeline):
+        """Add the counts recorded since the last round-trip to a pipeline about to run."""
+        with _stats_lock:
+            hits, misses = _pending_stats.pop(self.model, (0, 0))
+        if hits:
+            pipeline.hincrby(f"embedding_stats:{self.model}", "hits", hits)
+        if misses:
+            pipeline.hincrby(f"embedding_stats:{self.model}", "misses", misses)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed the texts, only calling the model for texts without a stored vector.
+        """
+        if not texts:
+            return []
+
+        keys = [self._key(text) for text in texts]
+        vectors = self._lookup(keys)
+
+        # embed each missing text once, even if it repeats within the batch
+        missing = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(keys[i], []).append(i)
+
+        if missing:
+            todo = [texts[indices[0]] for indices in missing.values()]
+            embedded = embed_with_retry(self.embeddings, todo)
+            self._store(dict(zip(missing.keys(), embedded)))
+            for indices, vector in zip(missing.values(), embedded):
+                for i in indices:
+                    vectors[i] = list(vector)
+
+        # a text repeated within the batch is one lookup, not a hit per copy
+        found = set(keys) - missing.keys()
+        self._record(len(found), len(missing))
+        logger.info(f"Embedded {len(missing)} unique texts out of {len(texts)}, the rest came from the cache")
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._key(text, kind="query")
+        vector = self._lookup([key])[0]
+        if vector is None:
+            metrics.EMBED_BATCH_SIZE.labels("query").observe(1)
+            with metrics.timed(metrics.EMBED_SECONDS.labels("query")):
+                vector = self.embeddings.embed_query(text)
+            self._store({key: vector})
+            self._record(0, 1)
+        else:
+            self._record(1, 0)
+        return vector
+
+    def stats(self) -> dict:
+        """
+        Hit rate of this instance and of every process using the same model.
+        """
+        pipeline = self.redis_client.pipeline(transaction=False)
+        self._queue_stats(pipeline)
+        pipeline.hgetall(f"embedding_stats:{self.model}")
+        raw = pipeline.execute()[-1]
+        total_hits = int(raw.get(b"hits", 0))
+        total_misses = int(raw.get(b"misses", 0))
+        return {
+            "model": self.model,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / max(self.hits + self.misses, 1),
+            "total_hits": total_hits,
+            "total_misses": total_misses,
+            "total_hit_rate": total_hits / max(total_hits + total_misses, 1),
+        }
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import logging
+import uuid
+from typing import List
+
+from langchain_core.messages import (
+    BaseMessage,
+    SystemMessage,
+    get_buffer_string,
+    messages_from_dict,
+    trim_messages,
+)
+from langchain_core.messages.utils import count_tokens_approximately
+
+from app.config import settings
+from app.modules.connections import adelete_if_equals, get_async_redis
+from app.modules.prompts import summarize_prompt
+from app.modules.utils import MESSAGE_STORE_PREFIX, Utils
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PREFIX = "message_summary:"
+SUMMARY_LOCK_TIMEOUT = 120
+
+class ChatHistory:
+    def __init__(self, llm, window_turns: int = settings.HISTORY_WINDOW_TURNS,
+                 token_budget: int = settings.HISTORY_TOKEN_BUDGET):
+        """The chat history sent to the LLM, bounded per request.
+        Only the last window_turns question/answer pairs are read from the message
+        store, older turns are folded into a rolling summary kept next to it, and the
+        result is trimmed to token_budget so prompt size stays flat on long sessions.
+        The full history stays in the message store for /api/chat_history.
+        """
+        self.llm = llm
+        self.window = 2 * window_turns
+        self.token_budget = token_budget
+        self.helpers = Utils()
+        # keep references, the event loop only holds weak ones to running tasks
+        self._tasks = set()
+
+    async def load(self, session_id: str) -> List[BaseMessage]:
+        """
+        Get the bounded history of the session, oldest message first.
+        Returns:
+            list: the rolling summary as a system message (if any) then the recent messages
+        """
+        pipeline = get_async_redis().pipeline(transaction=False)
+        pipeline.lrange(MESSAGE_STORE_PREFIX + session_id, 0, self.window - 1)
+        pipeline.hget(SUMMARY_PREFIX + session_id, "summary")
+        items, summary = await pipeline.execute()
+
+        messages = messages_from_dict([json.loads(m) for m in items[::-1]])
+        budget = self.token_budget
+        if summary:
+            summary = SystemMessage(content=f"Summary of the earlier conversation:\n{summary.decode()}")
+            budget -= count_tokens_approximately([summary])
+
+        messages = trim_messages(
+            messages,
+            max_tokens=max(budget, 0),
+            token_counter=count_tokens_approximately,
+            strategy="last",
+            start_on="human",
+        )
+        return [summary] + messages if summary else messages
+
+    async def append(self, session_id: str, human_message: str, ai_message: str):
+        """
+        Log a turn, then fold the turns that left the window into the summary
+        in the background, so the answer is not delayed by it.
+        """
+        await self.helpers.log_chat_history(session_id, human_message, ai_message)
+        task = asyncio.create_task(self.summarize(session_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def summarize(self, session_id: str):
+        """
+        Extend the rolling summary with the messages older than the window that
+        are not summarized yet. One summarizer runs per session at a time.
+        """
+        client = get_async_redis()
+        store = MESSAGE_STORE_PREFIX + session_id
+        summary_key = SUMMARY_PREFIX + session_id
+        lock_key = f"summary_lock:{session_id}"
+        # a summary outlasting the lock timeout must not free the lock of the next one
+        token = uuid.uuid4().hex
+        try:
+            if not await client.set(lock_key, token, nx=True, ex=SUMMARY_LOCK_TIMEOUT):
+                return
+            try:
+                length = await client.llen(store)
+                covered = int(await client.hget(summary_key, "covered") or 0)
+                # newest first: the window is [0, window), summarized messages are at the tail
+                end = length - 1 - covered
+                if end < self.window:
+                    return
+
+                items = await client.lrange(store, self.window, end)
+                new_messages = messages_from_dict([json.loads(m) for m in items[::-1]])
+                summary = await client.hget(summary_key, "summary")
+                result = await self.llm.ainvoke(summarize_prompt.format_messages(
+                    summary=summary.decode() if summary else "(empty)",
+                    new_lines=get_buffer_string(new_messages),
+                    max_words=settings.SUMMARY_MAX_WORDS,
+                ))
+                await client.hset(summary_key, mapping={
+                    "summary": result.content,
+                    "covered": covered + len(items),
+                })
+                logger.info(f"Summarized {len(items)} messages of session {session_id}")
+            finally:
+                await adelete_if_equals(lock_key, token)
+        except Exception as e:
+            # the window alone still bounds the prompt, the summary catches up next turn
+            logger.error(f"Error in summarizing session {session_id}: {e}")
@@ -0,0 +1,218 @@
+import asyncio
+import hashlib
+import logging
+import math
+import random
+import time
+import uuid
+from typing import AsyncIterator, List
+
+import redis
+
+from app.config import settings
+from app.modules import metrics
+from app.modules.connections import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+LIMIT_PREFIX = "llm_limit:"
+
+# Checks every scope of a chat and takes a slot in all of them, or in none.
+# Per scope: a sorted set of leases (id -> expiry), bounding the open streams,
+# and a token bucket (level, last refill), bounding the start rate. The clock is
+# the server's, so processes on different hosts agree on it.
+# KEYS: leases and bucket of each scope; ARGV: lease id, lease ttl, then
+# concurrency, rate per second and burst of each scope.
+# Returns {admitted, milliseconds until a bucket has a token, at concurrency limit}.
+ADMIT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local lease, ttl = ARGV[1], tonumber(ARGV[2])
+local wait, full, levels = 0, 0, {}
+for i = 1, #KEYS / 2 do
+    local leases, bucket = KEYS[2 * i - 1], KEYS[2 * i]
+    local limit, rate, burst = tonumber(ARGV[3 * i]), tonumber(ARGV[3 * i + 1]), tonumber(ARGV[3 * i + 2])
+    if limit > 0 then
+        redis.call('ZREMRANGEBYSCORE', leases, '-inf', now)
+        if redis.call('ZCARD', leases) >= limit then full = 1 end
+    end
+    if rate > 0 then
+        local state = redis.call('HMGET', bucket, 'level', 'ts')
+        local level = burst
+        if state[1] then
+            level = math.min(burst, tonumber(state[1]) + (now - tonumber(state[2])) * rate)
+        end
+        levels[i] = level
+        if level < 1 then wait = math.max(wait, (1 - level) / rate) end
+    end
+end
+if full == 1 or wait > 0 then
+    return {0, math.ceil(wait * 1000), full}
+end
+for i = 1, #KEYS / 2 do
+    local leases, bucket = KEYS[2 * i - 1], KEYS[2 * i]
+    local limit, rate, burst = tonumber(ARGV[3 * i]), tonumber(ARGV[3 * i + 1]), tonumber(ARGV[3 * i + 2])
+    if limit > 0 then
+        redis.call('ZADD', leases, now + ttl, lease)
+        redis.call('EXPIRE', leases, math.ceil(ttl))
+    end
+    if rate > 0 then
+        redis.call('HSET', bucket, 'level', levels[i] - 1, 'ts', now)
+        redis.call('EXPIRE', bucket, math.ceil(burst / rate) + 1)
+    end
+end
+return {1, 0, 0}
+"""
+
+# KEYS: lease sets holding the lease; ARGV: lease id, lease ttl
+RENEW = """
+local t = redis.call('TIME')
+local expiry = tonumber(t[1]) + tonumber(t[2]) / 1000000 + tonumber(ARGV[2])
+for _, leases in ipairs(KEYS) do
+    redis.call('ZADD', leases, 'XX', expiry, ARGV[1])
+    redis.call('EXPIRE', leases, math.ceil(tonumber(ARGV[2])))
+end
+return 1
+"""
+
+class RateLimited(Exception):
+    """A chat that got no LLM slot within LLM_QUEUE_TIMEOUT, answered with a 429."""
+
+    def __init__(self, scope: str, retry_after: float):
+        super().__init__(f"LLM limits reached ({scope}), retry after {retry_after:.1f}s")
+        self.scope = scope
+        self.retry_after = max(1, math.ceil(retry_after))
+
+class Scope:
+    """The limits of one scope: all chats, or those of one tenant."""
+
+    def __init__(self, name: str, concurrency: int = 0, rate_per_minute: float = 0, burst: int = 0):
+        self.name = name
+        self.concurrency = concurrency
+        self.rate = rate_per_minute / 60
+        # a bucket smaller than one token would never admit anything
+        self.burst = max(1, burst or math.ceil(self.rate))
+
+    @property
+    def limited(self) -> bool:
+        return self.concurrency > 0 or self.rate > 0
+
+    def keys(self) -> list:
+        return [f"{LIMIT_PREFIX}{self.name}:leases", f"{LIMIT_PREFIX}{self.name}:bucket"]
+
+    def args(self) -> list:
+        return [self.concurrency, self.rate, self.burst]
+
+def tenant_scope(tenant: str) -> Scope:
+    """The limits of a tenant ("file:<file_id>", "key:<api key>"...), LLM_TENANT_LIMITS overriding the defaults."""
+    limits = settings.LLM_TENANT_LIMITS.get(tenant, {})
+    name = tenant
+    if tenant.startswith("key:"):
+        # API keys stay out of Redis and of the logs
+        name = "key:" + hashlib.sha256(tenant[4:].encode()).hexdigest()[:16]
+    return Scope(
+        name,
+        concurrency=int(limits.get("concurrency", settings.LLM_TENANT_MAX_CONCURRENCY)),
+        rate_per_minute=float(limits.get("rate_per_minute", settings.LLM_TENANT_RATE_PER_MINUTE)),
+        burst=int(limits.get("burst", settings.LLM_TENANT_BURST)),
+    )
+
+def scopes(tenants: List[str]) -> List[Scope]:
+    """The global scope and those of the tenants, unlimited ones left out."""
+    every = [Scope("global", settings.LLM_MAX_CONCURRENCY, settings.LLM_RATE_PER_MINUTE, settings.LLM_BURST)]
+    every += [tenant_scope(tenant) for tenant in dict.fromkeys(tenants)]
+    return [scope for scope in every if scope.limited]
+
+class Lease:
+    """A slot in the concurrency limits of its scopes, held while the answer streams."""
+
+    def __init__(self, lease_id: str, keys: list, ttl: float = settings.LLM_LEASE_TTL):
+        self.lease_id = lease_id
+        self.keys = keys
+        self.ttl = ttl
+
+    async def renew(self):
+        """Push the expiry back every third of the ttl, until cancelled."""
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await get_async_redis().eval(RENEW, len(self.keys), *self.keys, self.lease_id, self.ttl)
+            except redis.exceptions.RedisError as e:
+                logger.error(f"Error in renewing LLM lease: {e}")
+
+    async def release(self):
+        """Free the slot, once: later calls do nothing."""
+        keys, self.keys = self.keys, []
+        if not keys:
+            return
+        try:
+            async with get_async_redis().pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.zrem(key, self.lease_id)
+                await pipe.execute()
+        except redis.exceptions.RedisError as e:
+            # the slot frees itself when the lease expires
+            logger.error(f"Error in releasing LLM lease: {e}")
+
+    async def stream(self, tokens: AsyncIterator[str]) -> AsyncIterator[str]:
+        """
+        Yield the tokens, holding the lease until the stream ends or is closed.
+        A stream that is never started never releases it: callers also release it
+        once the response is done, else it expires after its ttl.
+        """
+        renewal = asyncio.create_task(self.renew()) if self.keys else None
+        try:
+            async for token in tokens:
+                yield token
+        finally:
+            if renewal is not None:
+                renewal.cancel()
+            await tokens.aclose()
+            await self.release()
+
+async def acquire(tenants: List[str], timeout: float = settings.LLM_QUEUE_TIMEOUT) -> Lease:
+    """
+    Wait for an LLM slot in the global limits and in those of each tenant.
+    Chats queue for up to timeout seconds, polling Redis with a jittered backoff,
+    so the limits hold across API processes. A wait for the rate limit that would
+    outlast the timeout is rejected right away.
+    When Redis is unreachable chats are let through, the LLM is still there.
+    Args:
+        tenants: the tenants of the chat, e.g. ["file:<file_id>", "key:<api key>"]
+    Returns:
+        the lease to stream the answer with
+    Raises:
+        RateLimited: with the seconds to wait before retrying
+    """
+    limited = scopes(tenants)
+    if not limited:
+        return Lease("", [])
+
+    lease_id = uuid.uuid4().hex
+    keys = [key for scope in limited for key in scope.keys()]
+    args = [arg for scope in limited for arg in scope.args()]
+    names = ", ".join(scope.name for scope in limited)
+    start = time.monotonic()
+    delay = 0.02
+    try:
+        while True:
+            admitted, wait_ms, full = await get_async_redis().eval(
+                ADMIT, len(keys), *keys, lease_id, settings.LLM_LEASE_TTL, *args
+            )
+            if admitted:
+                metrics.LLM_ADMISSIONS.labels("admitted").inc()
+                return Lease(lease_id, [key for scope in limited if scope.concurrency > 0 for key in scope.keys()[:1]])
+
+            wait = wait_ms / 1000
+            remaining = timeout - (time.monotonic() - start)
+            if remaining <= 0 or wait > remaining:
+                metrics.LLM_ADMISSIONS.labels("rejected").inc()
+                raise RateLimited(names, wait if not full else max(wait, delay))
+            await asyncio.sleep(min(max(wait, delay) * random.uniform(0.5, 1.5), remaining))
+            delay = min(delay * 2, 0.5)
+    except redis.exceptions.RedisError as e:
+        logger.error(f"Error in LLM admission, letting the chat through: {e}")
+        metrics.LLM_ADMISSIONS.labels("unchecked").inc()
+        return Lease("", [])
+    finally:
+        metrics.LLM_QUEUE_SECONDS.observe(time.monotonic() - start)
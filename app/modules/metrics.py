@@ -0,0 +1,192 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    start_http_server,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+from app.modules import connections
+
+logger = logging.getLogger(__name__)
+
+# Hot-path metrics, per process. Under several API workers, set PROMETHEUS_MULTIPROC_DIR
+# and /metrics aggregates them (except the Redis pool gauges, which stay per process).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STAGE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+UPLOAD_BYTES = Counter("chatdoc_upload_bytes_total", "Bytes of uploads written to disk")
+UPLOAD_SECONDS = Histogram("chatdoc_upload_seconds", "Time to receive an upload (or a resumable part)",
+                           buckets=LATENCY_BUCKETS)
+UPLOAD_THROUGHPUT = Histogram("chatdoc_upload_bytes_per_second", "Throughput of an upload",
+                              buckets=(2 ** 16, 2 ** 18, 2 ** 20, 2 ** 22, 2 ** 24, 2 ** 26, 2 ** 28))
+INGEST_STAGE_SECONDS = Histogram("chatdoc_ingest_stage_seconds", "Time of an ingestion stage",
+                                 ["stage", "status"], buckets=STAGE_BUCKETS)
+EMBED_BATCH_SIZE = Histogram("chatdoc_embedding_batch_size", "Texts per embedding request, cache misses only",
+                             ["kind"], buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500))
+EMBED_SECONDS = Histogram("chatdoc_embedding_request_seconds", "Latency of an embedding request, retries included",
+                          ["kind"], buckets=LATENCY_BUCKETS)
+KNN_SECONDS = Histogram("chatdoc_knn_query_seconds", "Round-trip of the FT.SEARCH queries of a retrieval",
+                        ["mode"], buckets=LATENCY_BUCKETS)
+RETRIEVAL_SECONDS = Histogram("chatdoc_retrieval_seconds", "Retrieval, query embedding and reranking included",
+                              buckets=LATENCY_BUCKETS)
+REWRITE_SECONDS = Histogram("chatdoc_rewrite_seconds", "Follow-up question rewrite, cache lookup included",
+                            buckets=LATENCY_BUCKETS)
+LLM_SECONDS = Histogram("chatdoc_llm_request_seconds", "Latency of an LLM call", ["model"], buckets=LATENCY_BUCKETS)
+LLM_TTFT = Histogram("chatdoc_llm_time_to_first_token_seconds", "Time to the first streamed token of an LLM call",
+                     ["model"], buckets=LATENCY_BUCKETS)
+LLM_TOKENS_PER_SECOND = Histogram("chatdoc_llm_tokens_per_second", "Output token rate of a streamed LLM call, after the first token",
+                                  ["model"], buckets=(5, 10, 20, 40, 60, 80, 100, 150, 200, 400))
+LLM_TOKENS = Counter("chatdoc_llm_tokens_total", "LLM tokens", ["model", "direction"])
+CHAT_TTFT = Histogram("chatdoc_chat_time_to_first_token_seconds", "Time to the first answer token of a chat request",
+                      ["cached"], buckets=LATENCY_BUCKETS)
+CACHE_REQUESTS = Counter("chatdoc_cache_requests_total", "Cache lookups", ["cache", "result"])
+LLM_ADMISSIONS = Counter("chatdoc_llm_admissions_total", "Chats admitted to or rejected by the LLM limits", ["result"])
+LLM_QUEUE_SECONDS = Histogram("chatdoc_llm_queue_seconds", "Time a chat waited for an LLM slot, rejected ones included",
+                              buckets=LATENCY_BUCKETS)
+
+def cache_lookup(cache: str, hit: bool, count: int = 1):
+    if count:
+        CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc(count)
+
+@contextmanager
+def timed(histogram: Histogram):
+    """Observe the time of the block, also when it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start)
+
+def observe_upload(size: int, seconds: float):
+    UPLOAD_BYTES.inc(size)
+    UPLOAD_SECONDS.observe(seconds)
+    if seconds > 0:
+        UPLOAD_THROUGHPUT.observe(size / seconds)
+
+def _model_name(serialized: Optional[dict], kwargs: dict) -> str:
+    params = kwargs.get("invocation_params") or {}
+    name = params.get("model") or params.get("model_name") or params.get("_type")
+    if not name and serialized:
+        name = (serialized.get("kwargs") or {}).get("model") or serialized.get("name")
+    return str(name or "unknown")
+
+class LLMMetricsHandler(BaseCallbackHandler):
+    """Records latency, time to first token, token rate and token counts of every LLM call of a run,
+    the rewrite included. Time to first token only exists for streamed calls.
+    """
+
+    run_inline = True
+
+    def __init__(self):
+        self.calls: Dict[UUID, dict] = {}
+
+    def on_chat_model_start(self, serialized: dict, messages: list, *, run_id: UUID, **kwargs: Any):
+        self.calls[run_id] = {"model": _model_name(serialized, kwargs), "start": time.perf_counter(),
+                              "first": None, "tokens": 0}
+
+    def on_llm_start(self, serialized: dict, prompts: list, *, run_id: UUID, **kwargs: Any):
+        self.on_chat_model_start(serialized, [], run_id=run_id, **kwargs)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any):
+        call = self.calls.get(run_id)
+        if call is not None:
+            call["first"] = call["first"] or time.perf_counter()
+            call["tokens"] += 1
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        call = self.calls.pop(run_id, None)
+        if call is None:
+            return
+        end = time.perf_counter()
+        model = call["model"]
+        LLM_SECONDS.labels(model).observe(end - call["start"])
+        if call["first"] is not None:
+            LLM_TTFT.labels(model).observe(call["first"] - call["start"])
+            if call["tokens"] > 1 and end > call["first"]:
+                LLM_TOKENS_PER_SECOND.labels(model).observe((call["tokens"] - 1) / (end - call["first"]))
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                LLM_TOKENS.labels(model, "input").inc(usage.get("input_tokens", 0))
+                LLM_TOKENS.labels(model, "output").inc(usage.get("output_tokens", 0))
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self.calls.pop(run_id, None)
+
+def _pool_usage(pool) -> Optional[tuple]:
+    """(connections in use, max connections) of a blocking pool, None if unknown."""
+    try:
+        if hasattr(pool, "_in_use_connections"):  # asyncio pool
+            in_use = len(pool._in_use_connections)
+        else:
+            # the sync pool queues idle connections, and None for connections not opened yet
+            in_use = len(pool._connections) - sum(c is not None for c in list(pool.pool.queue))
+        return in_use, pool.max_connections
+    except Exception as e:
+        logger.debug(f"Redis pool usage could not be read: {e}")
+        return None
+
+class RedisPoolCollector:
+    """Saturation of this process's Redis pools, read at scrape time."""
+
+    def collect(self):
+        in_use = GaugeMetricFamily("chatdoc_redis_pool_in_use_connections", "Redis connections checked out", labels=["pool"])
+        limit = GaugeMetricFamily("chatdoc_redis_pool_max_connections", "Redis pool size", labels=["pool"])
+        for name, client in (("sync", connections._redis), ("async", connections._async_redis)):
+            usage = _pool_usage(client.connection_pool) if client is not None else None
+            if usage is not None:
+                in_use.add_metric([name], usage[0])
+                limit.add_metric([name], usage[1])
+        yield in_use
+        yield limit
+
+REGISTRY.register(RedisPoolCollector())
+
+def collector_registry() -> CollectorRegistry:
+    """This process's metrics, or those of every process sharing PROMETHEUS_MULTIPROC_DIR."""
+    if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        return REGISTRY
+    from prometheus_client import multiprocess
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+def render() -> tuple:
+    """
+    The metrics in the Prometheus text format, as (body, content type).
+    """
+    return generate_latest(collector_registry()), CONTENT_TYPE_LATEST
+
+def serve(port: int):
+    """
+    Expose the metrics on their own HTTP port, for processes without a web server
+    (Celery workers). Tasks run in the prefork pool children, whose metrics only
+    reach this server through PROMETHEUS_MULTIPROC_DIR.
+    """
+    if not port:
+        return
+    if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        logger.warning("PROMETHEUS_MULTIPROC_DIR is not set, metrics of pool processes are not served")
+    start_http_server(port, registry=collector_registry())
+    logger.info(f"Metrics served on port {port}")
+
+def process_exited(pid: int):
+    """Drop the live gauges of a process that wrote to PROMETHEUS_MULTIPROC_DIR, its counters are kept."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(pid)
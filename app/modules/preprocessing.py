@@ -1,94 +1,635 @@
 import os
-import redis
+import re
+import hashlib
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from langchain_pymupdf4llm import PyMuPDF4LLMLoader
+import pymupdf
+import numpy as np
+from billiard.pool import Pool
+from langchain_core.documents import Document
 from langchain_community.vectorstores.redis import Redis
-from langchain_experimental.text_splitter import SemanticChunker
+from langchain_community.vectorstores.redis.base import _generate_field_schema, check_index_exists
 
-from app.config.config import Config
+try:
+    from redis.commands.search.index_definition import IndexDefinition, IndexType
+except ImportError:  # redis-py < 6
+    from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+
+from app.modules.embeddings import CachedEmbeddings
+from app.modules.chunking import HEADING_PATTERN, chunking_key, get_chunker
+from app.modules.registry import IndexRegistry
+from app.modules.compact import (
+    TEXT_SUFFIX, VectorCodec, check_vector_settings, compress_text, decompress_text, with_codec,
+)
+from app.modules.connections import get_config, get_redis
+from app.config import settings
+
+# per index, chunk key -> "{page hash}:{chunk hash}", what a new version is diffed against
+MANIFEST_PREFIX = "chunk_manifest:"
+
+# "4", "4.2", "Section 4.2", "Chapter 3" at the start of a heading
+SECTION_PATTERN = re.compile(r"^(?:(?:section|chapter|part|article)\s+)?(\d+(?:\.\d+)*)\b", re.IGNORECASE)
+# same sentence split as SemanticChunker
+SENTENCE_PATTERN = re.compile(r"(?<=[.?!])\s+")
+HEADING_SEPARATOR = " > "
+
+def content_digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+def heading_outline(pages: list, stack: list = None) -> dict:
+    """
+    Heading path in effect along each page, by page number (as a string):
+    [(offset, path)], starting at offset 0 with the path carried over from the
+    previous pages. Pass the same stack to carry it across calls.
+    """
+    stack = [] if stack is None else stack
+    outline = {}
+    for page in pages:
+        entries = [(0, [text for _, text in stack])]
+        for match in HEADING_PATTERN.finditer(page.page_content):
+            level, text = len(match.group(1)), match.group(2).replace("**", "").replace("_", " ").strip()
+            while stack and stack[-1][0] >= level:
+                stack.pop()
+            stack.append((level, text))
+            entries.append((match.start(), [text for _, text in stack]))
+        outline[str(page.metadata["page"])] = entries
+    return outline
+
+def section_tags(path: list) -> str:
+    """Section numbers of a heading path as TAG values, "4.2" also counts as "4"."""
+    tags = []
+    for heading in path:
+        match = SECTION_PATTERN.match(heading)
+        if match:
+            parts = match.group(1).split(".")
+            tags += [".".join(parts[:i]) for i in range(1, len(parts) + 1)]
+    return ",".join(dict.fromkeys(tags))
+
+def annotate_chunks(pages: list, chunks: list, outline: dict):
+    """
+    Add the heading path, section numbers and character offsets within the page
+    to the metadata of chunks, in place. Semantic chunks join sentences with single
+    spaces, so chunks are located by their first and last sentence, which are verbatim.
+    """
+    texts = {str(page.metadata["page"]): page.page_content for page in pages}
+    cursors = {}
+    for chunk in chunks:
+        number = str(chunk.metadata.get("page"))
+        text, cursor = texts.get(number, ""), cursors.get(number, 0)
+        sentences = SENTENCE_PATTERN.split(chunk.page_content.strip())
+        start = text.find(sentences[0], cursor)
+        start = cursor if start < 0 else start
+        end = text.find(sentences[-1], start)
+        end = start + len(chunk.page_content) if end < 0 else end + len(sentences[-1])
+        # the next chunk may overlap this one
+        cursors[number] = start + 1
+
+        path = []
+        for offset, entry in outline.get(number, [(0, [])]):
+            if offset > start:
+                break
+            path = entry
+        chunk.metadata.update({
+            "heading": HEADING_SEPARATOR.join(path),
+            "section": section_tags(path),
+            "char_start": start,
+            "char_end": end,
+        })
+
+def chunk_number(key: str) -> int:
+    """Position of a chunk in its document, keys ingested before numbering sort first."""
+    suffix = key.rsplit(":", 1)[-1]
+    return int(suffix) if suffix.isdigit() else -1
+
+def vector_schema(**overrides) -> dict:
+    """
+    Vector field definition for new indexes, from settings.
+    """
+    schema = {
+        "algorithm": settings.VECTOR_ALGORITHM.upper(),
+        "datatype": settings.VECTOR_DATATYPE.upper(),
+        "distance_metric": settings.VECTOR_DISTANCE_METRIC.upper(),
+    }
+    if schema["algorithm"] == "HNSW":
+        schema.update({
+            "m": settings.HNSW_M,
+            "ef_construction": settings.HNSW_EF_CONSTRUCTION,
+            "ef_runtime": settings.HNSW_EF_RUNTIME,
+        })
+    schema.update(overrides)
+    return schema
+
+def index_schema(metadata: dict, tags: tuple = ("file_id", "section")) -> dict:
+    """
+    Index schema generated from chunk metadata, with the given fields indexed as TAG
+    so queries can pre-filter on them inside the KNN search.
+    """
+    schema = _generate_field_schema({k: v for k, v in metadata.items() if k not in tags})
+    schema["tag"] = schema.get("tag", []) + [{"name": tag} for tag in tags if tag in metadata]
+    return {k: v for k, v in schema.items() if v}
+
+def parse_page_range(shard: tuple) -> list:
+    """
+    Parse pages [start, end) of a PDF to markdown, one Document per page.
+    Runs in a pool process, so it opens its own handle on the file.
+    """
+    import pymupdf4llm
+
+    file_path, start, end = shard
+    docs = []
+    with pymupdf.open(file_path) as doc:
+        for page in range(start, end):
+            # same per-page call and cleanup as PyMuPDF4LLMLoader
+            text = pymupdf4llm.to_markdown(doc, pages=[page], show_progress=False, graphics_limit=5000)
+            if text.endswith("\n-----\n\n"):
+                text = text[:-8]
+            docs.append(Document(
+                page_content=text,
+                metadata={
+                    "source": file_path,
+                    "file_path": file_path,
+                    "total_pages": len(doc),
+                    "page": page,
+                },
+            ))
+    return docs
 
 class DocumentProcessor:
-    def __init__(self, file_path: str):
-        config = Config()
+    def __init__(self, file_path: str,
+                 parse_workers: int = settings.PARSE_WORKERS,
+                 shard_pages: int = settings.PARSE_SHARD_PAGES,
+                 batch_size: int = settings.INGEST_BATCH_SIZE,
+                 embed_concurrency: int = settings.EMBED_CONCURRENCY,
+                 vector_params: dict = None,
+                 collection: str = None,
+                 version: int = 1,
+                 chunking: str = settings.CHUNKING_STRATEGY):
+        config = get_config()
         self.redis_url = config.REDIS_URL
-        self.redis_client = redis.from_url(self.redis_url)
         self.file_path = file_path
         self.embeddings = config.EMBED_MODEL
+        self.chunk_embeddings = CachedEmbeddings(self.embeddings) # used for chunking and ingestion
         self.file_name = os.path.basename(self.file_path) # Format: file_<uuid>.pdf
         self.file_id = self.file_name.split("_")[0]
+        # a collection shares one index between many files, told apart by the file_id tag
+        self.collection = collection
+        if collection:
+            self.index_name, self.key_prefix = IndexRegistry.collection_index(collection)
+        else:
+            # every version of a file gets its own index, swapped in once complete
+            self.index_name, self.key_prefix = IndexRegistry.version_index(self.file_id, version)
+        self.version = version
+        self.vector_schema = vector_schema(**(vector_params or {}))
+        self.registry = IndexRegistry()
+        self.parse_workers = parse_workers
+        self.shard_pages = shard_pages
+        self.batch_size = batch_size
+        self.embed_concurrency = embed_concurrency
+        self.chunking = chunking
+        self.vectorstore = None
+        self.codec = None
+        self.codec_saved = False
+        self.chunks_written = 0
     
-    def vector_document(self):
+    def get_codec(self) -> VectorCodec:
         """
-        Create and return a retriever for the document.
+        The vector codec of the index: a collection keeps the one chosen (and the PCA
+        fitted) with its first file, a new index gets one from settings.
         """
-        try:
-            redis_vector = self.load_document()
-            retriever = redis_vector.as_retriever(search_kwargs={"k": 3})
-            logging.info("Step 3. Successfully created a retriever")
+        if self.codec is None:
+            self.codec = VectorCodec.load(get_redis(), self.index_name)
+            stored = self.registry.get_schema(self.index_name)
+            if self.codec is not None or stored:
+                # existing index, ingested before codecs were recorded: stored as is
+                self.codec = self.codec or VectorCodec(stored["vector"][0]["datatype"])
+                self.codec_saved = True
+            else:
+                check_vector_settings(self.vector_schema["datatype"], self.vector_schema["distance_metric"],
+                                      settings.PCA_COMPONENTS)
+                self.codec = VectorCodec(self.vector_schema["datatype"], compact_text=settings.COMPACT_TEXT)
+        return self.codec
 
-            return retriever
-        except Exception as e:
-            logging.error(f"Error in vector_document: {e}")
-            raise
+    def save_codec(self, vectors: list):
+        """
+        Fit the PCA on the first vectors ingested into a new index, then record the codec
+        before anything is written so readers always decode the index correctly.
+        """
+        if self.codec_saved:
+            return
+        if settings.PCA_COMPONENTS > 0:
+            if self.codec.fit(np.vstack(vectors), settings.PCA_COMPONENTS):
+                logging.info(f"Fitted PCA to {settings.PCA_COMPONENTS} dimensions on {sum(map(len, vectors))} chunks")
+            else:
+                logging.warning(f"Too few chunks to fit PCA on {self.index_name}, keeping full dimensions")
+        self.codec.save(get_redis(), self.index_name)
+        self.codec_saved = True
+        self.vectorstore._embeddings = with_codec(self.chunk_embeddings, self.codec)
 
-    def ingest_document(self, docs: list) -> Redis:
+    def store_texts(self, keys: list, texts: list):
+        pipeline = get_redis().pipeline(transaction=False)
+        for key, text in zip(keys, texts):
+            pipeline.set(key + TEXT_SUFFIX, compress_text(text))
+        pipeline.execute()
+
+    def get_vectorstore(self, metadata: dict) -> Redis:
+        """
+        The document's vector store, created once with a schema generated from
+        the metadata of the first chunk. An existing index (a collection, or a
+        re-ingestion) keeps the vector field it was created with, whatever the
+        current settings, and the metadata fields already recorded for it.
+        """
+        if self.vectorstore is None:
+            stored = self.registry.get_schema(self.index_name)
+            self.vectorstore = Redis(
+                self.redis_url,
+                self.index_name,
+                with_codec(self.chunk_embeddings, self.get_codec()),
+                index_schema=self.registry.merge_schema(stored, index_schema(metadata)),
+                vector_schema=None if stored else self.vector_schema,
+                key_prefix=self.key_prefix,
+            )
+            if stored:
+                self.vectorstore._schema.content_vector.dims = stored["vector"][0]["dims"]
+            self.vectorstore.client = get_redis()
+        return self.vectorstore
+
+    def chunk_key(self, number: int) -> str:
+        # keys are numbered, so ingesting the same chunks again overwrites them; in a
+        # collection they are also grouped per file, so one file can be removed from it
+        if self.collection:
+            return f"{self.key_prefix}:{self.file_id}:{number}"
+        return f"{self.key_prefix}:{number}"
+
+    def page_hashes(self, pages: list, outline: dict) -> dict:
+        """
+        Hash of each parsed page, by page number (as a string, it goes through JSON).
+        It covers the chunking settings and the heading path carried into the page,
+        the chunks and their metadata depend on both.
+        """
+        prefix = chunking_key(self.chunking) + "\x00"
+        return {
+            str(page.metadata["page"]): content_digest(
+                prefix + HEADING_SEPARATOR.join(outline[str(page.metadata["page"])][0][1]) + "\x00" + page.page_content
+            )
+            for page in pages
+        }
+
+    def save_manifest(self, keys: list, docs: list, page_hashes: dict):
+        """Record the content hashes of single-document chunks, for diffing the next version."""
+        if self.collection:
+            return
+        get_redis().hset(MANIFEST_PREFIX + self.index_name, mapping={
+            key: f"{page_hashes.get(str(doc.metadata.get('page')), '')}:{content_digest(doc.page_content)}"
+            for key, doc in zip(keys, docs)
+        })
+
+    def load_manifest(self, index_name: str, key_prefix: str) -> dict:
+        """
+        Content hashes of the chunks of an index, as {key: (page hash, chunk hash)}.
+        Indexes ingested before manifests were kept are hashed from their stored
+        text, without page hashes.
+        """
+        client = get_redis()
+        raw = client.hgetall(MANIFEST_PREFIX + index_name)
+        if raw:
+            manifest = {}
+            for key, value in raw.items():
+                page_hash, chunk_hash = value.decode().split(":")
+                manifest[key.decode()] = (page_hash, chunk_hash)
+            return manifest
+
+        codec = VectorCodec.load(client, index_name)
+        keys = [
+            key.decode() for key in client.scan_iter(match=f"{key_prefix}:*", count=self.batch_size)
+            if not key.decode().endswith(TEXT_SUFFIX)
+        ]
+        manifest = {}
+        for start in range(0, len(keys), self.batch_size):
+            batch = keys[start:start + self.batch_size]
+            pipeline = client.pipeline(transaction=False)
+            for key in batch:
+                if codec is not None and codec.compact_text:
+                    pipeline.get(key + TEXT_SUFFIX)
+                else:
+                    pipeline.hget(key, "content")
+            for key, blob in zip(batch, pipeline.execute()):
+                text = (decompress_text(blob) if codec is not None and codec.compact_text else blob.decode()) if blob else ""
+                manifest[key] = ("", content_digest(text))
+        logging.info(f"Hashed {len(manifest)} chunks of {index_name}, it has no manifest")
+        return manifest
+
+    def diff_pages(self, pages: list, previous: dict, progress=None) -> tuple:
+        """
+        Diff the parsed pages of a new version against the index of the previous one.
+        Unchanged pages keep their chunks; changed pages are chunked again and only
+        the chunks whose content is new need embedding.
+        Args:
+            pages: parsed pages of the new version
+            previous: index_name and key_prefix of the current version
+        Returns:
+            tuple: (plan, chunks to embed). The plan lists every chunk of the new
+            version in order, with the key it is copied from (None for new chunks).
+        """
+        manifest = self.load_manifest(previous["index_name"], previous["key_prefix"])
+        by_page, by_chunk = {}, {}
+        for key in sorted(manifest, key=chunk_number):
+            page_hash, chunk_hash = manifest[key]
+            if page_hash:
+                by_page.setdefault(page_hash, []).append(key)
+            by_chunk.setdefault(chunk_hash, key)
+
+        outline = heading_outline(pages)
+        hashes = self.page_hashes(pages, outline)
+        changed = [page for page in pages if hashes[str(page.metadata["page"])] not in by_page]
+        new_chunks = {}
+        for chunk in self.split_pages(changed, progress, outline):
+            new_chunks.setdefault(str(chunk.metadata["page"]), []).append(chunk)
+
+        entries, chunks = [], []
+        for page in pages:
+            number = str(page.metadata["page"])
+            page_hash = hashes[number]
+            if page_hash in by_page:
+                entries += [
+                    {"source": key, "page": page.metadata["page"], "page_hash": page_hash, "chunk_hash": manifest[key][1]}
+                    for key in by_page[page_hash]
+                ]
+                continue
+            for chunk in new_chunks.get(number, []):
+                chunk_hash = content_digest(chunk.page_content)
+                source = by_chunk.get(chunk_hash)
+                entries.append({"source": source, "page": page.metadata["page"], "page_hash": page_hash, "chunk_hash": chunk_hash})
+                if source is None:
+                    chunks.append(chunk)
+
+        reused = {entry["source"] for entry in entries if entry["source"]}
+        plan = {
+            "page_hashes": hashes,
+            "total_pages": len(pages),
+            "entries": entries,
+            "reused": len(entries) - len(chunks),
+            "embedded": len(chunks),
+            "removed": len(manifest) - len(reused),
+        }
+        logging.info(
+            f"Version {self.version} of {self.file_id}: {len(changed)}/{len(pages)} pages changed, "
+            f"{plan['reused']} chunks reused, {plan['embedded']} to embed, {plan['removed']} removed"
+        )
+        return plan, chunks
+
+    def apply_version(self, plan: dict, chunks: list, previous: dict, progress=None) -> Redis:
+        """
+        Build the index of a new version: same schema and codec as the previous one,
+        unchanged chunks copied inside Redis (COPY, no embedding), new chunks embedded
+        and written. The previous index is untouched until the version is registered.
+        Returns:
+            Redis: the vector store of the new version
+        """
+        client = get_redis()
+        schema = self.registry.get_schema(previous["index_name"])
+        if check_index_exists(client, self.index_name):
+            # left over by a failed attempt at this version
+            self.registry.drop_index(self.index_name, self.key_prefix)
+        self.codec = VectorCodec.load(client, previous["index_name"]) or VectorCodec(schema["vector"][0]["datatype"])
+        self.codec.save(client, self.index_name)
+        self.codec_saved = True
+
+        self.vectorstore = Redis(
+            self.redis_url,
+            self.index_name,
+            with_codec(self.chunk_embeddings, self.codec),
+            index_schema=schema,
+            key_prefix=self.key_prefix,
+        )
+        self.vectorstore.client = client
+        self.vectorstore._schema.content_vector.dims = schema["vector"][0]["dims"]
+        client.ft(self.index_name).create_index(
+            fields=self.vectorstore._schema.get_fields(),
+            definition=IndexDefinition(prefix=[self.key_prefix], index_type=IndexType.HASH),
+        )
+
+        copies = [entry for entry in plan["entries"] if entry["source"]]
+        pipeline = client.pipeline(transaction=False)
+        for number, entry in enumerate(copies):
+            key = self.chunk_key(number)
+            pipeline.copy(entry["source"], key, replace=True)
+            if self.codec.compact_text:
+                pipeline.copy(entry["source"] + TEXT_SUFFIX, key + TEXT_SUFFIX, replace=True)
+            # the page may have moved, and the chunk now comes from the new file
+            pipeline.hset(key, mapping={
+                "page": entry["page"],
+                "total_pages": plan["total_pages"],
+                "source": self.file_path,
+                "file_path": self.file_path,
+            })
+            pipeline.hset(MANIFEST_PREFIX + self.index_name, key, f"{entry['page_hash']}:{entry['chunk_hash']}")
+            if number % self.batch_size == self.batch_size - 1:
+                pipeline.execute()
+        pipeline.execute()
+        self.chunks_written = len(copies)
+
+        if chunks:
+            self.ingest_document(chunks, progress, plan["page_hashes"])
+        else:
+            self.registry.save_schema(self.index_name, self.vectorstore.schema)
+        return self.vectorstore
+
+    def embed_batches(self, texts: list):
+        """
+        Embed texts in batches, with up to embed_concurrency requests in flight.
+        Yields the vectors of each batch in order; no new request is sent until
+        the oldest one has been consumed. Rate limited requests are retried with
+        backoff by CachedEmbeddings.
+        """
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.embed_concurrency) as executor:
+            pending = deque()
+            for batch in batches:
+                if len(pending) >= self.embed_concurrency:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(self.chunk_embeddings.embed_documents, batch))
+            while pending:
+                yield pending.popleft().result()
+
+    def ingest_document(self, docs: list, progress=None, page_hashes: dict = None) -> Redis:
         """
         Ingest document into the vectordb.
         Args:
             docs (list): List of documents
-            file_name (str): Name of the file (the uuid of the file)
+            progress: optional callback(done, total), called after each batch
+            page_hashes: content hash of the pages the chunks come from, see page_hashes()
         Returns:
-            Redis: Redis object
+            Redis: Redis object, covering every chunk ingested so far
         """
         try:
-            for i in range(0, len(docs), 100):
-                if i + 100 > len(docs):
-                    chunks = docs[i:]
-                else:
-                    chunks = docs[i:i+100]
+            for doc in docs:
+                doc.metadata["file_id"] = self.file_id
+            vector = self.get_vectorstore(docs[0].metadata)
+            texts = [doc.page_content for doc in docs]
+            metadatas = [doc.metadata for doc in docs]
+            keys = [self.chunk_key(self.chunks_written + i) for i in range(len(docs))]
+            self.chunks_written += len(docs)
+
+            batches = self.embed_batches(texts)
+            if not self.codec_saved:
+                # the PCA of a new index is fitted on its whole first shard
+                batches = list(batches)
+                self.save_codec(batches)
+            codec = self.codec
 
-                vector = Redis.from_documents(
-                    chunks, 
-                    self.embeddings,
-                    redis_url=self.redis_url,
-                    index_name=self.file_name,
+            # the index is created with the first batch, then each batch
+            # is written through one pipeline
+            start = 0
+            for embeddings in batches:
+                end = start + len(embeddings)
+                if not codec.is_identity:
+                    embeddings = codec.encode(embeddings).tolist()
+                vector.add_texts(
+                    # compact chunks keep an empty content field in the index
+                    [""] * (end - start) if codec.compact_text else texts[start:end],
+                    metadatas[start:end],
+                    embeddings=embeddings,
+                    keys=keys[start:end],
+                    batch_size=self.batch_size,
                 )
-            vector.write_schema("data/schema.yaml")
+                if codec.compact_text:
+                    self.store_texts(keys[start:end], texts[start:end])
+                self.save_manifest(keys[start:end], docs[start:end], page_hashes or {})
+                start = end
+                if progress:
+                    progress(end, len(texts))
+            # the schema now has the embedding dimension, keep it for reconnecting
+            self.registry.save_schema(self.index_name, vector.schema)
             return vector
         except Exception as e:
             logging.error(f"Error in ingest_document: {e}")
             raise
 
-    def load_document(self):
+    def parse_document(self):
         """
-        Indexing document, returns VectorStoreRetriever
+        Parse the PDF in page-range shards across a process pool.
+        Yields the pages of each shard in document order, so the output is the
+        same whatever the number of workers.
         """
-        try:
-            logging.info("Loading file name:" + self.file_id)
-
-            # check if the vectorstore already exist
-            if len(self.redis_client.keys(f"doc:{self.file_id}:*")) > 0:
-                logging.info("Step 1. Vectorstore already exist. Skipping step 2")
-                return Redis.from_existing_index(
-                    embedding=self.embeddings,
-                    index_name=self.file_id, 
-                    redis_url=self.redis_url,
-                    schema="data/schema.yaml",
-                    key_prefix="doc")
-            else:
-                loader = PyMuPDF4LLMLoader(self.file_path)
-                docs = loader.load()
-                logging.info("Step 1. Successfully loaded the document.")
+        with pymupdf.open(self.file_path) as doc:
+            total_pages = len(doc)
 
-                text_splitter = SemanticChunker(self.embeddings)
-                documents = text_splitter.split_documents(docs)
-                logging.info("Step 1.1. Splitted the document into chunks")
+        shards = [
+            (self.file_path, start, min(start + self.shard_pages, total_pages))
+            for start in range(0, total_pages, self.shard_pages)
+        ]
+        workers = min(self.parse_workers, len(shards))
+        if workers <= 1:
+            for shard in shards:
+                yield parse_page_range(shard)
+            return
 
-                redis_vector = self.ingest_document(documents)
-                logging.info("Step 1.2. Ingested document into vector store")
+        # billiard, unlike multiprocessing, can fork from a daemonic Celery worker
+        with Pool(workers) as pool:
+            yield from pool.imap(parse_page_range, shards)
 
-                return redis_vector
-        except Exception as e:
-            logging.error(f"Error in load_document: {e}")
-            raise
+    def parse_pages(self, progress=None) -> list:
+        """
+        Parse the whole PDF, shards in parallel. New versions use it: they are
+        diffed against the previous one page by page, so chunking waits for every page.
+        Args:
+            progress: optional callback(done, total) called after each shard
+        """
+        with pymupdf.open(self.file_path) as doc:
+            total_pages = len(doc)
+        pages = []
+        for docs in self.parse_document():
+            pages.extend(docs)
+            if progress:
+                progress(len(pages), total_pages)
+        return pages
+
+    def parse_and_split(self, progress=None) -> tuple:
+        """
+        Parse the PDF and chunk each shard as soon as it is parsed, while the pool
+        parses the next ones. The chunks of each shard are embedded in the background
+        into the embedding cache, so the embed stage mostly reads them back.
+        The chunks are the same as split_pages() of the whole document.
+        Args:
+            progress: optional callback(done, total) called after each shard
+        Returns:
+            tuple: (pages, chunks, page_hashes)
+        """
+        with pymupdf.open(self.file_path) as doc:
+            total_pages = len(doc)
+        text_splitter = get_chunker(self.chunk_embeddings, self.chunking)
+        pages, chunks, outline, stack = [], [], {}, []
+        with ThreadPoolExecutor(max_workers=self.embed_concurrency) as executor:
+            embedding = []
+            for shard in self.parse_document():
+                # the heading path is carried over from the shards before
+                shard_outline = heading_outline(shard, stack)
+                shard_chunks = text_splitter.split_documents(shard)
+                annotate_chunks(shard, shard_chunks, shard_outline)
+                texts = [chunk.page_content for chunk in shard_chunks]
+                for start in range(0, len(texts), self.batch_size):
+                    embedding.append(executor.submit(self.prefetch_embeddings, texts[start:start + self.batch_size]))
+                outline.update(shard_outline)
+                pages.extend(shard)
+                chunks.extend(shard_chunks)
+                if progress:
+                    progress(len(pages), total_pages)
+            for future in embedding:
+                future.result()
+        return pages, chunks, self.page_hashes(pages, outline)
+
+    def prefetch_embeddings(self, texts: list) -> int:
+        """Embed texts into the embedding cache only, without keeping the vectors."""
+        return len(self.chunk_embeddings.embed_documents(texts))
+
+    def split_pages(self, pages: list, progress=None, outline: dict = None) -> list:
+        """
+        Chunking of parsed pages with the processor's strategy, a shard at a time, with
+        the chunk metadata filters and citations use (see annotate_chunks).
+        Args:
+            outline: heading_outline() of the whole document, computed from pages if omitted
+        """
+        outline = heading_outline(pages) if outline is None else outline
+        text_splitter = get_chunker(self.chunk_embeddings, self.chunking)
+        chunks = []
+        for start in range(0, len(pages), self.shard_pages):
+            shard = pages[start:start + self.shard_pages]
+            shard_chunks = text_splitter.split_documents(shard)
+            annotate_chunks(shard, shard_chunks, outline)
+            chunks.extend(shard_chunks)
+            if progress:
+                progress(min(start + self.shard_pages, len(pages)), len(pages))
+        return chunks
+
+    def embed_chunks(self, chunks: list, progress=None):
+        """
+        Embed the chunks into the embedding cache, so indexing only reads them back.
+        """
+        texts = [doc.page_content for doc in chunks]
+        done = 0
+        for embeddings in self.embed_batches(texts):
+            done += len(embeddings)
+            if progress:
+                progress(done, len(texts))
+
+    def finish_ingestion(self, redis_vector: Redis):
+        if self.collection:
+            self.registry.add_to_collection(self.collection, self.file_id, redis_vector)
+        else:
+            self.registry.mark_ingested(self.index_name)
+        logging.info(f"Embedding cache: {self.chunk_embeddings.stats()}")
+
+    def connect_existing(self) -> Redis:
+        return Redis.from_existing_index(
+            embedding=with_codec(self.embeddings, VectorCodec.load(get_redis(), self.index_name)),
+            index_name=self.index_name,
+            redis_url=self.redis_url,
+            schema=self.registry.get_schema(self.index_name),
+            key_prefix=self.key_prefix)
+
+    def is_ingested(self) -> bool:
+        if self.collection:
+            return self.registry.in_collection(self.collection, self.file_id)
+        return self.registry.is_ingested(self.index_name)
@@ -1,4 +1,4 @@
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder, PromptTemplate
 
 # Prompt template
 contextualize_q_system_prompt = """Given a chat history and the latest user question \
@@ -18,13 +18,31 @@ qa_system_prompt = """You are an assistant for question-answering tasks. \
 Use the following pieces of retrieved context to answer the question. \
 If you don't know the answer, just say that you don't know. \
 Use three sentences maximum and keep the answer concise.\
-Be professional and do not include emojis or slang in your answer.\
+Be professional and do not include emojis or slang in your answer. \
+Each piece of context starts with its number in brackets, cite the pieces \
+you use with that number, e.g. [2].
+
 {context}"""
 
+# one retrieved chunk in the context, labelled with its citation number, page and section
+document_prompt = PromptTemplate.from_template("{citation}\n{page_content}")
+
 prompt = ChatPromptTemplate.from_messages(
     [
         ("system", qa_system_prompt),
         MessagesPlaceholder("chat_history"),
         ("human", "{input}"),
     ]
-)
\ No newline at end of file
+)
+
+summarize_system_prompt = """Progressively summarize a conversation between a user \
+and an assistant about a document. Extend the current summary with the new lines, \
+keeping facts, names, numbers and open questions the user may refer to later. \
+Keep it under {max_words} words and return only the summary."""
+
+summarize_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", summarize_system_prompt),
+        ("human", "Current summary:\n{summary}\n\nNew lines:\n{new_lines}"),
+    ]
+)
@@ -1,24 +1,86 @@
 from langchain.chains.retrieval import create_retrieval_chain
-from langchain.chains.history_aware_retriever import create_history_aware_retriever
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_core.runnables import Runnable
+from langchain_core.callbacks import UsageMetadataCallbackHandler
+from langchain_core.runnables import Runnable, RunnableLambda
 
-import redis
 import logging
+import os
+import time
+from functools import lru_cache
+from typing import Optional
 
 from app.modules.prompts import *
-from app.modules.utils import Utils
-from app.config.config import Config
+from app.modules import metrics
+from app.modules.connections import get_llm
+from app.modules.history import ChatHistory
+from app.modules.rewrite import create_fast_history_aware_retriever, is_standalone
+from app.modules.answer_cache import AnswerCache
+from app.modules.retrieval import parse_scope
+from app.config import settings
 
-config = Config()
-helpers = Utils()
+# built on first use, once per process, like the model clients they wrap
+@lru_cache(maxsize=None)
+def get_history() -> ChatHistory:
+    return ChatHistory(get_llm())
 
-REDIS_URL = config.REDIS_URL
-embeddings = config.EMBED_MODEL
-llm = config.LLM_MODEL
+@lru_cache(maxsize=None)
+def get_answer_cache() -> AnswerCache:
+    return AnswerCache()
 
-# Create a redis client
-redis_client = redis.from_url(REDIS_URL)
+def document_sources(docs: list) -> list:
+    """
+    The distinct files and pages the retrieved chunks come from.
+    """
+    sources = []
+    for doc in docs:
+        source = {
+            "file_id": doc.metadata.get("file_id"),
+            "source": os.path.basename(doc.metadata.get("source", "")) or None,
+            "page": doc.metadata.get("page"),
+        }
+        if source not in sources:
+            sources.append(source)
+    return sources
+
+def page_number(doc) -> Optional[int]:
+    """1-based page of a chunk, pages are stored 0-based."""
+    try:
+        return int(doc.metadata["page"]) + 1
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def cite(docs: list) -> list:
+    """Number the retrieved chunks and label them with their page and section, for the prompt."""
+    for n, doc in enumerate(docs, start=1):
+        details = []
+        if page_number(doc) is not None:
+            details.append(f"page {page_number(doc)}")
+        if doc.metadata.get("heading"):
+            details.append(doc.metadata["heading"])
+        doc.metadata["citation"] = f"[{n}] {', '.join(details)}".rstrip()
+    return docs
+
+def document_citations(docs: list) -> list:
+    """
+    Compact citations of the chunks given to the LLM, numbered as in the prompt:
+    file, 1-based page, heading path and character range within the page.
+    """
+    citations = []
+    for n, doc in enumerate(docs, start=1):
+        citation = {"n": n, "file_id": doc.metadata.get("file_id"), "page": page_number(doc)}
+        if doc.metadata.get("heading"):
+            citation["section"] = doc.metadata["heading"]
+        if doc.metadata.get("char_start") not in (None, ""):
+            citation["chars"] = [int(doc.metadata["char_start"]), int(doc.metadata["char_end"])]
+        citations.append(citation)
+    return citations
+
+def total_usage(handler: UsageMetadataCallbackHandler) -> dict:
+    usage = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
+    for model_usage in handler.usage_metadata.values():
+        for key in usage:
+            usage[key] += model_usage.get(key, 0)
+    return usage
 
 class RagChat:
     def __init__(self) -> None:
@@ -29,12 +91,12 @@ class RagChat:
         Create history chain.
         """
         try:
-            history_aware_retriever = create_history_aware_retriever(
-                llm, 
+            history_aware_retriever = create_fast_history_aware_retriever(
+                get_llm(),
                 retriever, 
                 contextualize_q_prompt
-            )
-            question_answer_chain = create_stuff_documents_chain(llm, prompt)
+            ) | RunnableLambda(cite)
+            question_answer_chain = create_stuff_documents_chain(get_llm(), prompt, document_prompt=document_prompt)
             rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
             logging.info("Step 4. Created chain success")
 
@@ -43,39 +105,133 @@ class RagChat:
             logging.error(f"Error in init_chain_with_history: {e}")
             raise
 
-    async def output_generation(self, question: str, session_id: str, chain: Runnable):
+    async def answer_stream(self, question: str, session_id: str, chain: Runnable, meta: dict,
+                            search_kwargs: dict = None):
         """
-        Answer the given question.
+        Stream the answer of the RAG chain, recording the sources, citations and token usage in meta.
         """
+        chat_history = await get_history().load(session_id)
+        usage = UsageMetadataCallbackHandler()
+        chunks = chain.astream(
+            {
+            'input': question,
+            'chat_history': chat_history,
+            'search_kwargs': search_kwargs or {},
+            },
+            config={"callbacks": [usage, metrics.LLMMetricsHandler()]},
+        )
         try:
-            answer = []
-            async for chunk in chain.astream(
-                {
-                'input': question,
-                'chat_history': helpers.get_session_history(session_id).messages
-                }
-            ):
+            async for chunk in chunks:
                 for key in chunk:
-                    if key == "answer":
-                        answer.append(chunk[key])
+                    if key == "context":
+                        meta["sources"] = document_sources(chunk[key])
+                        meta["citations"] = document_citations(chunk[key])
+                    elif key == "answer":
                         yield chunk[key]
+        finally:
+            # closing the chain's stream cancels the LLM request, right when the client goes away
+            await chunks.aclose()
+            meta["usage"] = total_usage(usage)
+
+    async def lookup_answer(self, question: str, scope: str = None, variant: str = "all",
+                            standalone_only: bool = True) -> Optional[dict]:
+        """
+        Look a question up in the answer cache of scope, ahead of answering it: a hit
+        needs no LLM call, so callers only take an LLM slot on a miss.
+        Args:
+            standalone_only: follow-up questions depend on the chat history, they are not cached
+        Returns:
+            dict: {"scope", "variant", "found"} to pass on to output_generation or
+            chat_completion, found is the (hit or None, vector) of AnswerCache.lookup;
+            None when the cache does not apply to the question
+        """
+        if not scope or not settings.ANSWER_CACHE_ENABLED or (standalone_only and not is_standalone(question)):
+            return None
+        question_scope = parse_scope(question) if settings.SCOPE_FROM_QUESTION and standalone_only else {}
+        if question_scope:
+            # "section 4" and "section 5" questions are close, their answers are not
+            variant = AnswerCache.variant(search_kwargs={"variant": variant, **question_scope})
+        found = await get_answer_cache().lookup(scope, question, variant)
+        return {"scope": scope, "variant": variant, "found": found}
+
+    @staticmethod
+    def is_cached(lookup: Optional[dict]) -> bool:
+        return lookup is not None and lookup["found"][0] is not None
+
+    async def output_generation(self, question: str, session_id: str, chain: Runnable,
+                                scope: str = None, variant: str = "all", meta: dict = None,
+                                search_kwargs: dict = None, lookup: Optional[dict] = None):
+        """
+        Answer the given question.
+        Standalone questions go through the answer cache of scope when one is given.
+        Args:
+            meta: filled with the sources, citations, token usage and whether the answer was cached
+            search_kwargs: retrieval options of this request (k, fetch_k, mmr, lambda_mult,
+                rerank, pages, section)
+            lookup: the lookup_answer() of this question, when the caller already made it
+        """
+        meta = {} if meta is None else meta
+        meta.update({"sources": [], "citations": [], "usage": {}, "cached": False})
+        start = time.perf_counter()
+        answer = []
+        tokens = None
+        try:
+            tokens = self.answer_stream(question, session_id, chain, meta, search_kwargs)
+            if lookup is None:
+                lookup = await self.lookup_answer(question, scope, variant)
+            if lookup is not None:
+                tokens = get_answer_cache().stream(lookup["scope"], question, tokens, lookup["variant"], meta,
+                                                   found=lookup["found"])
+            async for token in tokens:
+                if not answer:
+                    metrics.CHAT_TTFT.labels(str(meta["cached"]).lower()).observe(time.perf_counter() - start)
+                answer.append(token)
+                yield token
         except Exception as e:
             logging.error(f"Error in output_generation: {e}")
             raise
         finally:
-            helpers.log_chat_history(session_id, question, "".join(answer))
+            if tokens is not None:
+                await tokens.aclose()
+            await get_history().append(session_id, question, "".join(answer))
+
+    async def llm_stream(self, question: str, meta: dict):
+        usage = UsageMetadataCallbackHandler()
+        chunks = get_llm().astream(question, config={"callbacks": [usage, metrics.LLMMetricsHandler()]})
+        try:
+            async for chunk in chunks:
+                yield chunk.content
+        finally:
+            await chunks.aclose()
+            meta["usage"] = total_usage(usage)
 
-    async def chat_completion(self, question: str):
+    async def chat_completion(self, question: str, meta: dict = None, lookup: Optional[dict] = None):
         """
         Get response.
+        Args:
+            meta: filled with the token usage and whether the answer was cached
+            lookup: the lookup_answer() of this question in the "llm" scope, when the caller already made it
         """
+        meta = {} if meta is None else meta
+        meta.update({"sources": [], "citations": [], "usage": {}, "cached": False})
         full = []
+        start = time.perf_counter()
+        tokens = None
         try:
-            async for chunks in llm.astream(question):
-                full += chunks.content
-                yield chunks
+            tokens = self.llm_stream(question, meta)
+            if lookup is None:
+                lookup = await self.lookup_answer(question, "llm", standalone_only=False)
+            if lookup is not None:
+                tokens = get_answer_cache().stream("llm", question, tokens, meta=meta, found=lookup["found"])
+            async for token in tokens:
+                if not full:
+                    metrics.CHAT_TTFT.labels(str(meta["cached"]).lower()).observe(time.perf_counter() - start)
+                full.append(token)
+                yield token
         except Exception as e:
             logging.error(f"Error in chat_completion: {e}")
             raise
         finally:
+            if tokens is not None:
+                await tokens.aclose()
             logging.info("".join(full))
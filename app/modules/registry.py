@@ -0,0 +1,451 @@
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+import redis
+from langchain_community.vectorstores.redis import Redis
+from langchain_community.vectorstores.redis.constants import REDIS_VECTOR_DTYPE_MAP
+from langchain_community.vectorstores.redis.filters import RedisTag
+
+from app.config import settings
+from app.modules import metrics
+from app.modules.connections import delete_if_equals, get_embeddings, get_redis, redis_url
+from app.modules.answer_cache import AnswerCache
+from app.modules.retrieval import HybridRetriever
+from app.modules.compact import VectorCodec, with_codec
+
+logger = logging.getLogger(__name__)
+
+# RediSearch supports half precision and int8 vectors, LangChain only knows FLOAT32/FLOAT64
+REDIS_VECTOR_DTYPE_MAP.setdefault("FLOAT16", np.float16)
+REDIS_VECTOR_DTYPE_MAP.setdefault("INT8", np.int8)
+
+class IndexRegistry:
+    def __init__(self, max_size: int = settings.INDEX_CACHE_SIZE):
+        """A registry of ingested vector indexes shared by every process through Redis.
+        Celery workers record the index metadata once ingestion is done, API processes
+        rebuild the retriever and RAG chain from it on first use and keep the most
+        recently used ones in a bounded in-process LRU.
+        Clients are looked up on use, so a registry can be created at import time.
+        """
+        self.max_size = max_size
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def redis_client(self):
+        return get_redis()
+
+    @property
+    def redis_url(self) -> str:
+        return redis_url()
+
+    @property
+    def embeddings(self):
+        return get_embeddings()
+
+    @staticmethod
+    def _key(file_id: str) -> str:
+        return f"index_meta:{file_id}"
+
+    @staticmethod
+    def embed_model_name(embeddings) -> str:
+        return getattr(embeddings, "model", None) or type(embeddings).__name__
+
+    def register(self, file_id: str, vector: Redis, chunk_count: Optional[int] = None, version: int = 1) -> dict:
+        """
+        Record the metadata needed to reconnect to an ingested index. Registering a new
+        version of a file swaps its index in one transaction: every process builds its
+        next chain from the new index, chains already built keep the previous one.
+        Args:
+            file_id (str): id of the file the index was built from
+            vector (Redis): the vector store returned by ingestion
+            chunk_count (int): number of chunks stored, read from the index if omitted
+            version (int): version of the file's content
+        Returns:
+            dict: the stored metadata
+        """
+        if chunk_count is None:
+            chunk_count = int(vector.client.ft(vector.index_name).info()["num_docs"])
+
+        previous = self.get_metadata(file_id)
+        metadata = {
+            "index_name": vector.index_name,
+            "key_prefix": vector.key_prefix,
+            "schema": json.dumps(vector.schema),
+            "chunk_count": chunk_count,
+            "embed_model": self.embed_model_name(vector.embeddings),
+            "version": version,
+        }
+        pipeline = self.redis_client.pipeline()
+        pipeline.hset(self._key(file_id), mapping=metadata)
+        # a new version is the file's own index, even if the previous one was shared
+        pipeline.hdel(self._key(file_id), "alias_of")
+        pipeline.sadd(f"index_refs:{vector.index_name}", file_id)
+        if previous is not None and previous["index_name"] != vector.index_name:
+            pipeline.srem(f"index_refs:{previous['index_name']}", file_id)
+        pipeline.execute()
+        self.evict(file_id)
+        # answers cached for a previous ingestion of this index are stale
+        AnswerCache.invalidate(vector.index_name)
+        logger.info(f"Registered index {vector.index_name} for file {file_id}")
+        return metadata
+
+    @staticmethod
+    def merge_schema(stored: Optional[dict], schema: dict) -> dict:
+        """
+        The schema of an index shared by several files (a collection): the stored one,
+        plus the metadata fields of schema it lacks. The vector field stays the stored one.
+        """
+        if not stored:
+            return schema
+        merged = {kind: list(fields) for kind, fields in stored.items()}
+        names = {field["name"] for fields in stored.values() for field in fields}
+        for kind, fields in schema.items():
+            if kind == "vector":
+                continue
+            for field in fields:
+                if field["name"] not in names:
+                    merged.setdefault(kind, []).append(field)
+                    names.add(field["name"])
+        return merged
+
+    def save_schema(self, index_name: str, schema: dict):
+        """
+        Keep the index schema in Redis, so reconnecting needs no file I/O. Schemas
+        saved for an existing index are merged into the stored one (merge_schema),
+        in a transaction retried if another worker saves it at the same time.
+        """
+        key = f"index_schema:{index_name}"
+
+        def merge(pipe):
+            stored = pipe.get(key)
+            merged = self.merge_schema(json.loads(stored) if stored else None, schema)
+            pipe.multi()
+            pipe.set(key, json.dumps(merged))
+
+        self.redis_client.transaction(merge, key)
+
+    def mark_ingested(self, index_name: str):
+        self.redis_client.sadd("ingested_indexes", index_name)
+
+    def is_ingested(self, index_name: str) -> bool:
+        """O(1) check, instead of scanning the keyspace for the index's keys."""
+        return bool(self.redis_client.sismember("ingested_indexes", index_name))
+
+    def get_schema(self, index_name: str) -> Optional[dict]:
+        schema = self.redis_client.get(f"index_schema:{index_name}")
+        return json.loads(schema) if schema else None
+
+    def claim_content_hash(self, file_id: str, content_hash: str) -> str:
+        """
+        Record the content hash of a file.
+        Returns:
+            str: the file_id that owns this content, the first upload with that hash
+        """
+        self.redis_client.set(f"file_content:{file_id}", content_hash)
+        self.redis_client.set(f"content_hash:{content_hash}", file_id, nx=True)
+        return self.redis_client.get(f"content_hash:{content_hash}").decode()
+
+    def get_content_hash(self, file_id: str) -> Optional[str]:
+        content_hash = self.redis_client.get(f"file_content:{file_id}")
+        return content_hash.decode() if content_hash else None
+
+    def release_content_hash(self, file_id: str):
+        """Release the content hash of a file, so a later upload can own it again."""
+        content_hash = self.get_content_hash(file_id)
+        if content_hash:
+            owner = self.redis_client.get(f"content_hash:{content_hash}")
+            if owner and owner.decode() == file_id:
+                self.redis_client.delete(f"content_hash:{content_hash}")
+
+    def take_over_content_hash(self, file_id: str, content_hash: str, owner: str) -> str:
+        """
+        Claim content whose owner has neither an index nor a running job (its ingestion failed).
+        Returns:
+            str: the new owner, file_id unless another upload took it over first
+        """
+        delete_if_equals(f"content_hash:{content_hash}", owner)
+        return self.claim_content_hash(file_id, content_hash)
+
+    @staticmethod
+    def job_key(content_hash: str, collection: Optional[str] = None, file_id: Optional[str] = None) -> str:
+        """Key claimed by the ingestion job of some content, alone or into a collection."""
+        if collection:
+            return f"ingest_job:{collection}:{file_id}:{content_hash}"
+        return f"ingest_job:{content_hash}"
+
+    def release_job(self, job_key: str, file_id: str):
+        """Drop the job claim of a file, so ingesting its content again starts a new job."""
+        claim = self.redis_client.get(job_key)
+        if claim is not None and claim.decode().split(" ")[-1] == file_id:
+            delete_if_equals(job_key, claim)
+
+    def is_referenced(self, index_name: str) -> bool:
+        return self.redis_client.scard(f"index_refs:{index_name}") > 0
+
+    @staticmethod
+    def version_index(file_id: str, version: int) -> tuple:
+        """
+        Index name and key prefix of a version of a file. The first version keeps the
+        original names, later ones get a prefix no other version's prefix matches.
+        """
+        if version <= 1:
+            return file_id, f"doc:{file_id}"
+        return f"{file_id}_v{version}", f"doc_v{version}:{file_id}"
+
+    def alias(self, file_id: str, source_id: str) -> Optional[dict]:
+        """
+        Point file_id at the index already built for source_id (same content).
+        Returns:
+            dict: the shared metadata, or None if source_id is not ingested yet
+        """
+        metadata = self.redis_client.hgetall(self._key(source_id))
+        if not metadata:
+            return None
+        metadata[b"alias_of"] = metadata.get(b"alias_of", source_id)
+        pipeline = self.redis_client.pipeline()
+        pipeline.hset(self._key(file_id), mapping=metadata)
+        pipeline.sadd(f"index_refs:{metadata[b'index_name'].decode()}", file_id)
+        pipeline.execute()
+        self.evict(file_id)
+        logger.info(f"File {file_id} reuses index of {source_id}")
+        return self.get_metadata(file_id)
+
+    def get_metadata(self, file_id: str) -> Optional[dict]:
+        raw = self.redis_client.hgetall(self._key(file_id))
+        if not raw:
+            return None
+        metadata = {k.decode(): v.decode() for k, v in raw.items()}
+        metadata["schema"] = json.loads(metadata["schema"])
+        metadata["chunk_count"] = int(metadata["chunk_count"])
+        metadata["version"] = int(metadata.get("version", 1))
+        return metadata
+
+    def get(self, file_id: str) -> tuple:
+        """
+        Get the retriever and RAG chain of a file, building them from the registry
+        when they are not in the local cache. The current index is read on every
+        call (one HGET), so a new version registered by a worker is picked up.
+        Returns:
+            tuple: (retriever, rag_chain), or (None, None) if the file is not ingested
+        """
+        index_name = self.redis_client.hget(self._key(file_id), "index_name")
+        if index_name is None:
+            self.evict(file_id)
+            return None, None
+        return self._cached(file_id, lambda: self.get_metadata(file_id), index_name=index_name.decode())
+
+    def get_collection(self, collection: str, file_ids: Optional[list] = None) -> tuple:
+        """
+        Get a retriever and RAG chain over a collection, optionally restricted to
+        some of its files. The restriction is a TAG filter inside the KNN query.
+        Returns:
+            tuple: (retriever, rag_chain), or (None, None) if the collection is empty
+        """
+        file_ids = sorted(set(file_ids)) if file_ids else []
+        cache_key = f"collection:{collection}:{','.join(file_ids)}"
+        return self._cached(cache_key, lambda: self.get_collection_metadata(collection), file_ids)
+
+    def _cached(self, cache_key: str, load_metadata, file_ids: Optional[list] = None,
+                index_name: Optional[str] = None) -> tuple:
+        with self._lock:
+            entry = self._cache.get(cache_key)
+            if entry is not None and index_name in (None, entry[0].vectorstore.index_name):
+                self._cache.move_to_end(cache_key)
+                metrics.cache_lookup("index", True)
+                return entry
+        metrics.cache_lookup("index", False)
+
+        metadata = load_metadata()
+        if metadata is None:
+            return None, None
+
+        try:
+            entry = self._build(metadata, file_ids)
+        except Exception as e:
+            logger.error(f"Error in rebuilding index {metadata['index_name']}: {e}")
+            return None, None
+
+        with self._lock:
+            self._cache[cache_key] = entry
+            self._cache.move_to_end(cache_key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return entry
+
+    def _build(self, metadata: dict, file_ids: Optional[list] = None) -> tuple:
+        # imported here, rag_chat pulls in the LLM clients
+        from app.modules.rag_chat import RagChat
+
+        if metadata["embed_model"] != self.embed_model_name(self.embeddings):
+            raise ValueError(
+                f"Index was embedded with {metadata['embed_model']}, "
+                f"current model is {self.embed_model_name(self.embeddings)}"
+            )
+
+        codec = VectorCodec.load(self.redis_client, metadata["index_name"])
+        vector = Redis.from_existing_index(
+            embedding=with_codec(self.embeddings, codec),
+            index_name=metadata["index_name"],
+            schema=metadata["schema"],
+            key_prefix=metadata["key_prefix"],
+            redis_url=self.redis_url,
+        )
+        # LangChain opens a client per store, share the process pool instead
+        vector.client = self.redis_client
+        search_filter = RedisTag("file_id") == file_ids if file_ids else None
+        retriever = HybridRetriever(
+            vectorstore=vector, filter=search_filter, compact_text=bool(codec and codec.compact_text)
+        )
+        rag_chain = RagChat().init_chain_with_history(retriever)
+        return retriever, rag_chain
+
+    @staticmethod
+    def collection_index(collection: str) -> tuple:
+        """Index name and key prefix shared by every file of a collection."""
+        return f"collection_{collection}", f"col:{collection}"
+
+    def add_to_collection(self, collection: str, file_id: str, vector: Redis):
+        pipeline = self.redis_client.pipeline()
+        pipeline.hset(f"collection:{collection}", mapping={
+            "index_name": vector.index_name,
+            "key_prefix": vector.key_prefix,
+            "embed_model": self.embed_model_name(vector.embeddings),
+        })
+        pipeline.sadd(f"collection_files:{collection}", file_id)
+        pipeline.sadd(f"file_collections:{file_id}", collection)
+        pipeline.execute()
+        self.evict_collection(collection)
+        AnswerCache.invalidate(vector.index_name)
+        logger.info(f"Added file {file_id} to collection {collection}")
+
+    def in_collection(self, collection: str, file_id: str) -> bool:
+        return bool(self.redis_client.sismember(f"collection_files:{collection}", file_id))
+
+    def collections_of(self, file_id: str) -> list:
+        return sorted(c.decode() for c in self.redis_client.smembers(f"file_collections:{file_id}"))
+
+    def get_collection_files(self, collection: str) -> list:
+        return sorted(f.decode() for f in self.redis_client.smembers(f"collection_files:{collection}"))
+
+    def get_collection_metadata(self, collection: str) -> Optional[dict]:
+        raw = self.redis_client.hgetall(f"collection:{collection}")
+        if not raw or not self.redis_client.scard(f"collection_files:{collection}"):
+            return None
+        metadata = {k.decode(): v.decode() for k, v in raw.items()}
+        metadata["schema"] = self.get_schema(metadata["index_name"])
+        return metadata
+
+    def leave_collection(self, collection: str, file_id: str):
+        """
+        Take a file out of a collection: it is no longer listed nor its job claimed,
+        and retrievers built over the collection are rebuilt. Its chunks are left
+        to remove_from_collection.
+        """
+        pipeline = self.redis_client.pipeline()
+        pipeline.srem(f"collection_files:{collection}", file_id)
+        pipeline.srem(f"file_collections:{file_id}", collection)
+        pipeline.execute()
+        content_hash = self.get_content_hash(file_id)
+        if content_hash:
+            self.release_job(self.job_key(content_hash, collection, file_id), file_id)
+        self.evict_collection(collection)
+
+    def remove_from_collection(self, collection: str, file_id: str, batch_size: int = settings.DELETE_BATCH_SIZE) -> int:
+        """
+        Remove one file's chunks from a collection, with SCAN and batched UNLINK.
+        Returns:
+            int: number of keys deleted
+        """
+        _, key_prefix = self.collection_index(collection)
+        self.leave_collection(collection, file_id)
+
+        deleted = self._unlink_matching(f"{key_prefix}:{file_id}:*", batch_size)
+        AnswerCache.invalidate(self.collection_index(collection)[0], batch_size)
+        logger.info(f"Removed file {file_id} ({deleted} chunks) from collection {collection}")
+        return deleted
+
+    def evict(self, file_id: str):
+        """Drop the local copy only, the index stays registered."""
+        with self._lock:
+            self._cache.pop(file_id, None)
+
+    def evict_collection(self, collection: str):
+        """Drop the local retrievers of a collection, whatever their file_ids filter."""
+        with self._lock:
+            for key in [key for key in self._cache if key.startswith(f"collection:{collection}:")]:
+                del self._cache[key]
+
+    def remove(self, file_id: str) -> Optional[tuple]:
+        """
+        Unregister a file.
+        Returns:
+            tuple: (index_name, key_prefix) of its index if no other file uses it
+            anymore and it should be dropped, else None
+        """
+        self.evict(file_id)
+        metadata = self.get_metadata(file_id)
+        content_hash = self.get_content_hash(file_id)
+        if content_hash:
+            self.release_job(self.job_key(content_hash), file_id)
+        self.release_content_hash(file_id)
+        if metadata is None:
+            self.redis_client.delete(self._key(file_id), f"file_content:{file_id}")
+            return None
+
+        # the reference is dropped and the remaining ones counted in one transaction,
+        # so of two files of an index removed at once, exactly one sees it unused
+        pipeline = self.redis_client.pipeline(transaction=True)
+        pipeline.delete(self._key(file_id), f"file_content:{file_id}")
+        pipeline.srem(f"index_refs:{metadata['index_name']}", file_id)
+        pipeline.scard(f"index_refs:{metadata['index_name']}")
+        *_, refs = pipeline.execute()
+        if refs > 0:
+            return None
+        return metadata["index_name"], metadata["key_prefix"]
+
+    def _unlink_matching(self, pattern: str, batch_size: int) -> int:
+        deleted = 0
+        batch = []
+        for key in self.redis_client.scan_iter(match=pattern, count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                deleted += self.redis_client.unlink(*batch)
+                batch = []
+        if batch:
+            deleted += self.redis_client.unlink(*batch)
+        return deleted
+
+    def drop_index(self, index_name: str, key_prefix: str, batch_size: int = settings.DELETE_BATCH_SIZE) -> int:
+        """
+        Drop a search index and its keys without blocking Redis: the index is
+        dropped without DD, then keys are found with SCAN and freed with UNLINK
+        in batches.
+        Returns:
+            int: number of keys deleted
+        """
+        try:
+            self.redis_client.ft(index_name).dropindex(delete_documents=False)
+        except redis.exceptions.ResponseError as e:
+            logger.warning(f"Index {index_name} could not be dropped: {e}")
+
+        deleted = self._unlink_matching(f"{key_prefix}:*", batch_size)
+        AnswerCache.invalidate(index_name, batch_size)
+
+        pipeline = self.redis_client.pipeline()
+        pipeline.srem("ingested_indexes", index_name)
+        pipeline.delete(
+            f"index_schema:{index_name}", f"index_refs:{index_name}", f"vector_codec:{index_name}",
+            f"chunk_manifest:{index_name}",
+        )
+        pipeline.execute()
+        logger.info(f"Dropped index {index_name} and {deleted} keys")
+        return deleted
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
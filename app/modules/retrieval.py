@@ -0,0 +1,297 @@
+import logging
+import re
+import threading
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+from langchain_community.vectorstores.redis import Redis
+from langchain_community.vectorstores.redis.filters import RedisFilterExpression, RedisNum, RedisTag
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from redis.commands.search.query import Query
+
+from app.config import settings
+from app.modules import metrics, tracing
+from app.modules.compact import TEXT_SUFFIX, decompress_text
+
+logger = logging.getLogger(__name__)
+
+# RediSearch splits text on punctuation when indexing, "AB-12.3" is stored as "ab", "12", "3"
+TERM_PATTERN = re.compile(r"[^\W_]+", re.UNICODE)
+RERANKERS = ("none", "lexical", "cross-encoder")
+# RediSearch default stopwords, they are not indexed
+STOPWORDS = {
+    "a", "is", "the", "an", "and", "are", "as", "at", "be", "but", "by", "for", "if", "in",
+    "into", "it", "no", "not", "of", "on", "or", "such", "that", "their", "then", "there",
+    "these", "they", "this", "to", "was", "will", "with",
+}
+
+# scope a question can restrict itself to: "pages 10-20", "page 3", "only section 4.2"
+PAGES_PATTERN = re.compile(r"\bp(?:ages?|p?\.)\s*(\d+)(?:\s*(?:-|–|to|through)\s*(\d+))?", re.IGNORECASE)
+SECTION_PATTERN = re.compile(r"(?:\b(?:section|chapter)\s+|§\s*)(\d+(?:\.\d+)*)", re.IGNORECASE)
+
+_cross_encoder = None
+_cross_encoder_lock = threading.Lock()
+
+def text_query(query: str) -> Optional[str]:
+    """
+    Full-text query matching any term of the question. Identifiers that RediSearch
+    splits at indexing time (part numbers, clause ids) become exact phrases.
+    """
+    clauses = []
+    for raw in query.split():
+        terms = TERM_PATTERN.findall(raw.lower())
+        if len(terms) > 1:
+            clauses.append('"' + " ".join(terms) + '"')
+        elif terms and len(terms[0]) > 1 and terms[0] not in STOPWORDS:
+            clauses.append(terms[0])
+    if not clauses:
+        return None
+    return "(" + "|".join(dict.fromkeys(clauses)) + ")"
+
+def parse_scope(question: str) -> dict:
+    """Page range and section named in a question, as pages ("10-20") and section ("4.2")."""
+    scope = {}
+    match = PAGES_PATTERN.search(question)
+    if match:
+        scope["pages"] = f"{match.group(1)}-{match.group(2) or match.group(1)}"
+    match = SECTION_PATTERN.search(question)
+    if match:
+        scope["section"] = match.group(1)
+    return scope
+
+def scope_filter(schema, pages: Optional[str] = None, section: Optional[str] = None) -> Optional[RedisFilterExpression]:
+    """
+    Pre-filter on chunk metadata, applied inside the KNN query. Pages are 1-based
+    like in a PDF viewer, and stored 0-based. Indexes without the field (ingested
+    before it was recorded) are not filtered on it.
+    """
+    numeric = {field.name for field in schema.numeric or []}
+    tags = {field.name for field in schema.tag or []}
+    expression = None
+    if pages and "page" in numeric:
+        first, _, last = pages.partition("-")
+        first, last = sorted((int(first), int(last or first)))
+        expression = (RedisNum("page") >= first - 1) & (RedisNum("page") <= last - 1)
+    if section and "section" in tags:
+        tag = RedisTag("section") == section
+        expression = tag if expression is None else expression & tag
+    return expression
+
+def reciprocal_rank_fusion(rankings: List[List[str]], rrf_k: int = settings.RRF_K) -> List[str]:
+    """Fuse ranked lists of ids, each list contributes 1 / (rrf_k + rank) per id."""
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+def lexical_score(query: str, text: str) -> float:
+    """Share of the question's terms found in the text, exact identifiers count double."""
+    text_terms = set(TERM_PATTERN.findall(text.lower()))
+    score, total = 0.0, 0.0
+    for raw in query.split():
+        terms = TERM_PATTERN.findall(raw.lower())
+        if not terms:
+            continue
+        weight = 2.0 if len(terms) > 1 or any(c.isdigit() for c in raw) else 1.0
+        total += weight
+        if raw.lower().strip("?!.,;:") in text.lower() or all(t in text_terms for t in terms):
+            score += weight
+    return score / total if total else 0.0
+
+def get_cross_encoder():
+    """Load the optional cross-encoder once per process, None if it is not installed."""
+    global _cross_encoder
+    with _cross_encoder_lock:
+        if _cross_encoder is None:
+            try:
+                from sentence_transformers import CrossEncoder
+            except ImportError:
+                logger.warning("sentence-transformers is not installed, falling back to lexical reranking")
+                _cross_encoder = False
+            else:
+                _cross_encoder = CrossEncoder(settings.RERANK_MODEL, device="cpu")
+        return _cross_encoder or None
+
+class HybridRetriever(BaseRetriever):
+    """Full-text (BM25) and vector KNN search over a LangChain Redis index.
+    Both FT.SEARCH queries go to Redis in one pipelined round-trip, their rankings
+    are fused with reciprocal rank fusion and the fused candidates are optionally
+    reranked (lexical overlap or a CPU cross-encoder) and diversified with MMR.
+    k, fetch_k, mmr, lambda_mult and rerank can be overridden per call, as well as
+    pages and section, which pre-filter both queries on chunk metadata (and are
+    otherwise read from the question when scope_from_question is set; a scope read
+    from the question that matches nothing is dropped and the search rerun).
+    With hybrid off, or when the text is stored compressed outside the index
+    (compact_text), only the KNN query runs.
+    """
+
+    vectorstore: Redis
+    k: int = settings.RETRIEVER_K
+    fetch_k: int = settings.RETRIEVER_FETCH_K
+    filter: Optional[RedisFilterExpression] = None
+    mmr: bool = False
+    lambda_mult: float = settings.RETRIEVER_MMR_LAMBDA
+    rerank: str = settings.RETRIEVER_RERANK
+    rrf_k: int = settings.RRF_K
+    hybrid: bool = settings.HYBRID_SEARCH
+    compact_text: bool = False
+    scope_from_question: bool = settings.SCOPE_FROM_QUESTION
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    def _search_args(self, query_string: str, fetch_k: int, return_fields: List[str],
+                     params: Optional[dict] = None, sort_by: Optional[str] = None) -> list:
+        query = Query(query_string).return_fields(*return_fields).paging(0, fetch_k).dialect(2)
+        if sort_by:
+            query = query.sort_by(sort_by)
+        args = ["FT.SEARCH", self.vectorstore.index_name, *query.get_args()]
+        if params:
+            args += ["PARAMS", 2 * len(params)]
+            for name, value in params.items():
+                args += [name, value]
+        return args
+
+    @staticmethod
+    def _parse_reply(reply) -> List[Tuple[str, dict]]:
+        # RESP2 FT.SEARCH reply: [total, id, [field, value, ...], id, [...], ...]
+        results = []
+        for i in range(1, len(reply), 2):
+            doc_id = reply[i].decode() if isinstance(reply[i], bytes) else reply[i]
+            fields = reply[i + 1]
+            results.append((doc_id, {
+                (fields[j].decode() if isinstance(fields[j], bytes) else fields[j]): fields[j + 1]
+                for j in range(0, len(fields), 2)
+            }))
+        return results
+
+    def search(self, query: str, **kwargs: Any) -> Tuple[List[Document], float]:
+        """
+        Run the hybrid search.
+        Returns:
+            tuple: (documents, relevance of the best vector hit, 0 to 1 for cosine)
+        """
+        with metrics.timed(metrics.RETRIEVAL_SECONDS), tracing.span("retrieval", index=self.vectorstore.index_name):
+            return self._search(query, **kwargs)
+
+    def _search(self, query: str, **kwargs: Any) -> Tuple[List[Document], float]:
+        search_filter = kwargs.get("filter", self.filter)
+        scope = {key: kwargs[key] for key in ("pages", "section") if kwargs.get(key)}
+        from_question = not scope and self.scope_from_question
+        if from_question:
+            scope = parse_scope(query)
+        scope = scope_filter(self.vectorstore._schema, **scope)
+        if scope is None:
+            return self._query(query, search_filter, **kwargs)
+
+        docs, best = self._query(query, scope if search_filter is None else search_filter & scope, **kwargs)
+        if docs or not from_question:
+            return docs, best
+        # "Section 230", "chapter 11": a number in the question is not always a heading of the document
+        logger.info(f"No chunk in the scope read from the question, searching without it: {scope}")
+        return self._query(query, search_filter, **kwargs)
+
+    def _query(self, query: str, search_filter: Optional[RedisFilterExpression],
+               **kwargs: Any) -> Tuple[List[Document], float]:
+        k = int(kwargs.get("k", self.k))
+        fetch_k = max(int(kwargs.get("fetch_k", self.fetch_k)), k)
+        mmr = kwargs.get("mmr", self.mmr)
+        rerank = kwargs.get("rerank", self.rerank)
+
+        schema = self.vectorstore._schema
+        content_key, vector_key = schema.content_key, schema.content_vector_key
+        return_fields = [content_key, *schema.metadata_keys]
+        if mmr:
+            return_fields.append(vector_key)
+        base = f"({search_filter})" if search_filter else "*"
+
+        query_vector = np.asarray(self.vectorstore._embeddings.embed_query(query), dtype=schema.vector_dtype)
+        pipeline = self.vectorstore.client.pipeline(transaction=False)
+        pipeline.execute_command(*self._search_args(
+            f"{base}=>[KNN {fetch_k} @{vector_key} $vector AS vector_distance]",
+            fetch_k, return_fields + ["vector_distance"],
+            params={"vector": query_vector.tobytes()}, sort_by="vector_distance",
+        ))
+        full_text = text_query(query) if self.hybrid and not self.compact_text else None
+        if full_text:
+            text_filter = f"({search_filter}) " if search_filter else ""
+            pipeline.execute_command(*self._search_args(
+                f"{text_filter}@{content_key}:{full_text}", fetch_k, return_fields,
+            ))
+        with metrics.timed(metrics.KNN_SECONDS.labels("hybrid" if full_text else "vector")):
+            replies = pipeline.execute()
+
+        vector_hits = self._parse_reply(replies[0])
+        text_hits = self._parse_reply(replies[1]) if full_text else []
+        fields = dict(text_hits)
+        fields.update(vector_hits)
+        best = 1 - float(vector_hits[0][1]["vector_distance"]) if vector_hits else 0.0
+
+        ranked = reciprocal_rank_fusion(
+            [[doc_id for doc_id, _ in vector_hits], [doc_id for doc_id, _ in text_hits]], self.rrf_k
+        )[:fetch_k]
+        if rerank != "none":
+            self._load_texts(ranked, fields)
+        ranked = self._rerank(query, ranked, fields, rerank)
+
+        if mmr and ranked:
+            vectors = [
+                np.frombuffer(fields[doc_id][vector_key], dtype=schema.vector_dtype).astype(np.float32)
+                for doc_id in ranked
+            ]
+            lambda_mult = float(kwargs.get("lambda_mult", self.lambda_mult))
+            picked = maximal_marginal_relevance(query_vector.astype(np.float32), vectors, lambda_mult=lambda_mult, k=k)
+            ranked = [ranked[i] for i in picked]
+
+        ranked = ranked[:k]
+        self._load_texts(ranked, fields)
+        return [self._to_document(doc_id, fields[doc_id]) for doc_id in ranked], best
+
+    def _load_texts(self, doc_ids: List[str], fields: dict):
+        """Read the compressed text of compact chunks, in one round-trip."""
+        if not self.compact_text:
+            return
+        content_key = self.vectorstore._schema.content_key
+        missing = [doc_id for doc_id in doc_ids if not fields[doc_id].get(content_key)]
+        if not missing:
+            return
+        blobs = self.vectorstore.client.mget([doc_id + TEXT_SUFFIX for doc_id in missing])
+        for doc_id, blob in zip(missing, blobs):
+            fields[doc_id][content_key] = decompress_text(blob) if blob else ""
+
+    def _rerank(self, query: str, ranked: List[str], fields: dict, rerank: str) -> List[str]:
+        if rerank not in RERANKERS:
+            raise ValueError(f"Unknown reranker {rerank}, expected one of {RERANKERS}")
+        if rerank == "none":
+            return ranked
+        content_key = self.vectorstore._schema.content_key
+        texts = [self._decode(fields[doc_id][content_key]) for doc_id in ranked]
+
+        if rerank == "cross-encoder":
+            model = get_cross_encoder()
+            if model is not None:
+                scores = model.predict([(query, text) for text in texts])
+                return [ranked[i] for i in np.argsort(-np.asarray(scores), kind="stable")]
+
+        # stable sort, fused rank breaks ties
+        scores = [lexical_score(query, text) for text in texts]
+        return [ranked[i] for i in sorted(range(len(ranked)), key=lambda i: -scores[i])]
+
+    @staticmethod
+    def _decode(value) -> str:
+        return value.decode("utf-8", errors="replace") if isinstance(value, bytes) else value
+
+    def _to_document(self, doc_id: str, fields: dict) -> Document:
+        schema = self.vectorstore._schema
+        metadata = {"id": doc_id}
+        for key in schema.metadata_keys:
+            if key in fields:
+                metadata[key] = self._decode(fields[key])
+        return Document(page_content=self._decode(fields[schema.content_key]), metadata=metadata)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun,
+                                **kwargs: Any) -> List[Document]:
+        return self.search(query, **kwargs)[0]
@@ -0,0 +1,135 @@
+import asyncio
+import hashlib
+import logging
+import re
+from typing import List, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.messages import get_buffer_string
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import BasePromptTemplate
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import Runnable, RunnableLambda
+from langchain_core.runnables.config import run_in_executor
+
+from app.config import settings
+from app.modules import metrics, tracing
+from app.modules.connections import get_async_redis
+from app.modules.retrieval import HybridRetriever
+
+logger = logging.getLogger(__name__)
+
+# words that usually point back at the conversation
+REFERENCE_WORDS = {
+    "it", "its", "this", "that", "these", "those", "they", "them", "their", "theirs",
+    "he", "him", "his", "she", "her", "hers", "there", "former", "latter", "above",
+    "previous", "earlier", "same", "else", "more", "again", "also", "too",
+}
+FOLLOW_UP_PREFIXES = (
+    "and ", "but ", "so ", "or ", "also ", "then ", "what about", "how about",
+    "what else", "tell me more", "elaborate", "go on", "continue",
+)
+# "this document" refers to the file being chatted with, not to the history
+DOCUMENT_REFERENCE = re.compile(r"\b(this|that|the)\s+(document|doc|paper|file|pdf|article|report|book)\b")
+MIN_STANDALONE_WORDS = 4
+
+def is_standalone(question: str) -> bool:
+    """
+    Cheap check of whether a follow-up question can be retrieved on as is.
+    Short questions, questions opening like a continuation and questions with
+    pronouns or other back-references are sent to the rewrite.
+    """
+    text = question.lower().strip()
+    if len(re.findall(r"[a-z0-9']+", text)) < MIN_STANDALONE_WORDS:
+        return False
+    if text.startswith(FOLLOW_UP_PREFIXES):
+        return False
+    words = re.findall(r"[a-z']+", DOCUMENT_REFERENCE.sub(" ", text))
+    return not REFERENCE_WORDS.intersection(words)
+
+class QuestionRewriter:
+    def __init__(self, llm, prompt: BasePromptTemplate, ttl: int = settings.REWRITE_CACHE_TTL):
+        """Rewrites follow-up questions into standalone ones.
+        Rewrites are cached in Redis keyed by the hash of the history and the question,
+        so a repeated follow-up (or a retried request) skips the LLM round-trip.
+        """
+        self.chain = prompt | llm | StrOutputParser()
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(question: str, chat_history: list) -> str:
+        digest = hashlib.sha256(f"{get_buffer_string(chat_history)}\x00{question}".encode("utf-8")).hexdigest()
+        return f"rewrite:{digest}"
+
+    async def rewrite(self, question: str, chat_history: list) -> str:
+        with metrics.timed(metrics.REWRITE_SECONDS), tracing.span("rewrite"):
+            key = self._key(question, chat_history)
+            client = get_async_redis()
+            cached = await client.get(key)
+            metrics.cache_lookup("rewrite", cached is not None)
+            if cached is not None:
+                return cached.decode()
+
+            rewritten = (await self.chain.ainvoke({"input": question, "chat_history": chat_history})).strip()
+            rewritten = rewritten or question
+            await client.set(key, rewritten, ex=self.ttl)
+            return rewritten
+
+async def retrieve_with_score(retriever: BaseRetriever, query: str, **search_kwargs) -> Tuple[List[Document], float]:
+    """
+    Retrieve and return the relevance (0 to 1, higher is better) of the best chunk,
+    used to pick between the raw and the rewritten question.
+    """
+    if isinstance(retriever, HybridRetriever):
+        return await run_in_executor(None, retriever.search, query, **search_kwargs)
+
+    vectorstore = getattr(retriever, "vectorstore", None)
+    if vectorstore is None or getattr(retriever, "search_type", None) != "similarity":
+        return await retriever.ainvoke(query, **search_kwargs), 0.0
+
+    results = await vectorstore.asimilarity_search_with_relevance_scores(query, **{**retriever.search_kwargs, **search_kwargs})
+    docs = [doc for doc, _ in results]
+    return docs, max((score for _, score in results), default=0.0)
+
+def create_fast_history_aware_retriever(llm, retriever: BaseRetriever, prompt: BasePromptTemplate,
+                                        mode: str = settings.REWRITE_MODE) -> Runnable:
+    """
+    Drop-in replacement for create_history_aware_retriever that avoids the rewrite
+    round-trip when it is not needed.
+    Args:
+        mode: "always" rewrites every follow-up like LangChain does,
+              "auto" skips the rewrite for questions that look standalone,
+              "parallel" also retrieves on the raw question while the rewrite runs,
+              keeps the raw chunks if they are already relevant enough and otherwise
+              the better of the two result sets
+    Returns:
+        Runnable: takes {"input", "chat_history", "search_kwargs"}, returns the retrieved documents
+    """
+    rewriter = QuestionRewriter(llm, prompt)
+
+    async def retrieve(inputs: dict) -> List[Document]:
+        question = inputs["input"]
+        chat_history = inputs.get("chat_history") or []
+        # per-request retrieval options (k, fetch_k, mmr...)
+        search_kwargs = inputs.get("search_kwargs") or {}
+        if not chat_history or (mode != "always" and is_standalone(question)):
+            return await retriever.ainvoke(question, **search_kwargs)
+
+        if mode != "parallel":
+            return await retriever.ainvoke(await rewriter.rewrite(question, chat_history), **search_kwargs)
+
+        raw_task = asyncio.create_task(retrieve_with_score(retriever, question, **search_kwargs))
+        rewrite_task = asyncio.create_task(rewriter.rewrite(question, chat_history))
+        raw_docs, raw_score = await raw_task
+        if raw_score >= settings.REWRITE_SKIP_SCORE:
+            rewrite_task.cancel()
+            logger.info(f"Raw question is relevant enough ({raw_score:.2f}), rewrite skipped")
+            return raw_docs
+
+        rewritten = await rewrite_task
+        if rewritten == question:
+            return raw_docs
+        docs, score = await retrieve_with_score(retriever, rewritten, **search_kwargs)
+        return docs if score >= raw_score else raw_docs
+
+    return RunnableLambda(retrieve).with_config(run_name="chat_retriever_chain")
@@ -0,0 +1,133 @@
+import asyncio
+import json
+import logging
+import time
+from typing import AsyncIterator, Callable, Optional
+
+from starlette.requests import Request
+
+from app.config import settings
+from app.modules.connections import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    # stop nginx style proxies from buffering the stream
+    "X-Accel-Buffering": "no",
+}
+
+# the events ending the stream of an ingestion job
+TERMINAL_EVENTS = ("ready", "error")
+
+def format_event(event: str, data) -> str:
+    """One SSE event, data is JSON so newlines in tokens cannot break the framing."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def event_stream(tokens: AsyncIterator[str], request: Request,
+                       final: Optional[Callable[[], dict]] = None,
+                       flush_chars: int = settings.SSE_FLUSH_CHARS,
+                       flush_interval: float = settings.SSE_FLUSH_INTERVAL,
+                       heartbeat: float = settings.SSE_HEARTBEAT_INTERVAL) -> AsyncIterator[str]:
+    """
+    Turn a token stream into SSE events.
+    Tokens are coalesced into "token" events of at least flush_chars characters, or
+    whatever arrived within flush_interval seconds. A comment line is sent as a
+    heartbeat when the model is silent for heartbeat seconds. The stream ends with a
+    "done" event carrying final() (sources, usage...), or an "error" event.
+    When the client disconnects the token stream is closed, which cancels the
+    upstream LLM request.
+    Args:
+        tokens: async iterator over the answer text
+        request: the request, polled for disconnection
+        final: called once the answer is complete, returns the "done" payload
+    """
+    buffer = []
+    buffered = 0
+    last_flush = time.monotonic()
+    next_token = None
+    try:
+        while True:
+            if next_token is None:
+                next_token = asyncio.ensure_future(tokens.__anext__())
+            timeout = heartbeat if not buffer else max(flush_interval - (time.monotonic() - last_flush), 0)
+            done, _ = await asyncio.wait({next_token}, timeout=timeout)
+
+            if done:
+                try:
+                    token = next_token.result()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    next_token = None
+                if token:
+                    buffer.append(token)
+                    buffered += len(token)
+
+            flush = buffer and (buffered >= flush_chars or time.monotonic() - last_flush >= flush_interval)
+            # polled only before a write, not for every token
+            if (flush or not done) and await request.is_disconnected():
+                logger.info("Client disconnected, cancelling the stream")
+                return
+
+            if flush:
+                yield format_event("token", {"text": "".join(buffer)})
+                buffer, buffered = [], 0
+                last_flush = time.monotonic()
+            elif not done and not buffer:
+                yield ": ping\n\n"
+
+        if buffer:
+            yield format_event("token", {"text": "".join(buffer)})
+        yield format_event("done", final() if final else {})
+    except Exception as e:
+        logger.error(f"Error in event_stream: {e}")
+        yield format_event("error", {"detail": "Error in generating the answer."})
+    finally:
+        if next_token is not None:
+            # the generator cannot be closed while a step of it is still running
+            next_token.cancel()
+            try:
+                await next_token
+            except BaseException:
+                pass
+        await tokens.aclose()
+
+async def job_events(job_id: str, request: Request, channel: str, status: Callable[[], tuple],
+                     heartbeat: float = settings.SSE_HEARTBEAT_INTERVAL) -> AsyncIterator[str]:
+    """
+    SSE events of an ingestion job, pushed from its Redis pub/sub channel.
+    The channel is subscribed before the status is read once, so a client connecting
+    or reconnecting mid-job gets the current state and misses nothing published after.
+    The stream ends with the "ready" event (index stats) or an "error" event.
+    Args:
+        job_id: id returned when the ingestion started
+        request: the request, polled for disconnection
+        channel: the job's pub/sub channel
+        status: returns the current (event, data) of the job, called in a thread
+    """
+    pubsub = get_async_redis().pubsub(ignore_subscribe_messages=True)
+    try:
+        await pubsub.subscribe(channel)
+        event, data = await asyncio.to_thread(status)
+        yield format_event(event, data)
+        if event in TERMINAL_EVENTS:
+            return
+        while True:
+            message = await pubsub.get_message(timeout=heartbeat)
+            if await request.is_disconnected():
+                logger.info(f"Client following job {job_id} disconnected")
+                return
+            if message is None:
+                yield ": ping\n\n"
+                continue
+            payload = json.loads(message["data"])
+            yield format_event(payload["event"], payload["data"])
+            if payload["event"] in TERMINAL_EVENTS:
+                return
+    except Exception as e:
+        logger.error(f"Error in streaming events of job {job_id}: {e}")
+        yield format_event("error", {"detail": "Cannot follow the specified task."})
+    finally:
+        await pubsub.aclose()
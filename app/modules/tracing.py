@@ -0,0 +1,104 @@
+import logging
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+from app.config import settings
+
+try:
+    from opentelemetry import context as otel_context, propagate, trace
+except ImportError:  # optional, requests are still given a trace id
+    trace = None
+
+logger = logging.getLogger(__name__)
+
+_trace_id: ContextVar[Optional[str]] = ContextVar("trace_id", default=None)
+
+def enabled() -> bool:
+    """Whether OpenTelemetry spans are recorded. Exporting them is up to the SDK
+    (e.g. run under opentelemetry-instrument), without one the API records nothing."""
+    return trace is not None and settings.OTEL_ENABLED
+
+def current_trace_id() -> Optional[str]:
+    if enabled():
+        span_context = trace.get_current_span().get_span_context()
+        if span_context.is_valid:
+            return format(span_context.trace_id, "032x")
+    return _trace_id.get()
+
+@contextmanager
+def request_trace(trace_id: Optional[str] = None, name: str = "request", **attributes):
+    """
+    Scope of a request or task: sets its trace id (the caller's, else a new one)
+    and opens its root span when OpenTelemetry is on.
+    """
+    token = _trace_id.set(trace_id or uuid.uuid4().hex)
+    try:
+        with span(name, **attributes):
+            yield current_trace_id()
+    finally:
+        _trace_id.reset(token)
+
+@contextmanager
+def span(name: str, **attributes):
+    """A child span of the current one, nothing when OpenTelemetry is off."""
+    if not enabled():
+        yield None
+        return
+    with trace.get_tracer("chatdoc").start_as_current_span(name, attributes=attributes) as current:
+        yield current
+
+def inject(carrier: dict) -> dict:
+    """
+    Write the trace of the current request into a dict that travels with a task
+    (the ingestion job), to continue it in the worker with extract().
+    """
+    carrier["trace_id"] = current_trace_id()
+    if enabled():
+        propagate.inject(carrier)
+    return carrier
+
+@contextmanager
+def extract(carrier: dict, name: str, **attributes):
+    """Continue the trace written by inject(), under a new span."""
+    attached = otel_context.attach(propagate.extract(carrier)) if enabled() else None
+    try:
+        with request_trace(carrier.get("trace_id"), name, **attributes) as trace_id:
+            yield trace_id
+    finally:
+        if attached is not None:
+            otel_context.detach(attached)
+
+class TraceMiddleware:
+    """
+    Runs every HTTP request under a trace id, the caller's TRACE_HEADER if it sent one,
+    returned in the same header. A plain ASGI middleware: the root span ends once the
+    whole body is sent, so it covers the LLM time of streamed answers.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace_id = Headers(scope=scope).get(settings.TRACE_HEADER)
+        with request_trace(trace_id, f"{scope['method']} {scope['path']}") as trace_id:
+            async def send_with_trace_id(message):
+                if message["type"] == "http.response.start":
+                    MutableHeaders(scope=message)[settings.TRACE_HEADER] = trace_id
+                await send(message)
+
+            await self.app(scope, receive, send_with_trace_id)
+
+class TraceIdFilter(logging.Filter):
+    """Adds the trace id of the current request to log records, as %(trace_id)s."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = current_trace_id() or "-"
+        return True
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import AsyncIterator, Optional
+
+import aiofiles
+import redis
+
+from app.config import settings
+from app.modules.connections import get_async_redis, get_redis
+from app.modules.metrics import observe_upload
+
+logger = logging.getLogger(__name__)
+
+ALLOWED_CONTENT_TYPES = {"application/pdf", "application/x-pdf", "application/octet-stream"}
+PDF_MAGIC = b"%PDF-"
+# bytes the PDF header must appear in
+MAGIC_WINDOW = 1024
+UPLOAD_LOCK_TIMEOUT = 15 * 60
+
+class UploadError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+def check_content_type(content_type: Optional[str]):
+    if content_type and content_type.split(";")[0].strip() not in ALLOWED_CONTENT_TYPES:
+        raise UploadError(415, f"Unsupported file type {content_type}, only PDF files are accepted.")
+
+def check_magic_bytes(head: bytes, complete: bool = False) -> bool:
+    """
+    Whether the first bytes of a file show it is a PDF.
+    Args:
+        head: the first bytes received
+        complete: whether the file has no more bytes
+    Returns:
+        bool: True for a PDF, False while too few bytes arrived to tell
+    """
+    # the PDF header may be preceded by junk, readers look at the first 1024 bytes
+    if PDF_MAGIC in head[:MAGIC_WINDOW]:
+        return True
+    if complete or len(head) >= MAGIC_WINDOW:
+        raise UploadError(415, "File is not a valid PDF.")
+    return False
+
+async def stream_to_disk(chunks: AsyncIterator[bytes], file_path: str, offset: int = 0,
+                         max_bytes: int = settings.UPLOAD_MAX_BYTES, partial: bool = False) -> tuple:
+    """
+    Copy an upload to disk chunk by chunk, so memory stays bounded by the chunk size.
+    The first bytes are held back until the PDF header is checked. On any error
+    the file is put back as it was: removed, or truncated to offset.
+    Args:
+        chunks: async iterator over the uploaded bytes
+        file_path: destination, appended to when offset > 0
+        offset: bytes already on disk (resumed upload)
+        max_bytes: upload size limit
+        partial: whether more parts of the file may follow (resumable upload)
+    Returns:
+        tuple: (sha256 hex digest of the bytes written, total size on disk)
+    """
+    digest = hashlib.sha256()
+    size = offset
+    # bytes of earlier parts, when they were too few to check the header
+    prefix = b""
+    if 0 < offset < MAGIC_WINDOW:
+        async with aiofiles.open(file_path, "rb") as in_file:
+            prefix = await in_file.read(offset)
+    checked = offset >= MAGIC_WINDOW or check_magic_bytes(prefix)
+    held = b""
+    start = time.perf_counter()
+    try:
+        async with aiofiles.open(file_path, "ab" if offset else "wb") as out_file:
+            async for chunk in chunks:
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadError(413, f"File is larger than {max_bytes} bytes.")
+                digest.update(chunk)
+                if not checked:
+                    held += chunk
+                    checked = check_magic_bytes(prefix + held)
+                    if not checked:
+                        continue
+                    chunk, held = held, b""
+                await out_file.write(chunk)
+            if size == 0:
+                raise UploadError(400, "Uploaded file is empty.")
+            if not checked:
+                # the file ended, or this part did, before MAGIC_WINDOW bytes
+                if not partial or size >= max_bytes:
+                    check_magic_bytes(prefix + held, complete=True)
+                await out_file.write(held)
+    except BaseException:
+        # also on a dropped connection or a disk error, no partial file is left behind
+        if offset == 0:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        elif os.path.exists(file_path):
+            # keep the resumable upload where it was before this request
+            os.truncate(file_path, offset)
+        raise
+    observe_upload(size - offset, time.perf_counter() - start)
+    return digest.hexdigest(), size
+
+async def iter_upload_file(file, chunk_size: int = settings.UPLOAD_CHUNK_SIZE):
+    """Read a FastAPI UploadFile in chunks."""
+    while chunk := await file.read(chunk_size):
+        yield chunk
+
+class ResumableUploads:
+    def __init__(self, data_path: str):
+        """Upload sessions that survive dropped connections.
+        A session is created with the file name and total size, then the client sends
+        the bytes in one or more parts, each starting at the offset already on disk.
+        Session state is kept in Redis so any API process can continue an upload.
+        """
+        self.data_path = data_path
+
+    @property
+    def redis_client(self):
+        return get_redis()
+
+    @staticmethod
+    def _key(upload_id: str) -> str:
+        return f"upload:{upload_id}"
+
+    def create(self, upload_id: str, file_name: str, size: int) -> dict:
+        if size <= 0:
+            raise UploadError(400, "Upload size must be positive.")
+        if size > settings.UPLOAD_MAX_BYTES:
+            raise UploadError(413, f"File is larger than {settings.UPLOAD_MAX_BYTES} bytes.")
+
+        session = {
+            "file_name": os.path.basename(file_name),
+            "file_path": os.path.join(self.data_path, upload_id + "_" + os.path.basename(file_name)),
+            "size": size,
+        }
+        self.redis_client.set(self._key(upload_id), json.dumps(session), ex=settings.UPLOAD_SESSION_TTL)
+        open(session["file_path"], "wb").close()
+        return session
+
+    @staticmethod
+    def _session(raw: Optional[bytes]) -> dict:
+        if raw is None:
+            raise UploadError(404, "Upload session not found or expired.")
+        session = json.loads(raw)
+        # the bytes on disk are the source of truth for the resume offset
+        session["offset"] = os.path.getsize(session["file_path"]) if os.path.exists(session["file_path"]) else 0
+        return session
+
+    def get(self, upload_id: str) -> dict:
+        return self._session(self.redis_client.get(self._key(upload_id)))
+
+    async def aget(self, upload_id: str) -> dict:
+        return self._session(await get_async_redis().get(self._key(upload_id)))
+
+    async def append(self, upload_id: str, offset: int, chunks: AsyncIterator[bytes]) -> dict:
+        """
+        Write a part of the upload starting at offset, on the async Redis client
+        so the event loop is never blocked.
+        Returns:
+            dict: the session with the new offset
+        """
+        client = get_async_redis()
+        lock = client.lock(f"upload_lock:{upload_id}", timeout=UPLOAD_LOCK_TIMEOUT, blocking=False)
+        if not await lock.acquire():
+            raise UploadError(409, "Another part of this upload is in progress.")
+        try:
+            session = await self.aget(upload_id)
+            if offset != session["offset"]:
+                raise UploadError(409, f"Expected offset {session['offset']}, got {offset}.")
+            _, session["offset"] = await stream_to_disk(
+                chunks, session["file_path"], offset=offset, max_bytes=session["size"], partial=True
+            )
+        finally:
+            try:
+                await lock.release()
+            except redis.exceptions.LockError:
+                pass  # expired during a very slow part
+        await client.expire(self._key(upload_id), settings.UPLOAD_SESSION_TTL)
+        return session
+
+    def complete(self, upload_id: str) -> dict:
+        session = self.get(upload_id)
+        if session["offset"] != session["size"]:
+            raise UploadError(409, f"Upload incomplete, {session['offset']} of {session['size']} bytes received.")
+        self.redis_client.delete(self._key(upload_id))
+        return session
@@ -1,10 +1,18 @@
+import json
 import time
+import hashlib
 
-from langchain_community.chat_message_histories import RedisChatMessageHistory
+from langchain_core.messages import (
+    AIMessage,
+    HumanMessage,
+    message_to_dict,
+    messages_from_dict,
+)
 
-import app.config.config as config
+from app.modules.connections import get_async_redis
 
-redis_url = config.Config().REDIS_URL
+# same layout as RedisChatMessageHistory, newest message first
+MESSAGE_STORE_PREFIX = "message_store:"
 
 class Utils:
     def __init__(self):
@@ -13,24 +21,38 @@ class Utils:
         """
         pass
 
-    def get_session_history(self, session_id: str):
+    async def get_session_history(self, session_id: str) -> list:
         """
-        Get the chat history of the session.
+        Get the chat history of the session, oldest message first.
         """
-        return RedisChatMessageHistory(session_id, redis_url)
+        items = await get_async_redis().lrange(MESSAGE_STORE_PREFIX + session_id, 0, -1)
+        return messages_from_dict([json.loads(m) for m in items[::-1]])
 
-    def log_chat_history(session_id: str, human_message, ai_message):
+    async def log_chat_history(self, session_id: str, human_message, ai_message):
         """
         Log chat messages into our database.
         """
         try:
-            message_log = RedisChatMessageHistory(session_id, redis_url)
-            message_log.add_user_message(human_message)
-            message_log.add_ai_message(ai_message)
+            await get_async_redis().lpush(
+                MESSAGE_STORE_PREFIX + session_id,
+                json.dumps(message_to_dict(HumanMessage(content=human_message))),
+                json.dumps(message_to_dict(AIMessage(content=ai_message))),
+            )
         except Exception as e:
             print(f"Error in log_chat_history: {e}")
             raise
 
+    @staticmethod
+    def hash_file(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+        """
+        SHA-256 of a file on disk, read in chunks.
+        """
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
     def measure_time(func):
         """Decorator to measure the execution time of a function."""
         def wrapper(*args, **kwargs):
@@ -1,19 +1,20 @@
 from celery import Celery
 import logging
 
-from app.config.config import Config
+from app.modules.connections import redis_url
 
-config = Config()
-redis_url = config.REDIS_URL
+celery_app = Celery(__name__)
 
-celery_app = Celery(
-    __name__,
-    broker=redis_url,
-    backend=redis_url,
-)
-
-celery_app.conf.result_backend = redis_url
+# read when the configuration is first used, which binding the tasks at import does:
+# with REDIS_URL set in the environment, that does not build Config and its model clients
+celery_app.add_defaults(lambda: {
+    "broker_url": redis_url(),
+    "result_backend": redis_url(),
+})
+# ingestion stages are long, a worker takes one at a time and acknowledges it when done
+celery_app.conf.worker_prefetch_multiplier = 1
+celery_app.conf.task_acks_late = True
 
 logger = logging.getLogger(__name__)
 
-import app.services.tasks.process_document_task #noqa
\ No newline at end of file
+import app.services.tasks.process_document_task #noqa
@@ -1,24 +1,385 @@
+import json
 import logging
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+
+from celery import chain
 from celery.result import AsyncResult
+from celery.states import FAILURE, READY_STATES, SUCCESS
+from langchain_core.documents import Document
 
-from app.services.celery_app import celery_app, redis_url
-from app.modules import preprocessing, rag_chat
+from app.services.celery_app import celery_app
+from app.modules import metrics, registry, tracing
+from app.modules.compact import compress_text, decompress_text
+from app.modules.connections import delete_if_equals, get_redis
+from app.modules.embeddings import is_rate_limited
+from app.modules.utils import Utils
+from app.config import settings
 
-model = rag_chat.RagChat()
+index_registry = registry.IndexRegistry()
 logger = logging.getLogger(__name__)
 
-@celery_app.task(name="preprocessing_document")
-def process_document(retrievers: dict, chains: dict, file_path: str, file_id: str):
-    preprocessor = preprocessing.DocumentProcessor(file_path)
-    try: 
-        if retrievers.get(file_id) is None:
-            retrievers[file_id] = preprocessor.vector_document()
+STAGES = ("parse", "chunk", "embed", "index", "register")
+STAGE_OPTIONS = {
+    "bind": True,
+    # a stage lost with its worker is redelivered, every stage is safe to run twice
+    "acks_late": True,
+    "reject_on_worker_lost": True,
+    "max_retries": settings.INGEST_MAX_RETRIES,
+}
+
+class IngestionBusy(Exception):
+    """A new version of the file is still being ingested."""
+
+def save_json(key: str, value):
+    """Keep the output of a stage for the next one, compressed, until INGEST_STAGE_TTL."""
+    get_redis().set(key, compress_text(json.dumps(value)), ex=settings.INGEST_STAGE_TTL)
+
+def load_json(key: str):
+    blob = get_redis().get(key)
+    if blob is None:
+        raise ValueError(f"Output of the previous stage expired: {key}")
+    return json.loads(decompress_text(blob))
+
+def save_documents(key: str, docs: list):
+    save_json(key, [{"page_content": d.page_content, "metadata": d.metadata} for d in docs])
+
+def load_documents(key: str) -> list:
+    return [Document(**doc) for doc in load_json(key)]
 
-        if chains.get(file_id) is None:
-            chains[file_id] = model.init_chain_with_history(retrievers[file_id])
+# events of a job, pushed to the clients following it: progress, then ready or error
+
+def events_channel(job_id: str) -> str:
+    return f"ingest_events:{job_id}"
+
+def notify(job_id: str, event: str, data: dict):
+    """Push an event to the clients following a job. Nobody listening is fine, the state is in the backend."""
+    try:
+        get_redis().publish(events_channel(job_id), json.dumps({"event": event, "data": data}))
     except Exception as e:
-        logger.error(f"Error in processing document: {e}")
+        logger.warning(f"Event {event} of job {job_id} could not be published: {e}")
+
+def publish(job: dict, stage: str, done: int = 0, total: int = 0):
+    """Progress of a job, stored under its id in the result backend and pushed to its channel."""
+    progress = {
+        "stage": stage,
+        "stage_index": STAGES.index(stage) + 1,
+        "stages": len(STAGES),
+        "done": done,
+        "total": total,
+        "file_id": job["file_id"],
+    }
+    celery_app.backend.store_result(job["job_id"], progress, "PROGRESS")
+    notify(job["job_id"], "progress", progress)
+
+def progress_callback(job: dict, stage: str):
+    return lambda done, total: publish(job, stage, done, total)
+
+def processor_for(job: dict):
+    # parsing and chunking are only imported where stages run, not by the API
+    from app.modules.preprocessing import DocumentProcessor
+
+    return DocumentProcessor(job["file_path"], collection=job["collection"], version=job.get("version", 1))
+
+def release_job(job: dict):
+    # a finished job must not be joined by the next activation of the same content,
+    # a failed one must not block it
+    delete_if_equals(job["job_key"], job_value(job["job_id"], job["file_id"]))
+
+@contextmanager
+def stage(task, job: dict, name: str):
+    """
+    Run a stage: publish its start, retry rate limited embedding calls with
+    exponential backoff, and fail the whole job on any other error.
+    Stages are timed, and traced under the request that started the job.
+    """
+    publish(job, name)
+    start = time.perf_counter()
+    status = "error"
+    try:
+        with tracing.extract(job.get("trace") or {}, f"ingest.{name}", job_id=job["job_id"], file_id=job["file_id"]):
+            yield
+        status = "ok"
+    except Exception as e:
+        if is_rate_limited(e) and task.request.retries < task.max_retries:
+            delay = min(settings.INGEST_RETRY_MAX_DELAY, settings.INGEST_RETRY_BASE_DELAY * 2 ** task.request.retries)
+            delay *= random.uniform(0.5, 1.0)
+            logger.warning(f"Stage {name} of job {job['job_id']} rate limited, retrying in {delay:.0f}s")
+            status = "retry"
+            raise task.retry(exc=e, countdown=delay)
+        logger.error(f"Error in stage {name} of job {job['job_id']} (trace {(job.get('trace') or {}).get('trace_id')}): {e}")
+        celery_app.backend.mark_as_failure(job["job_id"], e)
+        notify(job["job_id"], "error", {"detail": str(e)})
+        release_job(job)
         raise
+    finally:
+        metrics.INGEST_STAGE_SECONDS.labels(name, status).observe(time.perf_counter() - start)
+
+@celery_app.task(name="ingest.parse", **STAGE_OPTIONS)
+def parse_stage(self, job: dict) -> dict:
+    with stage(self, job, "parse"):
+        processor = processor_for(job)
+        job["skip"] = processor.is_ingested()
+        if not job["skip"] and job.get("previous"):
+            pages = processor.parse_pages(progress_callback(job, "parse"))
+            save_documents(f"ingest:{job['job_id']}:pages", pages)
+        elif not job["skip"]:
+            # chunking and embedding overlap with parsing, only new versions are chunked in the chunk stage
+            _, chunks, page_hashes = processor.parse_and_split(progress_callback(job, "parse"))
+            if not chunks:
+                raise ValueError(f"No text could be extracted from {processor.file_name}")
+            save_json(f"ingest:{job['job_id']}:plan", {"page_hashes": page_hashes})
+            save_documents(f"ingest:{job['job_id']}:chunks", chunks)
+    return job
+
+@celery_app.task(name="ingest.chunk", **STAGE_OPTIONS)
+def chunk_stage(self, job: dict) -> dict:
+    with stage(self, job, "chunk"):
+        if not job["skip"] and job.get("previous"):
+            processor = processor_for(job)
+            pages = load_documents(f"ingest:{job['job_id']}:pages")
+            # a new version only chunks its changed pages, and embeds its new chunks
+            plan, chunks = processor.diff_pages(pages, job["previous"], progress_callback(job, "chunk"))
+            job["diff"] = {key: plan[key] for key in ("reused", "embedded", "removed")}
+            if not plan["entries"]:
+                raise ValueError(f"No text could be extracted from {processor.file_name}")
+            save_json(f"ingest:{job['job_id']}:plan", plan)
+            save_documents(f"ingest:{job['job_id']}:chunks", chunks)
+    return job
+
+@celery_app.task(name="ingest.embed", **STAGE_OPTIONS)
+def embed_stage(self, job: dict) -> dict:
+    with stage(self, job, "embed"):
+        if not job["skip"]:
+            # vectors land in the embedding cache, the index stage reads them back
+            chunks = load_documents(f"ingest:{job['job_id']}:chunks")
+            processor_for(job).embed_chunks(chunks, progress_callback(job, "embed"))
+    return job
+
+@celery_app.task(name="ingest.index", **STAGE_OPTIONS)
+def index_stage(self, job: dict) -> dict:
+    with stage(self, job, "index"):
+        if not job["skip"]:
+            processor = processor_for(job)
+            chunks = load_documents(f"ingest:{job['job_id']}:chunks")
+            plan = load_json(f"ingest:{job['job_id']}:plan")
+            if job.get("previous"):
+                redis_vector = processor.apply_version(plan, chunks, job["previous"], progress_callback(job, "index"))
+            else:
+                redis_vector = processor.ingest_document(chunks, progress_callback(job, "index"), plan["page_hashes"])
+            processor.finish_ingestion(redis_vector)
+    return job
+
+@celery_app.task(name="ingest.register", **STAGE_OPTIONS)
+def register_stage(self, job: dict) -> dict:
+    """
+    Record the index in the registry, where API processes build the retriever and
+    RAG chain from on first use, and point duplicate uploads waiting on this job at it.
+    A new version replaces the file's index in one transaction, the previous index
+    is dropped VERSION_DROP_DELAY seconds later, once in-flight chats are done with it.
+    The result is stored before the "ready" event goes out, so a client reading the
+    status after the event sees the job finished.
+    """
+    with stage(self, job, "register"):
+        processor = processor_for(job)
+        if job.get("previous"):
+            previous = job["previous"]
+            metadata = index_registry.register(job["file_id"], processor.connect_existing(), version=job["version"])
+            # the previous content is no longer this file's, identical uploads must not alias it
+            index_registry.release_content_hash(job["file_id"])
+            index_registry.claim_content_hash(job["file_id"], job["content_hash"])
+            if not index_registry.is_referenced(previous["index_name"]):
+                drop_version.apply_async(
+                    (previous["index_name"], previous["key_prefix"]), countdown=settings.VERSION_DROP_DELAY
+                )
+            result = {**index_result(job["file_id"], metadata), "version": job["version"], **job.get("diff", {})}
+        elif job["collection"]:
+            result = {
+                "collection": job["collection"],
+                "index_name": registry.IndexRegistry.collection_index(job["collection"])[0],
+                "file_count": len(index_registry.get_collection_files(job["collection"])),
+                "file_id": job["file_id"],
+            }
+        else:
+            metadata = index_registry.get_metadata(job["file_id"])
+            if metadata is None:
+                metadata = index_registry.register(job["file_id"], processor.connect_existing())
+            for waiter in get_redis().smembers(f"ingest_waiters:{job['job_id']}"):
+                index_registry.alias(waiter.decode(), job["file_id"])
+            result = index_result(job["file_id"], metadata)
+
+        get_redis().delete(
+            f"ingest:{job['job_id']}:pages", f"ingest:{job['job_id']}:chunks", f"ingest:{job['job_id']}:plan",
+            f"ingest_waiters:{job['job_id']}",
+        )
+        finished(job["job_id"], result)
+        release_job(job)
+    return result
+
+@celery_app.task(name="ingest.drop_version")
+def drop_version(index_name: str, key_prefix: str) -> int:
+    """Drop the index of a replaced version, unless a file points at it again."""
+    if index_registry.is_referenced(index_name):
+        return 0
+    return index_registry.drop_index(index_name, key_prefix)
+
+def job_value(job_id: str, file_id: str) -> str:
+    return f"{job_id} {file_id}"
+
+def choose_queue(file_path: str) -> str:
+    """Large documents get their own queue, so small ones are not stuck behind them."""
+    # the PDF library is loaded by the first upload, not when the API starts
+    import pymupdf
+
+    with pymupdf.open(file_path) as doc:
+        pages = len(doc)
+    return settings.INGEST_QUEUE_LARGE if pages >= settings.LARGE_DOCUMENT_PAGES else settings.INGEST_QUEUE_SMALL
+
+def index_result(file_id: str, metadata: dict) -> dict:
+    return {"index_name": metadata["index_name"], "chunk_count": metadata["chunk_count"], "file_id": file_id}
+
+def index_stats(index_name: str) -> dict:
+    """Size of an index as RediSearch reports it, empty if it cannot be read."""
+    try:
+        info = get_redis().ft(index_name).info()
+    except Exception as e:
+        logger.warning(f"Stats of index {index_name} could not be read: {e}")
+        return {}
+    return {
+        "num_docs": int(info.get("num_docs", 0)),
+        "vector_index_sz_mb": float(info.get("vector_index_sz_mb", 0)),
+        "total_index_memory_sz_mb": float(info.get("total_index_memory_sz_mb", 0)),
+    }
+
+def finished(job_id: str, result: dict) -> str:
+    celery_app.backend.store_result(job_id, result, SUCCESS)
+    notify(job_id, "ready", {**result, "stats": index_stats(result["index_name"])})
+    return job_id
+
+def join_job(job_key: str, file_id: str) -> Optional[str]:
+    """
+    Join the running job that claimed job_key. A file with the same content as
+    the job's own waits for it, and shares its index once built.
+    Returns:
+        str: id of the job, None if no job is running (a finished claim is released)
+    """
+    client = get_redis()
+    existing = client.get(job_key)
+    if existing is None:
+        return None
+    existing_id, owner = existing.decode().split(" ")
+    if AsyncResult(existing_id, app=celery_app).state in READY_STATES:
+        # finished or failed, its index may be gone since: start over
+        delete_if_equals(job_key, existing)
+        return None
+    if owner != file_id:
+        client.sadd(f"ingest_waiters:{existing_id}", file_id)
+        client.expire(f"ingest_waiters:{existing_id}", settings.INGEST_JOB_TTL)
+        # registered in between, after register_stage read the waiters
+        if index_registry.get_metadata(owner) is not None:
+            index_registry.alias(file_id, owner)
+    logger.info(f"File {file_id} joins ingestion job {existing_id}")
+    return existing_id
+
+def process_document(file_path: str, file_id: str, collection: str = None) -> str:
+    """
+    Start the ingestion of a document, or join the one already running for the
+    same content.
+    Returns:
+        str: id of the job, to poll with fetch_task_result
+    """
+    client = get_redis()
+    content_hash = index_registry.get_content_hash(file_id) or Utils.hash_file(file_path)
+
+    if collection:
+        job_key = index_registry.job_key(content_hash, collection, file_id)
+    else:
+        metadata = index_registry.get_metadata(file_id)
+        if metadata is not None:
+            return finished(str(uuid.uuid4()), index_result(file_id, metadata))
+        job_key = index_registry.job_key(content_hash)
+        # reuse the index of an identical file ingested earlier, or wait for its job
+        owner = index_registry.claim_content_hash(file_id, content_hash)
+        if owner != file_id:
+            if (metadata := index_registry.alias(file_id, owner)) is not None:
+                return finished(str(uuid.uuid4()), index_result(file_id, metadata))
+            if (existing_id := join_job(job_key, file_id)) is not None:
+                return existing_id
+            # no index and no job: the owner's ingestion failed, ingest the content for this file
+            index_registry.take_over_content_hash(file_id, content_hash, owner)
+
+    job_id = str(uuid.uuid4())
+    while not client.set(job_key, job_value(job_id, file_id), nx=True, ex=settings.INGEST_JOB_TTL):
+        if (existing_id := join_job(job_key, file_id)) is not None:
+            return existing_id
+
+    return start_job({
+        "job_id": job_id,
+        "job_key": job_key,
+        "file_path": file_path,
+        "file_id": file_id,
+        "collection": collection,
+        "skip": False,
+    })
+
+def update_document(file_path: str, file_id: str) -> str:
+    """
+    Start the ingestion of a new version of a file. Pages and chunks whose content
+    hash is unchanged are copied from the current index, only the rest is chunked
+    and embedded; chats use the current version until the new one is registered.
+    Returns:
+        str: id of the job, to poll with fetch_task_result
+    """
+    previous = index_registry.get_metadata(file_id)
+    if previous is None:
+        # nothing to diff against
+        return process_document(file_path, file_id)
+    content_hash = Utils.hash_file(file_path)
+    if content_hash == index_registry.get_content_hash(file_id):
+        return finished(str(uuid.uuid4()), index_result(file_id, previous))
+
+    client = get_redis()
+    job_id = str(uuid.uuid4())
+    job_key = f"ingest_version:{file_id}"
+    while not client.set(job_key, job_value(job_id, file_id), nx=True, ex=settings.INGEST_JOB_TTL):
+        existing = client.get(job_key)
+        if existing is None:
+            continue  # released in between
+        existing_id = existing.decode().split(" ")[0]
+        if AsyncResult(existing_id, app=celery_app).state not in READY_STATES:
+            raise IngestionBusy(f"Job {existing_id} is still ingesting a version of file {file_id}")
+        delete_if_equals(job_key, existing)
+
+    return start_job({
+        "job_id": job_id,
+        "job_key": job_key,
+        "file_path": file_path,
+        "file_id": file_id,
+        "collection": None,
+        "skip": False,
+        "version": previous["version"] + 1,
+        "content_hash": content_hash,
+        "previous": {"index_name": previous["index_name"], "key_prefix": previous["key_prefix"]},
+    })
+
+def start_job(job: dict) -> str:
+    queue = choose_queue(job["file_path"])
+    # the stages continue the trace of the request starting the job
+    job["trace"] = tracing.inject({})
+    publish(job, "parse")
+    chain(
+        parse_stage.s(job).set(queue=queue),
+        chunk_stage.s().set(queue=queue),
+        embed_stage.s().set(queue=queue),
+        index_stage.s().set(queue=queue),
+        # the last stage runs under the job id, so its result is the job's result
+        register_stage.s().set(queue=queue, task_id=job["job_id"]),
+    ).apply_async()
+    logger.info(f"Started ingestion job {job['job_id']} for file {job['file_id']} on queue {queue}, trace {job['trace']['trace_id']}")
+    return job["job_id"]
 
 def fetch_task_result(task_id: str):
     task_result = AsyncResult(id=task_id,
@@ -27,10 +388,27 @@ def fetch_task_result(task_id: str):
         "task_id": task_id,
         "task_status": task_result.status,
     }
+    if task_result.status == "PROGRESS":
+        result["progress"] = task_result.info
+    elif task_result.status == SUCCESS:
+        result["result"] = task_result.result
+    elif task_result.status == FAILURE:
+        result["error"] = str(task_result.info)
     return result
 
+def status_event(status: dict) -> tuple:
+    """The event matching a fetch_task_result snapshot, as (event, data)."""
+    if status["task_status"] == SUCCESS:
+        result = status["result"]
+        return "ready", {**result, "stats": index_stats(result["index_name"])}
+    if status["task_status"] == FAILURE:
+        return "error", {"detail": status["error"]}
+    if status["task_status"] == "PROGRESS":
+        return "progress", status["progress"]
+    return "pending", {"task_id": status["task_id"]}
+
 logger.info("Task service initialized")
 
 if __name__ == "__main__":
     logger.info("Starting celery worker")
-    celery_app.start()
\ No newline at end of file
+    celery_app.start()
@@ -1,13 +1,42 @@
-from app.services.tasks.process_document_task import process_document
+import os
+
+from app.services.tasks.process_document_task import (
+    parse_stage,
+    chunk_stage,
+    embed_stage,
+    index_stage,
+    register_stage,
+    drop_version,
+)
 from app.services.celery_app import celery_app, logger
+from app.modules import connections, metrics
+from app.config import settings
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown
+
+# imported once by the parent process, pool processes share it after the fork
+import app.modules.preprocessing #noqa
 
 def register_task():
     try:
         logger.info("Registering tasks")
-        celery_app.tasks.register(process_document)
+        for task in (parse_stage, chunk_stage, embed_stage, index_stage, register_stage, drop_version):
+            celery_app.tasks.register(task)
         logger.info("Tasks registered")
     except Exception as e:
         logger.error(f"Error in registering tasks: {e}")
         raise
 
+@worker_init.connect
+def serve_metrics(**kwargs):
+    metrics.serve(settings.WORKER_METRICS_PORT)
+
+@worker_process_init.connect
+def init_clients(**kwargs):
+    # model clients and Redis connections are built per pool process, never shared across a fork
+    connections.warm_up()
+
+@worker_process_shutdown.connect
+def mark_metrics_dead(pid=None, **kwargs):
+    metrics.process_exited(pid or os.getpid())
+
 register_task()
\ No newline at end of file
@@ -41,6 +41,54 @@ def test_session_with_files():
     assert response_delete.status_code == 200
     assert clean_up(id)
 
+def test_upload_rejects_non_pdf():
+    response = requests.post(f'{url}/upload/', files={"file": ("notes.txt", b"hello world", "text/plain")})
+    assert response.status_code == 415
+
+def test_upload_version_of_unknown_file():
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    with open(os.path.join(current_dir, 'sample-1.pdf'), 'rb') as file:
+        response = requests.post(f'{url}/files/unknown-file/versions', files={"file": file})
+    assert response.status_code == 404
+
+def test_resumable_upload():
+    s = requests.Session()
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    with open(os.path.join(current_dir, 'sample-1.pdf'), 'rb') as file:
+        content = file.read()
+
+    response = s.post(f'{url}/upload/resumable', json={"file_name": "sample-1.pdf", "size": len(content)})
+    assert response.status_code == 200
+    upload_id = response.json()['upload_id']
+
+    # send the file in two parts, as if the connection dropped in between
+    half = len(content) // 2
+    response = s.put(f'{url}/upload/resumable/{upload_id}', params={"offset": 0}, data=content[:half])
+    assert response.json()['offset'] == half
+    assert s.get(f'{url}/upload/resumable/{upload_id}').json()['offset'] == half
+    response = s.put(f'{url}/upload/resumable/{upload_id}', params={"offset": half}, data=content[half:])
+    assert response.json()['offset'] == len(content)
+
+    response = s.post(f'{url}/upload/resumable/{upload_id}/complete')
+    assert response.status_code == 200
+    assert response.json()['file_id'] == upload_id
+    check_file_exists_in_server(upload_id)
+
+    s.delete(f"{url}/delete?file_id={upload_id}")
+
+def test_preprocessing_events_starts_with_status():
+    with requests.get(f'{url}/preprocessing_events', stream=True, params={"task_id": "unknown-task"}) as response:
+        assert response.status_code == 200
+        assert response.headers['Content-Type'] == 'text/event-stream; charset=utf-8'
+        first_line = next(response.iter_lines())
+        assert first_line == b'event: pending'
+
+def test_metrics_and_trace_header():
+    response = requests.get(f'{url.removesuffix("/api")}/metrics', headers={"X-Request-ID": "test-trace"})
+    assert response.status_code == 200
+    assert response.headers['X-Request-ID'] == 'test-trace'
+    assert 'chatdoc_cache_requests_total' in response.text
+
 def test_api_chat_history():
     s = requests.Session()
     session = '123'
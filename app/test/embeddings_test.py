@@ -0,0 +1,73 @@
+from app.modules import embeddings
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client, self.commands = client, []
+
+    def getex(self, key, ex=None):
+        self.commands.append(("getex", key))
+
+    def set(self, key, value, ex=None):
+        self.commands.append(("set", key, value))
+
+    def hincrby(self, key, field, amount):
+        self.commands.append(("hincrby", key, field.encode(), amount))
+
+    def hgetall(self, key):
+        self.commands.append(("hgetall", key))
+
+    def execute(self):
+        self.client.round_trips.append([command[0] for command in self.commands])
+        results = []
+        for name, key, *args in self.commands:
+            if name == "getex":
+                results.append(self.client.values.get(key))
+            elif name == "set":
+                self.client.values[key] = args[0]
+                results.append(True)
+            elif name == "hincrby":
+                stats = self.client.values.setdefault(key, {})
+                stats[args[0]] = stats.get(args[0], 0) + args[1]
+                results.append(stats[args[0]])
+            else:
+                results.append(self.client.values.get(key, {}))
+        return results
+
+class FakeRedis:
+    def __init__(self):
+        self.values, self.round_trips = {}, []
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+class FakeModel:
+    model = "fake"
+
+    def embed_documents(self, texts):
+        return [[1.0]] * len(texts)
+
+    def embed_query(self, text):
+        return [2.0]
+
+def cached(monkeypatch) -> embeddings.CachedEmbeddings:
+    client = FakeRedis()
+    monkeypatch.setattr(embeddings, "get_redis", lambda: client)
+    monkeypatch.setattr(embeddings, "local_cache", embeddings.LocalVectorCache(0))
+    monkeypatch.setattr(embeddings, "_pending_stats", {})
+    return embeddings.CachedEmbeddings(FakeModel())
+
+def test_repeated_texts_are_not_hits(monkeypatch):
+    cache = cached(monkeypatch)
+    cache.embed_documents(["a", "a", "b"])
+    assert (cache.hits, cache.misses) == (0, 2)
+    cache.embed_documents(["a", "a", "c"])
+    assert (cache.hits, cache.misses) == (1, 3)
+
+def test_stats_ride_along_with_cache_round_trips(monkeypatch):
+    cache = cached(monkeypatch)
+    cache.embed_query("q")
+    cache.embed_query("q")
+    # the miss is counted by the next lookup, no round-trip of its own
+    assert cache.redis_client.round_trips == [["getex"], ["set"], ["getex", "hincrby"]]
+    stats = cache.stats()
+    assert (stats["total_hits"], stats["total_misses"]) == (1, 1)
@@ -0,0 +1,129 @@
+import asyncio, os, uuid
+
+import pytest
+import redis
+import redis.asyncio
+
+from app.config import settings
+from app.modules import limits
+
+redis_url = os.getenv("REDIS_URL", "redis://localhost:6379")
+
+class FakeRedis:
+    """Answers the ADMIT script with the given replies, in order."""
+
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.calls = 0
+
+    async def eval(self, script, numkeys, *args):
+        self.calls += 1
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+@pytest.fixture
+def limited(monkeypatch):
+    monkeypatch.setattr(settings, "LLM_MAX_CONCURRENCY", 2)
+    monkeypatch.setattr(settings, "LLM_RATE_PER_MINUTE", 0)
+    monkeypatch.setattr(settings, "LLM_TENANT_RATE_PER_MINUTE", 30)
+    monkeypatch.setattr(settings, "LLM_TENANT_LIMITS", {"key:secret": {"concurrency": 1}})
+
+def use(monkeypatch, client):
+    monkeypatch.setattr(limits, "get_async_redis", lambda: client)
+
+def test_unlimited_needs_no_redis(monkeypatch):
+    use(monkeypatch, FakeRedis())
+    lease = asyncio.run(limits.acquire(["file:a"]))
+    assert lease.keys == []
+
+def test_scopes_hide_api_keys(limited):
+    names = [scope.name for scope in limits.scopes(["file:a", "key:secret"])]
+    assert names[:2] == ["global", "file:a"]
+    assert names[2].startswith("key:") and "secret" not in names[2]
+
+def test_queued_chat_is_admitted(limited, monkeypatch):
+    client = FakeRedis([0, 0, 1], [0, 0, 1], [1, 0, 0])
+    use(monkeypatch, client)
+    lease = asyncio.run(limits.acquire(["file:a"], timeout=2))
+    assert client.calls == 3
+    # only concurrency limits hold a lease
+    assert lease.keys == ["llm_limit:global:leases"]
+
+def test_rate_wait_past_timeout_is_rejected_at_once(limited, monkeypatch):
+    client = FakeRedis([0, 5000, 0])
+    use(monkeypatch, client)
+    with pytest.raises(limits.RateLimited) as e:
+        asyncio.run(limits.acquire(["file:a"], timeout=2))
+    assert e.value.retry_after == 5
+    assert client.calls == 1
+
+def test_full_until_timeout_is_rejected(limited, monkeypatch):
+    use(monkeypatch, FakeRedis(*[[0, 0, 1]] * 100))
+    with pytest.raises(limits.RateLimited) as e:
+        asyncio.run(limits.acquire(["file:a"], timeout=0.2))
+    assert e.value.retry_after >= 1
+
+def test_redis_down_lets_chats_through(limited, monkeypatch):
+    use(monkeypatch, FakeRedis(redis.exceptions.ConnectionError("down")))
+    lease = asyncio.run(limits.acquire(["file:a"]))
+    assert lease.keys == []
+
+# the scripts themselves, against a real Redis
+async def admit(client, scopes, lease_id, ttl=60):
+    keys = [key for scope in scopes for key in scope.keys()]
+    args = [arg for scope in scopes for arg in scope.args()]
+    return await client.eval(limits.ADMIT, len(keys), *keys, lease_id, ttl, *args)
+
+def run_with_redis(test):
+    async def run():
+        client = redis.asyncio.from_url(redis_url)
+        try:
+            await client.ping()
+        except redis.exceptions.ConnectionError:
+            pytest.skip(f"no Redis at {redis_url}")
+        prefix = f"test{uuid.uuid4().hex[:8]}"
+        try:
+            await test(client, prefix)
+        finally:
+            keys = [key async for key in client.scan_iter(match=f"{limits.LIMIT_PREFIX}{prefix}*")]
+            if keys:
+                await client.delete(*keys)
+            await client.aclose()
+    asyncio.run(run())
+
+def test_admit_bounds_concurrency():
+    async def test(client, prefix):
+        scope = limits.Scope(f"{prefix}:global", concurrency=2)
+        assert (await admit(client, [scope], "a"))[0] == 1
+        assert (await admit(client, [scope], "b"))[0] == 1
+        assert await admit(client, [scope], "c") == [0, 0, 1]
+        await client.zrem(scope.keys()[0], "a")
+        assert (await admit(client, [scope], "c"))[0] == 1
+    run_with_redis(test)
+
+def test_admit_expires_leases():
+    async def test(client, prefix):
+        scope = limits.Scope(f"{prefix}:global", concurrency=1)
+        assert (await admit(client, [scope], "a", ttl=0.1))[0] == 1
+        await asyncio.sleep(0.2)
+        assert (await admit(client, [scope], "b"))[0] == 1
+    run_with_redis(test)
+
+def test_admit_token_bucket():
+    async def test(client, prefix):
+        scope = limits.Scope(f"{prefix}:global", rate_per_minute=60, burst=1)
+        assert (await admit(client, [scope], "a"))[0] == 1
+        admitted, wait_ms, full = await admit(client, [scope], "b")
+        assert admitted == 0 and full == 0 and 0 < wait_ms <= 1000
+    run_with_redis(test)
+
+def test_admit_takes_all_scopes_or_none():
+    async def test(client, prefix):
+        free = limits.Scope(f"{prefix}:global", concurrency=5)
+        full = limits.Scope(f"{prefix}:file:a", concurrency=1)
+        assert (await admit(client, [full], "a"))[0] == 1
+        assert (await admit(client, [free, full], "b"))[0] == 0
+        assert await client.zcard(free.keys()[0]) == 0
+    run_with_redis(test)
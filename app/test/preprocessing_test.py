@@ -0,0 +1,42 @@
+import pymupdf
+import pytest
+
+from app.modules import preprocessing
+
+class FakeEmbeddings:
+    def __init__(self):
+        self.texts = []
+
+    def embed_documents(self, texts):
+        self.texts += texts
+        return [[0.0]] * len(texts)
+
+@pytest.fixture
+def pdf(tmp_path):
+    path = str(tmp_path / "file_manual.pdf")
+    with pymupdf.open() as doc:
+        for i in range(7):
+            page = doc.new_page()
+            page.insert_text((72, 72), f"Section {i}.1 Heading", fontsize=20)
+            page.insert_text((72, 120), ("Some words of body text. " * 8 + "\n") * 10, fontsize=9)
+        doc.save(path)
+    return path
+
+def processor(path: str, workers: int) -> preprocessing.DocumentProcessor:
+    # no Config or Redis: only the parsing and chunking attributes are set
+    processor = preprocessing.DocumentProcessor.__new__(preprocessing.DocumentProcessor)
+    processor.file_path, processor.parse_workers, processor.shard_pages = path, workers, 2
+    processor.batch_size, processor.embed_concurrency, processor.chunking = 4, 2, "markdown"
+    processor.chunk_embeddings = FakeEmbeddings()
+    return processor
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_parse_and_split_matches_split_pages(pdf, workers):
+    p = processor(pdf, workers)
+    pages, chunks, page_hashes = p.parse_and_split()
+    outline = preprocessing.heading_outline(pages)
+    expected = p.split_pages(pages, outline=outline)
+    assert [(c.page_content, c.metadata) for c in chunks] == [(c.page_content, c.metadata) for c in expected]
+    assert page_hashes == p.page_hashes(pages, outline)
+    # every chunk went through the embedding cache
+    assert sorted(p.chunk_embeddings.texts) == sorted(c.page_content for c in chunks)
@@ -0,0 +1,22 @@
+from app.modules.registry import IndexRegistry
+
+def test_merge_schema_keeps_stored_fields_and_vector():
+    stored = {
+        "tag": [{"name": "file_id"}],
+        "numeric": [{"name": "page"}],
+        "vector": [{"name": "content_vector", "datatype": "FLOAT32", "dims": 768}],
+    }
+    schema = {
+        "tag": [{"name": "file_id"}, {"name": "section"}],
+        "text": [{"name": "heading"}],
+        "vector": [{"name": "content_vector", "datatype": "INT8", "dims": 768}],
+    }
+    merged = IndexRegistry.merge_schema(stored, schema)
+    assert merged["tag"] == [{"name": "file_id"}, {"name": "section"}]
+    assert merged["numeric"] == [{"name": "page"}]
+    assert merged["text"] == [{"name": "heading"}]
+    assert merged["vector"] == stored["vector"]
+
+def test_merge_schema_of_new_index():
+    schema = {"tag": [{"name": "file_id"}]}
+    assert IndexRegistry.merge_schema(None, schema) == schema
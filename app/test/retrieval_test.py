@@ -0,0 +1,38 @@
+from types import SimpleNamespace
+
+from langchain_core.documents import Document
+
+from app.modules.retrieval import HybridRetriever
+
+# an index with page numbers and numbered sections, no Redis needed: the query is faked
+schema = SimpleNamespace(numeric=[SimpleNamespace(name="page")], tag=[SimpleNamespace(name="section")])
+
+class FakeRetriever(HybridRetriever):
+    def _query(self, query, search_filter, **kwargs):
+        self.metadata["filters"].append(str(search_filter) if search_filter is not None else None)
+        hits = self.metadata["hits"].pop(0)
+        return [Document(page_content="hit")] * hits, 0.5
+
+def retriever(*hits) -> FakeRetriever:
+    return FakeRetriever.model_construct(
+        vectorstore=SimpleNamespace(_schema=schema, index_name="test"), filter=None, scope_from_question=True,
+        metadata={"filters": [], "hits": list(hits)},
+    )
+
+def test_scope_from_question_filters_search():
+    r = retriever(2)
+    docs, _ = r.search("What does section 4.2 say about refunds?")
+    assert len(docs) == 2
+    assert r.metadata["filters"] == ["@section:{4\\.2}"]
+
+def test_scope_from_question_without_hits_is_dropped():
+    r = retriever(0, 3)
+    docs, _ = r.search("Under Section 230, are platforms liable?")
+    assert len(docs) == 3
+    assert r.metadata["filters"] == ["@section:{230}", None]
+
+def test_explicit_scope_without_hits_is_kept():
+    r = retriever(0)
+    docs, _ = r.search("Are platforms liable?", section="230")
+    assert docs == []
+    assert r.metadata["filters"] == ["@section:{230}"]
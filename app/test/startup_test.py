@@ -0,0 +1,35 @@
+import os, subprocess, sys
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Config builds the LLM and embedding clients, importing the API or the worker
+# must not: worker children build their own after the fork
+CHECK = """
+import {module}
+from app.modules import connections
+assert connections._config is None, "Config was built at import"
+"""
+
+# parsing and chunking only load where ingestion stages run
+API_MODULES = """
+import sys
+import app.app
+loaded = [name for name in ("app.modules.preprocessing", "pymupdf") if name in sys.modules]
+assert not loaded, f"imported by the API: {loaded}"
+"""
+
+def run(code: str, env: dict) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, "-c", code], cwd=root, env=env, capture_output=True, text=True)
+
+@pytest.mark.parametrize("module", ["app.app", "app.services.worker"])
+def test_import_does_not_build_config(module):
+    env = {**os.environ, "REDIS_URL": os.getenv("REDIS_URL", "redis://localhost:6379")}
+    result = run(CHECK.format(module=module), env)
+    assert result.returncode == 0, result.stderr
+
+def test_api_starts_without_redis_url_or_parsing():
+    env = {name: value for name, value in os.environ.items() if name != "REDIS_URL"}
+    result = run(CHECK.format(module="app.app") + API_MODULES, env)
+    assert result.returncode == 0, result.stderr
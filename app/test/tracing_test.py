@@ -0,0 +1,35 @@
+from contextlib import contextmanager
+
+from starlette.applications import Starlette
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from app.config import settings
+from app.modules import tracing
+
+def test_trace_covers_the_streamed_body(monkeypatch):
+    events = []
+
+    @contextmanager
+    def request_trace(trace_id=None, name="request", **attributes):
+        events.append(f"open {name}")
+        yield trace_id or "new"
+        events.append("close")
+
+    monkeypatch.setattr(tracing, "request_trace", request_trace)
+
+    async def tokens():
+        for token in ("a", "b"):
+            events.append(token)
+            yield token
+
+    async def chat(request):
+        return StreamingResponse(tokens())
+
+    app = Starlette(routes=[Route("/chat", chat)])
+    app.add_middleware(tracing.TraceMiddleware)
+    response = TestClient(app).get("/chat", headers={settings.TRACE_HEADER: "abc"})
+    assert response.text == "ab"
+    assert response.headers[settings.TRACE_HEADER] == "abc"
+    assert events == ["open GET /chat", "a", "b", "close"]
@@ -0,0 +1,107 @@
+import asyncio, json, os
+
+import pytest
+
+from app.modules import uploads
+
+async def chunks(*parts):
+    for part in parts:
+        if isinstance(part, Exception):
+            raise part
+        yield part
+
+def write(path, *parts, **kwargs):
+    return asyncio.run(uploads.stream_to_disk(chunks(*parts), str(path), **kwargs))
+
+def test_header_split_across_chunks(tmp_path):
+    path = tmp_path / "a.pdf"
+    _, size = write(path, b"junk", b"%P", b"DF-1.7", b"rest")
+    assert size == 16
+    assert path.read_bytes() == b"junk%PDF-1.7rest"
+
+def test_header_after_the_first_chunk_within_the_window(tmp_path):
+    path = tmp_path / "a.pdf"
+    write(path, b"x" * 600, b"y" * 300 + b"%PDF-", b"z" * 2000)
+    assert path.read_bytes().index(b"%PDF-") == 900
+
+def test_not_a_pdf_is_removed(tmp_path):
+    path = tmp_path / "a.pdf"
+    with pytest.raises(uploads.UploadError) as e:
+        write(path, b"x" * 600, b"y" * 600, b"%PDF-")
+    assert e.value.status_code == 415
+    assert not path.exists()
+
+def test_short_file_without_header_is_rejected(tmp_path):
+    path = tmp_path / "a.pdf"
+    with pytest.raises(uploads.UploadError):
+        write(path, b"hello")
+    assert not path.exists()
+
+def test_failed_stream_is_removed(tmp_path):
+    path = tmp_path / "a.pdf"
+    with pytest.raises(OSError):
+        write(path, b"%PDF-1.7", b"x" * 100, OSError("connection reset"))
+    assert not path.exists()
+
+def test_failed_part_is_truncated(tmp_path):
+    path = tmp_path / "a.pdf"
+    write(path, b"%PDF-1.7", max_bytes=100, partial=True)
+    with pytest.raises(OSError):
+        write(path, b"x" * 50, OSError("connection reset"), offset=8, max_bytes=100, partial=True)
+    assert path.read_bytes() == b"%PDF-1.7"
+
+def test_parts_shorter_than_the_window(tmp_path):
+    path = tmp_path / "a.pdf"
+    write(path, b"junk%P", max_bytes=20, partial=True)
+    write(path, b"DF-1.7", offset=6, max_bytes=20, partial=True)
+    write(path, b"x" * 8, offset=12, max_bytes=20, partial=True)
+    assert path.read_bytes() == b"junk%PDF-1.7" + b"x" * 8
+    os.remove(path)
+    write(path, b"junk", max_bytes=8, partial=True)
+    with pytest.raises(uploads.UploadError):
+        write(path, b"more", offset=4, max_bytes=8, partial=True)
+    assert path.read_bytes() == b"junk"
+
+class FakeAsyncRedis:
+    """Session and lock of a resumable upload, on the async client only."""
+
+    def __init__(self, session):
+        self.values = {"upload:u": json.dumps(session).encode()}
+        self.locked = False
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def expire(self, key, ttl):
+        pass
+
+    def lock(self, name, timeout, blocking):
+        client = self
+
+        class Lock:
+            async def acquire(self):
+                if client.locked:
+                    return False
+                client.locked = True
+                return True
+
+            async def release(self):
+                client.locked = False
+
+        return Lock()
+
+def test_append_uses_the_async_client(tmp_path, monkeypatch):
+    path = tmp_path / "u_a.pdf"
+    path.write_bytes(b"")
+    client = FakeAsyncRedis({"file_name": "a.pdf", "file_path": str(path), "size": 12})
+    monkeypatch.setattr(uploads, "get_async_redis", lambda: client)
+    # a sync call would fail: no Redis is reachable
+    monkeypatch.setattr(uploads, "get_redis", lambda: pytest.fail("sync Redis used"))
+    resumable = uploads.ResumableUploads(str(tmp_path))
+    session = asyncio.run(resumable.append("u", 0, chunks(b"%PDF-1.7")))
+    assert session["offset"] == 8 and not client.locked
+
+    client.locked = True
+    with pytest.raises(uploads.UploadError) as e:
+        asyncio.run(resumable.append("u", 8, chunks(b"rest")))
+    assert e.value.status_code == 409
@@ -87,11 +87,25 @@ const Chat = () => {
       const reader = response.body.getReader();
       const decoder = new TextDecoder();
       let chatbotMessage = { text: '', sender: 'chatbot' };
+      let buffer = '';
 
       while (true) {
         const { value, done } = await reader.read();
         if (done) break;
-        chatbotMessage.text += decoder.decode(value, { stream: true });
+        // server-sent events are separated by a blank line
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const rawEvent of events) {
+          const lines = rawEvent.split('\n');
+          const event = lines.find((line) => line.startsWith('event: '))?.slice(7);
+          const data = lines.find((line) => line.startsWith('data: '))?.slice(6);
+          if (event === 'token') {
+            chatbotMessage.text += JSON.parse(data).text;
+          } else if (event === 'error') {
+            throw new Error(JSON.parse(data).detail);
+          }
+        }
         setMessages((prevMessages) => {
           const updatedMessages = [...prevMessages];
           updatedMessages[prevMessages.length - 1] = { ...chatbotMessage };